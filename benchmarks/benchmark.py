@@ -0,0 +1,229 @@
+import argparse
+import ast
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource # Not available on Windows
+except ImportError:
+    resource = None
+
+from corpus import generate_corpus
+from fake_gemini import FakeSettings, install
+
+# --- Benchmark Harness ---
+# Measures end-to-end throughput of generate_feedback.py without spending API quota:
+#   1. writes a synthetic corpus of DOCX/PDF submissions (Canvas file naming) to a scratch folder,
+#   2. runs the unmodified script there in a child process, with genai.GenerativeModel replaced
+#      by the simulated backend in fake_gemini.py (latency, errors, 429s, server-side RPM),
+#   3. reports papers/minute, CPU time and peak RSS, plus the script's own per-stage metrics.
+#
+# Examples:
+#   python benchmarks/benchmark.py --papers 40 --latency 1.5 --error-rate 0.02
+#   python benchmarks/benchmark.py --server-rpm 60 --config REQUESTS_PER_MINUTE=60 -- --pack
+# Everything after "--" is passed to generate_feedback.py. --config NAME=VALUE overrides one of
+# its configuration constants for the run (VALUE is a Python literal).
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SETTINGS_FILENAME = "fake_server_settings.json"
+SERVER_STATS_FILENAME = "fake_server_stats.json"
+LOG_FILENAME = "run_log.txt"
+
+
+def parse_args(argv):
+    script_args = []
+    if "--" in argv:
+        script_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    parser = argparse.ArgumentParser(description="Benchmark generate_feedback.py against a simulated Gemini backend.")
+    corpus = parser.add_argument_group("synthetic corpus")
+    corpus.add_argument("--papers", type=int, default=20, help="Number of submissions (default: 20).")
+    corpus.add_argument("--words", type=int, default=800, help="Average words per paper (default: 800).")
+    corpus.add_argument("--words-spread", type=float, default=0.5, help="Length variation, +/- fraction (default: 0.5).")
+    corpus.add_argument("--pdf-fraction", type=float, default=0.5, help="Share of PDF submissions (default: 0.5).")
+    corpus.add_argument("--seed", type=int, default=0, help="Random seed for the corpus and the simulated API.")
+    api = parser.add_argument_group("simulated Gemini API")
+    api.add_argument("--latency", type=float, default=1.0, help="Mean seconds per response (default: 1.0).")
+    api.add_argument("--latency-jitter", type=float, default=0.3, help="Latency variation, +/- fraction (default: 0.3).")
+    api.add_argument("--error-rate", type=float, default=0.0, help="Probability of a 503 error per request.")
+    api.add_argument("--rate-limit-rate", type=float, default=0.0, help="Probability of a random 429 per request.")
+    api.add_argument("--server-rpm", type=int, default=None, help="Requests per minute before the API answers 429.")
+    api.add_argument("--output-chars", type=int, default=3000, help="Length of each simulated letter (default: 3000).")
+    parser.add_argument("--config", action="append", default=[], metavar="NAME=VALUE",
+                        help="Override a generate_feedback.py setting, e.g. MAX_CONCURRENT_REQUESTS=8 (repeatable).")
+    parser.add_argument("--workdir", help="Scratch folder for the corpus and output (default: a new temporary folder).")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch folder afterwards.")
+    parser.add_argument("--json", help="Also write the results as JSON to this file.")
+    args = parser.parse_args(argv)
+    args.script_args = script_args
+    args.overrides = parse_overrides(parser, args.config)
+    return args
+
+
+def parse_overrides(parser, items):
+    overrides = {}
+    for item in items:
+        name, separator, value = item.partition("=")
+        if not separator or not name.isupper():
+            parser.error(f"--config expects NAME=VALUE with an upper-case setting name, got '{item}'")
+        try:
+            overrides[name] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            overrides[name] = value # A bare string, e.g. TOKEN_COUNTING=api
+    return overrides
+
+
+# === Child process: run the script against the simulated backend ===
+
+def run_child(overrides, script_args):
+    with open(SETTINGS_FILENAME, "r", encoding="utf-8") as f:
+        server = install(FakeSettings.from_dict(json.load(f)))
+    sys.path.insert(0, REPO_ROOT)
+    import generate_feedback
+    from feedback_assistant.conformance import LetterTemplate
+    from feedback_assistant.rate_limiter import RateLimiter
+    from feedback_assistant.retry import RetryPolicy
+
+    for name, value in overrides.items():
+        if not hasattr(generate_feedback, name):
+            raise SystemExit(f"Unknown generate_feedback.py setting: {name}")
+        setattr(generate_feedback, name, value)
+    # These are built from the settings at import time
+    generate_feedback.rate_limiter = RateLimiter(generate_feedback.REQUESTS_PER_MINUTE, generate_feedback.TOKENS_PER_MINUTE)
+    generate_feedback.retry_policy = RetryPolicy(generate_feedback.MAX_RETRY_ATTEMPTS, generate_feedback.RETRY_BASE_DELAY,
+                                                 generate_feedback.RETRY_MAX_DELAY)
+    server.letter_sections = [name for name, _, _ in LetterTemplate(generate_feedback.feedback_template).sections]
+    sys.argv = ["generate_feedback.py"] + script_args
+    try:
+        generate_feedback.main()
+    finally:
+        with open(SERVER_STATS_FILENAME, "w", encoding="utf-8") as f:
+            json.dump(server.stats, f)
+
+
+# === Parent process ===
+
+def children_usage():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_CHILDREN)
+
+
+def run_benchmark(args, workdir):
+    print(f"Writing {args.papers} synthetic submissions to '{workdir}'...")
+    started = time.perf_counter()
+    generate_corpus(os.path.join(workdir, "papers"), args.papers, args.words, args.words_spread,
+                    args.pdf_fraction, args.seed)
+    print(f"  Done in {time.perf_counter() - started:.1f}s.")
+
+    settings = FakeSettings(latency=args.latency, latency_jitter=args.latency_jitter, error_rate=args.error_rate,
+                            rate_limit_rate=args.rate_limit_rate, server_rpm=args.server_rpm,
+                            output_chars=args.output_chars, seed=args.seed)
+    with open(os.path.join(workdir, SETTINGS_FILENAME), "w", encoding="utf-8") as f:
+        json.dump(settings.as_dict(), f)
+
+    command = [sys.executable, os.path.abspath(__file__), "--run-child", json.dumps(args.overrides)] + args.script_args
+    env = dict(os.environ, GOOGLE_API_KEY="simulated", PYTHONPATH=REPO_ROOT)
+    print("Running generate_feedback.py against the simulated API...")
+    usage_before = children_usage()
+    started = time.perf_counter()
+    with open(os.path.join(workdir, LOG_FILENAME), "w", encoding="utf-8") as log_file:
+        returncode = subprocess.call(command, cwd=workdir, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    wall_seconds = time.perf_counter() - started
+    usage_after = children_usage()
+
+    if returncode != 0:
+        with open(os.path.join(workdir, LOG_FILENAME), "r", encoding="utf-8") as f:
+            print("".join(f.readlines()[-30:]))
+        raise SystemExit(f"generate_feedback.py exited with status {returncode} (full log in {workdir})")
+
+    results = {
+        "papers": args.papers,
+        "corpus": {"words": args.words, "words_spread": args.words_spread, "pdf_fraction": args.pdf_fraction,
+                   "seed": args.seed},
+        "simulated_api": settings.as_dict(),
+        "config_overrides": args.overrides,
+        "script_args": args.script_args,
+        "wall_clock_s": round(wall_seconds, 3),
+        "papers_per_minute": round(args.papers / wall_seconds * 60, 2),
+    }
+    if usage_before and usage_after:
+        results["cpu_user_s"] = round(usage_after.ru_utime - usage_before.ru_utime, 3)
+        results["cpu_system_s"] = round(usage_after.ru_stime - usage_before.ru_stime, 3)
+        # ru_maxrss is the largest single process (KiB on Linux, bytes on macOS)
+        scale = 1 if sys.platform == "darwin" else 1024
+        results["peak_rss_mb"] = round(usage_after.ru_maxrss * scale / (1024 * 1024), 1)
+    with open(os.path.join(workdir, SERVER_STATS_FILENAME), "r", encoding="utf-8") as f:
+        results["api_requests"] = json.load(f)
+    metrics_path = os.path.join(workdir, "feedback", "run_metrics.json")
+    if os.path.exists(metrics_path):
+        with open(metrics_path, "r", encoding="utf-8") as f:
+            run_metrics = json.load(f)
+        results["outcomes"] = run_metrics.get("outcomes")
+        results["stages"] = run_metrics.get("stages")
+    token_report_path = os.path.join(workdir, "feedback", "token_report.json")
+    if os.path.exists(token_report_path):
+        with open(token_report_path, "r", encoding="utf-8") as f:
+            times = [paper["time_to_feedback_s"] for paper in json.load(f)["papers"] if "time_to_feedback_s" in paper]
+        if times:
+            results["time_to_feedback_s"] = {"mean": round(statistics.mean(times), 3),
+                                             "median": round(statistics.median(times), 3), "max": round(max(times), 3)}
+    return results
+
+
+def print_results(results):
+    print("\n--- Benchmark Results ---")
+    print(f"Papers: {results['papers']} (~{results['corpus']['words']} words, "
+          f"{results['corpus']['pdf_fraction']:.0%} PDF)")
+    api = results["simulated_api"]
+    print(f"Simulated API: {api['latency']}s +/-{api['latency_jitter']:.0%} latency, {api['error_rate']:.0%} errors, "
+          f"{api['rate_limit_rate']:.0%} random 429s, server RPM {api['server_rpm'] or 'unlimited'}")
+    if results.get("outcomes"):
+        outcomes = results["outcomes"]
+        print(f"Outcomes: {outcomes.get('success', 0)} succeeded, {outcomes.get('error', 0)} errors")
+    print(f"Wall time: {results['wall_clock_s']:.1f}s  ->  {results['papers_per_minute']:.1f} papers/minute")
+    if results.get("time_to_feedback_s"):
+        times = results["time_to_feedback_s"]
+        print(f"Time to feedback: {times['mean']:.1f}s mean, {times['median']:.1f}s median, {times['max']:.1f}s max")
+    if "cpu_user_s" in results:
+        print(f"CPU time: {results['cpu_user_s'] + results['cpu_system_s']:.1f}s "
+              f"(user {results['cpu_user_s']:.1f}s + system {results['cpu_system_s']:.1f}s)")
+        print(f"Peak RSS: {results['peak_rss_mb']:.1f} MB (largest single process)")
+    requests = results["api_requests"]
+    print(f"Requests to the simulated API: {requests['requests']} "
+          f"({requests['rate_limited']} rate limited, {requests['errors']} errors)")
+    if results.get("stages"):
+        busiest = sorted(results["stages"].items(), key=lambda item: item[1]["total_s"], reverse=True)[:5]
+        print("Most time spent in: " + ", ".join(
+            f"{stage} {summary['total_s']:.1f}s (p95 {summary['p95_s']:.2f}s)" for stage, summary in busiest))
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--run-child":
+        run_child(json.loads(sys.argv[2]), sys.argv[3:])
+        return
+
+    args = parse_args(sys.argv[1:])
+    workdir = args.workdir or tempfile.mkdtemp(prefix="feedback_benchmark_")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        results = run_benchmark(args, workdir)
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print_results(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to '{args.json}'")
+
+
+# The guard matters: the script's extraction worker processes re-import this file on Windows/macOS.
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import os
+import random
+
+# --- Synthetic Submission Corpus ---
+# Writes fake student papers as DOCX and PDF files named the way Canvas names submission
+# downloads (username_userid_submissionid_OriginalName.ext), at a chosen size and count.
+# The text is random essay-like filler, so extraction and prompt sizes are realistic.
+
+WORDS = (
+    "the analysis argument essay author evidence claim reader context example quote paragraph "
+    "question driving nature place identity community landscape language history memory poem "
+    "poet image reflection perspective however therefore because although while which suggests "
+    "shows reveals complicates connects structure tone voice audience purpose source research "
+    "interpretation meaning significance detail line stanza moment tension contrast theme"
+).split()
+
+FIRST_NAMES = ("alex", "bailey", "casey", "devon", "emery", "finley", "gray", "harper", "indigo",
+               "jordan", "kai", "logan", "morgan", "noel", "oakley", "parker", "quinn", "riley")
+
+
+def paper_paragraphs(rng, words):
+    # Roughly `words` words in paragraphs of 80-160 words
+    paragraphs = []
+    remaining = words
+    while remaining > 0:
+        count = min(remaining, rng.randint(80, 160))
+        sentence_words = [rng.choice(WORDS) for _ in range(count)]
+        text = []
+        for index, word in enumerate(sentence_words):
+            if index == 0 or text[-1].endswith("."):
+                word = word.capitalize()
+            text.append(word + ("." if rng.random() < 0.08 or index == count - 1 else ""))
+        paragraphs.append(" ".join(text))
+        remaining -= count
+    return paragraphs
+
+
+def canvas_filename(username, user_id, submission_id, title, extension):
+    return f"{username}_{user_id}_{submission_id}_{title}{extension}"
+
+
+def write_docx(path, paragraphs):
+    from docx import Document
+
+    document = Document()
+    for paragraph in paragraphs:
+        document.add_paragraph(paragraph)
+    document.save(path)
+
+
+def write_pdf(path, paragraphs, line_chars=90, lines_per_page=48):
+    # A minimal text PDF (Helvetica, one content stream per page) that PyPDF2 can read
+    lines = []
+    for paragraph in paragraphs:
+        line = ""
+        for word in paragraph.split():
+            if line and len(line) + 1 + len(word) > line_chars:
+                lines.append(line)
+                line = word
+            else:
+                line = f"{line} {word}" if line else word
+        lines.extend([line, ""])
+    pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)] or [[]]
+
+    objects = [] # PDF objects, numbered from 1
+    objects.append("<< /Type /Catalog /Pages 2 0 R >>")
+    page_numbers = [4 + 2 * index for index in range(len(pages))]
+    kids = " ".join(f"{number} 0 R" for number in page_numbers)
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>")
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    for number, page_lines in zip(page_numbers, pages):
+        text = "".join(f"({_pdf_escape(line)}) '\n" for line in page_lines)
+        stream = f"BT /F1 11 Tf 14 TL 60 760 Td\n{text}ET"
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {number + 1} 0 R >>")
+        objects.append(f"<< /Length {len(stream.encode('latin-1'))} >>\nstream\n{stream}\nendstream")
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref_at = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    for offset in offsets:
+        output += f"{offset:010d} 00000 n \n".encode("latin-1")
+    output += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_at}\n%%EOF\n".encode("latin-1")
+    with open(path, "wb") as f:
+        f.write(output)
+
+
+def _pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def generate_corpus(folder, count, words=800, words_spread=0.5, pdf_fraction=0.5, seed=0):
+    # Writes `count` papers into folder. Paper lengths vary by +/- words_spread around `words`.
+    # Returns the list of filenames written.
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    filenames = []
+    for index in range(count):
+        username = f"{rng.choice(FIRST_NAMES)}{index:03d}"
+        extension = ".pdf" if rng.random() < pdf_fraction else ".docx"
+        filename = canvas_filename(username, 100000 + index, 900000 + rng.randint(0, 99999),
+                                   f"Project1_Draft_{username.capitalize()}", extension)
+        length = max(50, int(words * rng.uniform(1 - words_spread, 1 + words_spread)))
+        paragraphs = paper_paragraphs(rng, length)
+        if extension == ".pdf":
+            write_pdf(os.path.join(folder, filename), paragraphs)
+        else:
+            write_docx(os.path.join(folder, filename), paragraphs)
+        filenames.append(filename)
+    return filenames
@@ -0,0 +1,157 @@
+import json
+import random
+import threading
+import time
+import types
+
+# --- Simulated Gemini Backend ---
+# A stand-in for genai.GenerativeModel that answers locally after a configurable delay, with
+# configurable random errors and 429s, and optionally enforces a server-side RPM quota the
+# way a real API tier would. install() patches google.generativeai so generate_feedback.py
+# runs unchanged against it. Supports what the script uses: plain and streamed
+# generate_content, JSON mode for packed requests, count_tokens and usage_metadata.
+
+
+class FakeSettings:
+
+    def __init__(self, latency=1.0, latency_jitter=0.3, error_rate=0.0, rate_limit_rate=0.0,
+                 server_rpm=None, output_chars=3000, stream_chunk_chars=200, seed=None):
+        self.latency = latency                  # Seconds per response (mean)
+        self.latency_jitter = latency_jitter    # +/- fraction of latency, uniformly distributed
+        self.error_rate = error_rate            # Probability of a 503 (overloaded) error
+        self.rate_limit_rate = rate_limit_rate  # Probability of a random 429 (quota) error
+        self.server_rpm = server_rpm            # Requests per rolling minute before 429s (None = unlimited)
+        self.output_chars = output_chars        # Length of each generated letter
+        self.stream_chunk_chars = stream_chunk_chars
+        self.seed = seed
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**values)
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class FakeServer:
+    # Shared state of the simulated API (one per process)
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.random = random.Random(settings.seed)
+        self.recent_requests = [] # monotonic timestamps, for server_rpm
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "rate_limited": 0, "errors": 0}
+        self.letter_sections = [] # Section headings of the feedback template, so letters pass the checks
+
+    def admit(self):
+        # Raises the error the real API would return for this request, if any
+        from google.api_core import exceptions
+
+        settings = self.settings
+        with self.lock:
+            self.stats["requests"] += 1
+            now = time.monotonic()
+            if settings.server_rpm:
+                self.recent_requests = [t for t in self.recent_requests if now - t < 60]
+                if len(self.recent_requests) >= settings.server_rpm:
+                    self.stats["rate_limited"] += 1
+                    retry_in = 60 - (now - self.recent_requests[0])
+                    raise exceptions.ResourceExhausted(f"Quota exceeded (simulated). Please retry in {retry_in:.1f}s.")
+                self.recent_requests.append(now)
+            roll = self.random.random()
+            if roll < settings.rate_limit_rate:
+                self.stats["rate_limited"] += 1
+                raise exceptions.ResourceExhausted("Resource has been exhausted (simulated). Please retry in 1s.")
+            if roll < settings.rate_limit_rate + settings.error_rate:
+                self.stats["errors"] += 1
+                raise exceptions.ServiceUnavailable("The model is overloaded (simulated).")
+            jitter = self.random.uniform(-settings.latency_jitter, settings.latency_jitter)
+        return max(0.0, settings.latency * (1 + jitter))
+
+
+server = None
+
+
+def install(settings):
+    # Replaces the Gemini client in google.generativeai with the simulated backend
+    global server
+    import google.generativeai as genai
+
+    server = FakeServer(settings)
+    genai.configure = lambda **kwargs: None
+    genai.GenerativeModel = FakeGenerativeModel
+    return server
+
+
+def _letter(identifier, length):
+    text = "This is simulated feedback. " * (length // 28 + 1)
+    sections = server.letter_sections
+    if sections:
+        # The same length, shared between the template's sections
+        body = "\n\n".join(f"**{name}:**\n*   {text[:length // len(sections)]}" for name in sections)
+    else:
+        body = text[:length]
+    return f"Dear {identifier},\n\n{body}\n\nBest,\nYour instructor"
+
+
+def _prompt_text(contents):
+    if isinstance(contents, str):
+        return contents
+    return json.dumps(contents, default=str)
+
+
+class FakeResponse:
+
+    def __init__(self, text, prompt_chars):
+        self.text = text
+        self.parts = [types.SimpleNamespace(text=text)] if text else []
+        self.prompt_feedback = types.SimpleNamespace(block_reason=None, safety_ratings=[])
+        prompt_tokens = max(1, prompt_chars // 4)
+        output_tokens = len(text) // 4
+        self.usage_metadata = types.SimpleNamespace(
+            prompt_token_count=prompt_tokens, candidates_token_count=output_tokens,
+            cached_content_token_count=0, total_token_count=prompt_tokens + output_tokens)
+
+
+class FakeStreamedResponse:
+    # Iterating yields chunks; usage/prompt_feedback are available like on the real object
+
+    def __init__(self, text, prompt_chars, seconds, chunk_chars):
+        self.full = FakeResponse(text, prompt_chars)
+        self.usage_metadata = self.full.usage_metadata
+        self.prompt_feedback = self.full.prompt_feedback
+        self.chunks = [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)] or [""]
+        self.seconds = seconds
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            time.sleep(self.seconds / len(self.chunks))
+            yield types.SimpleNamespace(parts=[types.SimpleNamespace(text=chunk)] if chunk else [])
+
+
+class FakeGenerativeModel:
+
+    def __init__(self, model_name, **kwargs):
+        self.model_name = model_name
+
+    def generate_content(self, contents, generation_config=None, stream=False, **kwargs):
+        seconds = server.admit()
+        prompt_chars = len(_prompt_text(contents))
+        length = server.settings.output_chars
+        schema = generation_config.get("response_schema") if isinstance(generation_config, dict) else None
+        if schema:
+            # Packed request: one letter per student identifier
+            text = json.dumps({identifier: _letter(identifier, length) for identifier in schema["properties"]})
+        else:
+            text = _letter("{student_identifier}", length)
+        if stream:
+            # The first chunk arrives after a fifth of the latency, the rest streams in
+            first = seconds / 5
+            time.sleep(first)
+            return FakeStreamedResponse(text, prompt_chars, seconds - first, server.settings.stream_chunk_chars)
+        time.sleep(seconds)
+        return FakeResponse(text, prompt_chars)
+
+    def count_tokens(self, contents):
+        return types.SimpleNamespace(total_tokens=max(1, len(_prompt_text(contents)) // 4))
@@ -0,0 +1,3 @@
+# Helper modules used by generate_feedback.py.
+# The script itself holds the assignment-specific configuration (prompt, template, folders);
+# everything in this package is generic plumbing around the Gemini API and the input files.
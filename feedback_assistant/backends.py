@@ -0,0 +1,86 @@
+import json
+import types
+
+from feedback_assistant.prefix_cache import NoPrefixCache
+from feedback_assistant.rate_limiter import estimate_tokens
+
+# --- Model Backends ---
+# Every generation request goes through a backend, so the script doesn't care which model
+# (or whether any real model) answers. A backend has:
+#   model_name  - used in cache keys, reports and log messages
+#   pricing     - a tokens.Pricing for budget checks and cost estimates
+#   cacheable   - whether its answers may be stored in the response cache
+#   generate(student_part, **options) - returns a response shaped like google.generativeai's
+#                 GenerateContentResponse (.parts/.text, .prompt_feedback, .usage_metadata;
+#                 with stream=True, iterating it yields chunks)
+#   close()
+# Two are provided:
+#   GeminiBackend - a Gemini model through google.generativeai, optionally with a prefix cache
+#   LocalBackend  - answers instantly with placeholder letters; needs no API key
+
+
+class GeminiBackend:
+    name = "gemini"
+    cacheable = True
+
+    def __init__(self, model_name, template, pricing, prefix_cache=None, client=None):
+        if client is None:
+            import google.generativeai as genai
+            client = genai.GenerativeModel(model_name)
+        self.model_name = model_name
+        self.template = template
+        self.pricing = pricing
+        self.prefix_cache = prefix_cache or NoPrefixCache()
+        self.client = client
+
+    def generate(self, student_part, **options):
+        # Full prompt, or only the student part if the prefix is cached
+        return self.prefix_cache.model(self.client).generate_content(
+            self.prefix_cache.contents(self.template, student_part), **options)
+
+    def close(self):
+        self.prefix_cache.close()
+
+
+class LocalBackend:
+    # Placeholder letters (JSON for packed requests) without calling any API. Useful for trying
+    # out the pipeline; its letters are never cached or counted as finished feedback.
+    name = "local"
+    cacheable = False
+
+    def __init__(self, model_name, template, pricing):
+        self.model_name = model_name
+        self.template = template
+        self.pricing = pricing
+
+    def generate(self, student_part, generation_config=None, stream=False, **options):
+        prompt_tokens = self.template.prefix_tokens + estimate_tokens(student_part)
+        schema = generation_config.get("response_schema") if isinstance(generation_config, dict) else None
+        if schema:
+            text = json.dumps({identifier: self._letter(identifier, prompt_tokens) for identifier in schema["properties"]})
+        else:
+            text = self._letter("{student_identifier}", prompt_tokens)
+        return LocalResponse(text, prompt_tokens)
+
+    def _letter(self, identifier, prompt_tokens):
+        return (f"Dear {identifier},\n\n[Placeholder feedback from the local backend ({self.model_name}); "
+                f"the prompt was ~{prompt_tokens} tokens.]")
+
+    def close(self):
+        pass
+
+
+class LocalResponse:
+
+    def __init__(self, text, prompt_tokens):
+        self.text = text
+        self.parts = [types.SimpleNamespace(text=text)]
+        self.prompt_feedback = types.SimpleNamespace(block_reason=None, safety_ratings=[])
+        output_tokens = estimate_tokens(text)
+        self.usage_metadata = types.SimpleNamespace(
+            prompt_token_count=prompt_tokens, candidates_token_count=output_tokens,
+            cached_content_token_count=0, total_token_count=prompt_tokens + output_tokens)
+
+    def __iter__(self):
+        # Streamed: the whole letter arrives as one chunk
+        yield self
@@ -0,0 +1,209 @@
+import dataclasses
+import json
+import os
+import threading
+import time
+import uuid
+
+# --- Offline Batch Jobs ---
+# Instead of one generate_content call per paper, every prompt is written to a JSONL file
+# and submitted as a single batch job. Batch jobs trade latency (minutes to hours) for
+# higher throughput and lower cost, which suits end-of-term grading.
+#
+# Request file format (one line per paper, as expected by the Gemini Batch API):
+#   {"key": "<paper filename>", "request": {"contents": [...], "generation_config": {...}}}
+# Result files use the same keys:
+#   {"key": "...", "response": {<GenerateContentResponse as JSON>}}  or  {"key": "...", "error": {...}}
+#
+# A backend needs four methods: submit(), state(), results() and name. Two are provided:
+#   GeminiBatchBackend - the Gemini Batch API (REST, via the requests package)
+#   LocalBatchBackend  - runs "jobs" in a background thread without calling any API;
+#                        useful for trying out batch mode and testing the fan-out.
+
+# Job states reported by state()
+PENDING = "pending"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+FINISHED_STATES = (SUCCEEDED, FAILED)
+
+
+def generation_config_as_dict(generation_config):
+    if generation_config is None:
+        return None
+    if dataclasses.is_dataclass(generation_config):
+        generation_config = dataclasses.asdict(generation_config)
+    return {name: value for name, value in dict(generation_config).items() if value is not None}
+
+
+def write_request_file(path, requests, generation_config=None):
+    # requests: iterable of (key, prompt text). Returns the number of lines written.
+    config = generation_config_as_dict(generation_config)
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for key, prompt in requests:
+            request = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+            if config:
+                request["generation_config"] = config
+            f.write(json.dumps({"key": key, "request": request}) + "\n")
+            count += 1
+    return count
+
+
+def parse_response(response):
+    # Pulls the useful fields out of a GenerateContentResponse in JSON form.
+    # Returns (feedback_text, block_reason, safety_ratings); block_reason is None unless blocked.
+    texts = []
+    for candidate in response.get("candidates") or []:
+        for part in (candidate.get("content") or {}).get("parts") or []:
+            if part.get("text"):
+                texts.append(part["text"])
+        break  # Only the first candidate, like response.parts
+    prompt_feedback = response.get("promptFeedback") or response.get("prompt_feedback") or {}
+    block_reason = prompt_feedback.get("blockReason") or prompt_feedback.get("block_reason")
+    safety_ratings = prompt_feedback.get("safetyRatings") or prompt_feedback.get("safety_ratings") or []
+    return "".join(texts).strip(), block_reason, safety_ratings
+
+
+class BatchRequestError(Exception):
+    # A per-request error from a batch result file. `code` lets retry.classify_error() classify it.
+
+    def __init__(self, error):
+        message = error.get("message") if isinstance(error, dict) else str(error)
+        super().__init__(message or str(error))
+        self.code = error.get("code") if isinstance(error, dict) else None
+
+
+class GeminiBatchBackend:
+    name = "gemini"
+    API_ROOT = "https://generativelanguage.googleapis.com"
+
+    def __init__(self, api_key, timeout=120):
+        import requests  # Only needed for batch mode
+
+        self.session = requests.Session()
+        self.session.headers["x-goog-api-key"] = api_key
+        self.timeout = timeout
+
+    def _check(self, response):
+        if response.status_code >= 400:
+            raise RuntimeError(f"Gemini Batch API error {response.status_code}: {response.text[:500]}")
+        return response
+
+    def _upload(self, path, display_name):
+        # Files API resumable upload: start the session, then send the bytes and finalize
+        size = os.path.getsize(path)
+        start = self._check(self.session.post(
+            f"{self.API_ROOT}/upload/v1beta/files",
+            headers={
+                "X-Goog-Upload-Protocol": "resumable",
+                "X-Goog-Upload-Command": "start",
+                "X-Goog-Upload-Header-Content-Length": str(size),
+                "X-Goog-Upload-Header-Content-Type": "application/jsonl",
+            },
+            json={"file": {"display_name": display_name}},
+            timeout=self.timeout,
+        ))
+        upload_url = start.headers["X-Goog-Upload-URL"]
+        with open(path, "rb") as f:
+            finished = self._check(self.session.post(
+                upload_url,
+                headers={"X-Goog-Upload-Offset": "0", "X-Goog-Upload-Command": "upload, finalize"},
+                data=f,
+                timeout=self.timeout,
+            ))
+        return finished.json()["file"]["name"]
+
+    def submit(self, requests_path, model_name, display_name):
+        file_name = self._upload(requests_path, display_name)
+        model_path = model_name if model_name.startswith("models/") else f"models/{model_name}"
+        response = self._check(self.session.post(
+            f"{self.API_ROOT}/v1beta/{model_path}:batchGenerateContent",
+            json={"batch": {"display_name": display_name, "input_config": {"file_name": file_name}}},
+            timeout=self.timeout,
+        ))
+        return response.json()["name"]  # "batches/..."
+
+    def _get(self, job_name):
+        return self._check(self.session.get(f"{self.API_ROOT}/v1beta/{job_name}", timeout=self.timeout)).json()
+
+    def state(self, job_name):
+        job = self._get(job_name)
+        # e.g. "JOB_STATE_RUNNING" / "BATCH_STATE_SUCCEEDED"
+        state = (job.get("metadata") or {}).get("state", "")
+        if state.endswith("SUCCEEDED"):
+            return SUCCEEDED
+        if state.endswith(("FAILED", "CANCELLED", "EXPIRED")):
+            return FAILED
+        if state.endswith("RUNNING"):
+            return RUNNING
+        return PENDING
+
+    def results(self, job_name):
+        # Yields (key, response dict or None, error or None) for every request in the job
+        job = self._get(job_name)
+        output = job.get("response") or (job.get("metadata") or {}).get("output") or {}
+        for inlined in (output.get("inlinedResponses") or {}).get("inlinedResponses", []):
+            yield (inlined.get("metadata") or {}).get("key"), inlined.get("response"), inlined.get("error")
+        responses_file = output.get("responsesFile")
+        if responses_file:
+            download = self._check(self.session.get(
+                f"{self.API_ROOT}/download/v1beta/{responses_file}:download",
+                params={"alt": "media"},
+                stream=True,
+                timeout=self.timeout,
+            ))
+            for line in download.iter_lines(decode_unicode=True):
+                if line:
+                    result = json.loads(line)
+                    yield result.get("key"), result.get("response"), result.get("error") or result.get("status")
+
+
+class LocalBatchBackend:
+    # A stand-in backend that needs no API key: each "job" is processed in a background thread
+    # and every request gets a placeholder response (or, if `generate` is given, whatever
+    # generate(prompt) returns). Results are written next to the request file.
+    name = "local"
+
+    def __init__(self, generate=None, seconds_per_request=0.0):
+        self.generate = generate
+        self.seconds_per_request = seconds_per_request
+        self._jobs = {}
+
+    def submit(self, requests_path, model_name, display_name):
+        job_name = f"local-batches/{uuid.uuid4().hex[:12]}"
+        results_path = os.path.splitext(requests_path)[0] + ".results.jsonl"
+        job = {"state": PENDING, "results_path": results_path}
+        self._jobs[job_name] = job
+        thread = threading.Thread(target=self._run, args=(job, requests_path, model_name), daemon=True)
+        thread.start()
+        return job_name
+
+    def _run(self, job, requests_path, model_name):
+        job["state"] = RUNNING
+        try:
+            with open(requests_path, "r", encoding="utf-8") as requests_file, \
+                    open(job["results_path"], "w", encoding="utf-8") as results_file:
+                for line in requests_file:
+                    request_line = json.loads(line)
+                    prompt = request_line["request"]["contents"][0]["parts"][0]["text"]
+                    if self.generate:
+                        text = self.generate(prompt)
+                    else:
+                        text = f"[Local batch backend placeholder feedback from {model_name}; prompt was {len(prompt)} characters.]"
+                    time.sleep(self.seconds_per_request)
+                    response = {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]}
+                    results_file.write(json.dumps({"key": request_line["key"], "response": response}) + "\n")
+            job["state"] = SUCCEEDED
+        except Exception as job_error:
+            job["error"] = str(job_error)
+            job["state"] = FAILED
+
+    def state(self, job_name):
+        return self._jobs[job_name]["state"]
+
+    def results(self, job_name):
+        with open(self._jobs[job_name]["results_path"], "r", encoding="utf-8") as f:
+            for line in f:
+                result = json.loads(line)
+                yield result["key"], result.get("response"), result.get("error")
@@ -0,0 +1,122 @@
+import collections
+import functools
+import hashlib
+import os
+import re
+import time
+import zipfile
+
+# --- Canvas Submissions ---
+# Canvas names the files in an assignment's bulk download (submissions.zip)
+#   username_userid_submissionid_OriginalName.ext
+#   username_LATE_userid_submissionid_OriginalName.ext     (submitted after the due date)
+# and adds "-1", "-2"... to OriginalName when a student uploads a file again for a later
+# attempt (Essay.docx, then Essay-1.docx). parse_submission_name() splits a name into those
+# parts, and latest_attempts() keeps only each student's most recent attempt, so superseded
+# drafts aren't sent to the API.
+#
+# A name can end in "-<digits>" on its own (Project-1.docx, Essay-2024.docx), so the suffix
+# only counts as Canvas's re-upload counter when it is a small number and the student has
+# another file with the same name without it (or with another counter). Otherwise the
+# submission id decides which file is newer.
+#
+# SubmissionArchive reads submissions straight out of the ZIP: members are listed from the
+# archive's directory and decompressed in memory when they are hashed or extracted, so the
+# archive never has to be unpacked into the papers folder.
+
+_CANVAS_NAME = re.compile(r"(?P<username>[^_]+)_(?:(?P<late>LATE)_)?(?P<user_id>\d+)_(?P<submission_id>\d+)_(?P<original_name>.+)")
+_UPLOAD_COUNTER = re.compile(r"-(?P<counter>[1-9]\d{0,2})$")
+
+
+def parse_submission_name(filename):
+    # -> {"username", "user_id", "submission_id", "late", "original_name", "upload_counter",
+    # "base_name"}, or None if the name doesn't follow the Canvas convention. upload_counter is
+    # the "-N" at the end of the original name (None without one) and base_name the original
+    # name without it; whether it really is a re-upload counter is up to latest_attempts().
+    match = _CANVAS_NAME.fullmatch(os.path.basename(filename))
+    if not match:
+        return None
+    stem, extension = os.path.splitext(match["original_name"])
+    counter = _UPLOAD_COUNTER.search(stem)
+    return {"username": match["username"], "user_id": match["user_id"], "submission_id": int(match["submission_id"]),
+            "late": bool(match["late"]), "original_name": match["original_name"],
+            "upload_counter": int(counter["counter"]) if counter else None,
+            "base_name": stem[:counter.start()] + extension if counter else match["original_name"]}
+
+
+def latest_attempts(filenames):
+    # Keeps each student's latest attempt: their files with the highest attempt number (then
+    # submission id). Several files from that one attempt are all kept; names that don't
+    # follow the Canvas convention are always kept.
+    # Returns (kept filenames in their original order, {superseded filename: a file that replaces it}).
+    parsed = {filename: parse_submission_name(filename) for filename in filenames}
+    parsed = {filename: submission for filename, submission in parsed.items() if submission is not None}
+    versions = collections.Counter() # (username, user id, base name) -> files with that name
+    for submission in parsed.values():
+        versions[(submission["username"], submission["user_id"], submission["base_name"])] += 1
+    latest = {} # (username, user id) -> (attempt, submission id, a file from that attempt)
+    keys = {}
+    for filename, submission in parsed.items():
+        student = (submission["username"], submission["user_id"])
+        reuploaded = submission["upload_counter"] is not None and versions[(*student, submission["base_name"])] > 1
+        keys[filename] = (submission["upload_counter"] if reuploaded else 0, submission["submission_id"])
+        current = latest.get(student)
+        if current is None or keys[filename] > current[:2]:
+            latest[student] = (*keys[filename], filename)
+    kept, superseded = [], {}
+    for filename in filenames:
+        submission = parsed.get(filename)
+        if submission is not None:
+            attempt, submission_id, newest = latest[(submission["username"], submission["user_id"])]
+            if keys[filename] != (attempt, submission_id):
+                superseded[filename] = newest
+                continue
+        kept.append(filename)
+    return kept, superseded
+
+
+class SubmissionArchive:
+    # The papers in a Canvas ZIP, by file name (Canvas archives are flat; members in
+    # sub-folders are listed by their base name, and system files are left out).
+
+    def __init__(self, path):
+        self.path = path
+        self.members = {} # file name -> ZipInfo
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                name = os.path.basename(info.filename)
+                if info.is_dir() or not name or name.startswith(".") or info.filename.startswith("__MACOSX/"):
+                    continue
+                self.members[name] = info
+
+    def names(self):
+        return list(self.members)
+
+    def info(self, filename):
+        # -> (size, mtime in ns, CRC-32), all from the archive's directory
+        info = self.members[filename]
+        mtime = time.mktime(info.date_time + (0, 0, -1))
+        return info.file_size, int(mtime * 1_000_000_000), info.CRC
+
+    def sha256(self, filename, chunk_size=1024 * 1024):
+        digest = hashlib.sha256()
+        with open_archive(self.path, os.stat(self.path).st_mtime_ns).open(self.members[filename]) as member:
+            for chunk in iter(lambda: member.read(chunk_size), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def member_name(self, filename):
+        # The member's full name inside the archive (for extraction.extract_member)
+        return self.members[filename].filename
+
+
+@functools.lru_cache(maxsize=2)
+def open_archive(path, mtime_ns):
+    # One open ZipFile per archive per (extraction worker) process; the central directory of a
+    # large archive is only parsed once
+    return zipfile.ZipFile(path)
+
+
+def read_member(path, member_name):
+    # The member's bytes, decompressed in memory
+    return open_archive(path, os.stat(path).st_mtime_ns).read(member_name)
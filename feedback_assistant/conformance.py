@@ -0,0 +1,180 @@
+import re
+
+from feedback_assistant.prompt_template import PromptTemplate
+
+# --- Checking Letters Against the Feedback Template ---
+# The Feedback Template is a series of bold section headings ("**Use of Evidence & Examples:**")
+# with "[AI: ...]" instructions under each. LetterTemplate reads that structure once and then
+# checks every generated letter against it:
+#   - required sections that are missing (headings containing "Optional" may be left out)
+#   - "[AI: ...]" instructions left in a section instead of feedback
+#   - sections with hardly any text, and letters that are too short/long or have no salutation
+# Problems in a section can be repaired without regenerating the letter: render_repair() asks
+# for just those sections again (with their instructions from the template), and repair()
+# splices the rewritten sections into the letter in template order.
+#
+# Headings are matched by their text, so "## Use of Evidence & Examples" or a heading with
+# text after it on the same line still counts. The last section ends where the closing begins
+# (the template's closing sentence or a sign-off such as "Best regards,").
+
+PLACEHOLDER = "[AI:"
+_HEADING_LINE = re.compile(r"\*\*(?P<name>[^*]+?):?\*\*")
+_SIGN_OFF = re.compile(r"(best|kind|warm)?\s*(regards|wishes)\b|sincerely\b|best,|thank you again\b", re.IGNORECASE)
+
+REPAIR_PROMPT = """
+**Rewrite Part of an Existing Letter:**
+A feedback letter for this paper has already been written (below), but some of its sections don't follow the Feedback Template. Do NOT write the whole letter again. Rewrite only these sections:
+
+{section_instructions}
+
+Start each rewritten section with its heading exactly as in the Feedback Template (for example **{example_heading}:**), replace every [AI: ...] instruction with real feedback on this paper, and keep the tone of the rest of the letter. Respond with the rewritten sections only.
+
+**The Letter So Far:**
+{letter}
+"""
+
+_repair_template = PromptTemplate("", REPAIR_PROMPT, fields=("section_instructions", "example_heading", "letter"))
+
+
+class LetterTemplate:
+
+    def __init__(self, template, min_chars=0, max_chars=None, min_section_chars=0):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.min_section_chars = min_section_chars
+        self.sections = [] # (name, required, instruction lines), in template order
+        self.closing_start = None
+        lines = template.strip().splitlines()
+        headings = self._headings(lines, [])
+        for index, (line_number, name) in enumerate(headings):
+            end = headings[index + 1][0] if index + 1 < len(headings) else self._closing(lines, line_number)
+            instructions = [line.strip() for line in lines[line_number + 1:end] if line.strip()]
+            self.sections.append((name, "optional" not in name.lower(), instructions))
+        closing_line = self._closing(lines, headings[-1][0]) if headings else len(lines)
+        closing = lines[closing_line] if closing_line < len(lines) else ""
+        self.closing_start = " ".join(closing.split()[:3]).lower()
+        self._patterns = {name: re.compile(rf"[#\s]*\**\s*{re.escape(name)}\s*(?::\s*\**|\*\*:?|$)", re.IGNORECASE)
+                          for name, _, _ in self.sections}
+
+    def _headings(self, lines, names):
+        # -> [(line number, section name)] of the heading lines, in order. With names, the
+        # lines that start with one of those headings; otherwise the template's own headings.
+        found = []
+        for line_number, line in enumerate(lines):
+            if names:
+                for name in names:
+                    if self._patterns[name].match(line):
+                        found.append((line_number, name))
+                        break
+            else:
+                match = _HEADING_LINE.fullmatch(line.strip())
+                if match:
+                    found.append((line_number, match["name"].strip()))
+        return found
+
+    def _closing(self, lines, last_heading):
+        # Line number where the closing starts: the first paragraph after the last section's
+        # content that opens like the template's closing, or with a sign-off. (In the template
+        # itself, the first paragraph after the last section that isn't a bullet.)
+        seen_content = False
+        for line_number in range(last_heading + 1, len(lines)):
+            line = lines[line_number].strip()
+            if not line:
+                continue
+            starts_paragraph = not lines[line_number - 1].strip()
+            is_bullet = line[0] in "*-•" or line[0].isdigit()
+            if seen_content and starts_paragraph and not is_bullet and (
+                    self.closing_start is None or line.lower().startswith(self.closing_start) or _SIGN_OFF.match(line)):
+                return line_number
+            seen_content = True
+        return len(lines)
+
+    def parse(self, letter):
+        # -> {section name: (first line, end line)} of the sections found in letter
+        lines = letter.splitlines()
+        headings = self._headings(lines, [name for name, _, _ in self.sections])
+        found = {}
+        for index, (line_number, name) in enumerate(headings):
+            end = headings[index + 1][0] if index + 1 < len(headings) else self._closing(lines, line_number)
+            found.setdefault(name, (line_number, end))
+        return found
+
+    def check(self, letter):
+        # -> [(section name, problem)] for every problem found; the name is None for problems
+        # with the letter as a whole (which a section repair can't fix)
+        problems = []
+        lines = letter.splitlines()
+        found = self.parse(letter)
+        in_sections = set()
+        for name, required, _ in self.sections:
+            if name not in found:
+                if required:
+                    problems.append((name, "missing"))
+                continue
+            start, end = found[name]
+            in_sections.update(range(start, end))
+            heading_rest = self._patterns[name].sub("", lines[start], count=1)
+            body = "\n".join([heading_rest] + lines[start + 1:end]).strip()
+            if PLACEHOLDER in body:
+                problems.append((name, "template instructions left in"))
+            elif len(body) < self.min_section_chars:
+                problems.append((name, f"only {len(body)} characters"))
+        if any(PLACEHOLDER in line for number, line in enumerate(lines) if number not in in_sections):
+            problems.append((None, "template instructions left in the letter"))
+        if len(letter) < self.min_chars:
+            problems.append((None, f"only {len(letter)} characters"))
+        if self.max_chars and len(letter) > self.max_chars:
+            problems.append((None, f"{len(letter)} characters (limit {self.max_chars})"))
+        if "Dear" not in letter[:300]:
+            problems.append((None, "no salutation"))
+        return problems
+
+    def render_repair(self, letter, names):
+        # The student part of a request for only the named sections (goes after the shared
+        # prefix and the paper, see generate_feedback.py)
+        instructions = []
+        for name, _, section_instructions in self.sections:
+            if name in names:
+                instructions.append("\n".join([f"**{name}:**"] + section_instructions))
+        return _repair_template.render_student_part(
+            section_instructions="\n\n".join(instructions), example_heading=names[0], letter=letter)
+
+    def repair(self, letter, rewritten, names):
+        # Puts the sections in `rewritten` (an answer to render_repair) into the letter: in place
+        # of the letter's version, or, for a missing section, after the sections that come
+        # before it in the template. Returns the new letter.
+        new_lines = rewritten.strip().splitlines()
+        new_sections = {}
+        headings = self._headings(new_lines, list(names))
+        for index, (line_number, name) in enumerate(headings):
+            end = headings[index + 1][0] if index + 1 < len(headings) else len(new_lines)
+            section = new_lines[line_number:end]
+            while section and not section[-1].strip():
+                section.pop()
+            new_sections.setdefault(name, section)
+
+        lines = letter.splitlines()
+        for position, (name, _, _) in reversed(list(enumerate(self.sections))):
+            if name not in new_sections:
+                continue
+            found = self.parse("\n".join(lines))
+            if name in found:
+                start, end = found[name]
+                while end > start + 1 and not lines[end - 1].strip():
+                    end -= 1 # Keep the blank line before the next section
+                lines[start:end] = new_sections[name]
+                continue
+            # Missing: after the nearest earlier section in the letter, else before the nearest later one
+            earlier = [found[other][1] for other, _, _ in self.sections[:position] if other in found]
+            later = [found[other][0] for other, _, _ in self.sections[position + 1:] if other in found]
+            if earlier:
+                insert_at = earlier[-1]
+                while insert_at > 0 and not lines[insert_at - 1].strip():
+                    insert_at -= 1
+                lines[insert_at:insert_at] = [""] + new_sections[name]
+            elif later:
+                lines[later[0]:later[0]] = new_sections[name] + [""]
+            else:
+                insert_at = self._closing(lines, 0) if lines else 0
+                lines[insert_at:insert_at] = new_sections[name] + [""]
+        return "\n".join(lines)
@@ -0,0 +1,249 @@
+import contextlib
+import io
+import mmap
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from feedback_assistant.canvas import read_member
+
+# --- Text Extraction from Student Papers ---
+# Runs in worker processes (see generate_feedback.py), so everything here is a plain
+# top-level function that returns picklable data. Nothing is printed from the worker:
+# messages are collected and printed by the main process next to the paper they belong to.
+#
+# extract_text() returns a dict:
+#   status   - "ok", "unsupported", "failed" (expected problems: empty, encrypted, unreadable PDF)
+#              or "exception" (anything unexpected, reported in an _ERROR_File_Processing.txt file)
+#   text     - the extracted text, paragraphs/pages separated by a blank line
+#   messages - lines to print for this paper
+#   warnings - the subset of messages worth repeating when the text is reused from a cache
+#              (failed pages, encryption, empty files, text cut off at a limit)
+#   error    - the exception text when status is "exception"
+#   cacheable - False when the outcome depends on this machine rather than the file
+#               (e.g. a broken PyPDF2 install), so it must not be cached
+#   pages    - PDFs only: one {"page", "seconds", "chars"} entry per page extracted, plus
+#              "error" for pages that failed
+#
+# extract_member() does the same for a paper inside a ZIP archive (see feedback_assistant.canvas),
+# reading it into memory instead of from a file.
+#
+# Extractors are looked up by file extension in EXTRACTORS (at the end of this file). Each is a
+# top-level function called as extractor(source, filename, result, limits) that fills in result;
+# source is a path or a binary file object. To support another file type, add one there.
+
+# Bump this whenever the extraction logic changes, so cached text from older versions
+# (see feedback_assistant.text_cache) is no longer used.
+EXTRACTOR_VERSION = 2
+
+
+class ExtractionLimits:
+    # Picklable, so it can be passed to the extraction worker processes.
+
+    def __init__(self, max_chars=None, max_pages=None, page_workers=1, parallel_min_pages=40, pages_per_task=10):
+        self.max_chars = max_chars                      # Stop after this much text (None = no limit)
+        self.max_pages = max_pages                      # Only read the first max_pages pages of a PDF
+        self.page_workers = page_workers                # Processes that share one large PDF (1 = serial)
+        self.parallel_min_pages = parallel_min_pages    # Smaller PDFs are always read serially
+        self.pages_per_task = pages_per_task            # Pages handed to a page worker at a time
+
+
+def extractor_version(limits):
+    # Text cache version for extractions with these limits: the caps change the text, the
+    # number of workers doesn't
+    return f"{EXTRACTOR_VERSION}:pages={limits.max_pages}:chars={limits.max_chars}"
+
+
+def extract_text(filepath, limits=None):
+    return _extract(filepath, os.path.basename(filepath), limits)
+
+
+def extract_member(archive_path, member_name, limits=None):
+    # member_name is the member's full name in the archive
+    filename = os.path.basename(member_name)
+    if not EXTRACTORS.get(os.path.splitext(filename)[1].lower()):
+        return _extract(None, filename, limits) # Not worth decompressing
+    try:
+        data = read_member(archive_path, member_name)
+    except Exception as member_error:
+        return {"status": "exception", "text": "", "messages": [], "warnings": [], "error": str(member_error), "cacheable": False}
+    return _extract(io.BytesIO(data), filename, limits)
+
+
+def _extract(source, filename, limits):
+    limits = limits or ExtractionLimits()
+    result = {"status": "ok", "text": "", "messages": [], "warnings": [], "error": None, "cacheable": True}
+    extractor = EXTRACTORS.get(os.path.splitext(filename)[1].lower())
+    try:
+        if extractor:
+            extractor(source, filename, result, limits)
+        else:
+            result["status"] = "unsupported"
+            result["messages"].append(f"  Skipping unsupported file type: {filename}")
+        if limits.max_chars and len(result["text"]) > limits.max_chars:
+            result["text"] = result["text"][:limits.max_chars]
+            _warn(result, f"  Warning: Text cut off after {limits.max_chars} characters (extraction limit).")
+    except Exception as file_proc_error:
+        result["status"] = "exception"
+        result["error"] = str(file_proc_error)
+    return result
+
+
+def _warn(result, message):
+    result["messages"].append(message)
+    result["warnings"].append(message)
+
+
+def _extract_docx(source, filename, result, limits):
+    from docx import Document  # For reading .docx
+
+    result["messages"].append("  Reading DOCX file...")
+    doc = Document(source)
+    paragraphs = [para.text for para in doc.paragraphs if para.text.strip()]
+    result["text"] = "\n\n".join(paragraphs) # Use double newline for better paragraph separation
+    if not result["text"]:
+        _warn(result, f"  Warning: No text extracted from DOCX file or file is empty.")
+        result["status"] = "failed"
+
+
+# --- PDF Engine ---
+# The file is memory-mapped rather than read into memory, so the page workers of a large PDF
+# share the operating system's copy of it instead of each loading their own. Pages are read in
+# order and their text is collected only until the character or page limit is reached; the
+# rest of the document is never parsed.
+#
+# PDFs with at least parallel_min_pages pages (e.g. portfolios) are split into page ranges
+# that a small pool of processes extracts in parallel. Only a couple of ranges per worker are
+# in flight at once, so text beyond the limit is hardly ever extracted and never all held in
+# memory. Every page's extraction time is recorded in result["pages"].
+# A PDF read from an archive is already in memory and always read one page at a time.
+
+def _extract_pdf(source, filename, result, limits):
+    messages = result["messages"]
+    filepath = source if isinstance(source, str) else None
+    messages.append("  Reading PDF file...")
+    text_list = []
+    try:
+        import PyPDF2  # For reading .pdf
+
+        if (os.path.getsize(filepath) if filepath else source.getbuffer().nbytes) == 0: # Nothing to map
+            _warn(result, f"  Warning: Skipping empty PDF file: {filename}")
+            result["status"] = "failed"
+            return
+        with contextlib.ExitStack() as stack:
+            pdf_data = source
+            if filepath:
+                pdf_file = stack.enter_context(open(filepath, 'rb'))
+                pdf_data = stack.enter_context(mmap.mmap(pdf_file.fileno(), 0, access=mmap.ACCESS_READ))
+            reader = PyPDF2.PdfReader(pdf_data)
+            # Check for encryption
+            if reader.is_encrypted:
+                try:
+                    # Try decrypting with empty password (common case)
+                    if reader.decrypt('') == PyPDF2.PasswordType.NOT_DECRYPTED:
+                        _warn(result, f"  Warning: Skipping password-protected PDF: {filename}")
+                        result["status"] = "failed"
+                        return
+                except Exception as decrypt_err:
+                    _warn(result, f"  Warning: Skipping encrypted PDF (decryption failed): {filename} - {decrypt_err}")
+                    result["status"] = "failed"
+                    return
+
+            num_pages = len(reader.pages)
+            if limits.max_pages and num_pages > limits.max_pages:
+                _warn(result, f"  Warning: Only reading the first {limits.max_pages} of {num_pages} pages (extraction limit).")
+                num_pages = limits.max_pages
+            if filepath and limits.page_workers > 1 and num_pages >= limits.parallel_min_pages:
+                messages.append(f"  Extracting {num_pages} pages with {limits.page_workers} processes...")
+                pages = _parallel_page_texts(filepath, num_pages, limits)
+            else:
+                pages = _page_texts(reader, range(num_pages))
+
+            chars = 0
+            for page_number, text, seconds, page_error in pages:
+                page_info = {"page": page_number + 1, "seconds": round(seconds, 4), "chars": len(text)}
+                result.setdefault("pages", []).append(page_info)
+                if page_error:
+                    page_info["error"] = page_error
+                    _warn(result, f"    Warning: Error extracting text from PDF page {page_number + 1}: {page_error}")
+                elif text:
+                    text_list.append(text)
+                    chars += len(text) + 2
+                if limits.max_chars and chars > limits.max_chars and page_number + 1 < num_pages:
+                    pages.close() # Stops the page workers
+                    _warn(result, f"  Warning: Stopped reading at page {page_number + 1} of {num_pages}: "
+                                  f"reached {limits.max_chars} characters (extraction limit).")
+                    break
+        result["text"] = "\n\n".join(text_list).strip() # Join pages with double newline
+        if limits.max_chars:
+            result["text"] = result["text"][:limits.max_chars]
+        if not result["text"]:
+            _warn(result, f"  Warning: No text extracted from PDF (check if image-based or complex).")
+            result["status"] = "failed"
+        slowest = max(result.get("pages", []), key=lambda page: page["seconds"], default=None)
+        if slowest and len(result["pages"]) >= limits.parallel_min_pages:
+            messages.append(f"  Read {len(result['pages'])} pages ({sum(page['seconds'] for page in result['pages']):.1f}s "
+                            f"in total, slowest: page {slowest['page']} at {slowest['seconds']:.2f}s).")
+    except ImportError as ie:
+        messages.append(f"  Error: PyPDF2 dependency possibly missing or corrupt: {ie}")
+        messages.append(f"  Try: pip install --upgrade PyPDF2")
+        result["status"] = "failed"
+        result["cacheable"] = False
+    except Exception as pdf_err:
+        _warn(result, f"  Error reading PDF file structure {filename}: {pdf_err}")
+        result["status"] = "failed"
+
+
+def _page_texts(reader, page_numbers):
+    # Yields (page number, text, seconds, error or None) for each page, in order
+    for page_number in page_numbers:
+        started = time.perf_counter()
+        try:
+            text, page_error = (reader.pages[page_number].extract_text() or "").strip(), None
+        except Exception as error:
+            text, page_error = "", str(error)
+        yield page_number, text, time.perf_counter() - started, page_error
+
+
+def _extract_page_range(filepath, first, last):
+    # Runs in a page worker: maps the PDF and extracts pages first..last-1
+    import PyPDF2
+
+    with open(filepath, 'rb') as pdf_file, mmap.mmap(pdf_file.fileno(), 0, access=mmap.ACCESS_READ) as pdf_data:
+        reader = PyPDF2.PdfReader(pdf_data)
+        if reader.is_encrypted:
+            reader.decrypt('') # The main worker already checked the empty password works
+        return list(_page_texts(reader, range(first, last)))
+
+
+def _parallel_page_texts(filepath, num_pages, limits):
+    # Same as _page_texts, with page ranges extracted by a pool of processes
+    ranges = iter([(first, min(first + limits.pages_per_task, num_pages))
+                   for first in range(0, num_pages, limits.pages_per_task)])
+    in_flight = deque() # (future, first, last), in page order
+    with ProcessPoolExecutor(max_workers=limits.page_workers) as pool:
+        try:
+            while True:
+                while len(in_flight) < limits.page_workers * 2:
+                    page_range = next(ranges, None)
+                    if page_range is None:
+                        break
+                    in_flight.append((pool.submit(_extract_page_range, filepath, *page_range), *page_range))
+                if not in_flight:
+                    break
+                future, first, last = in_flight.popleft()
+                try:
+                    page_results = future.result()
+                except Exception as range_error:
+                    # e.g. the worker died; the rest of the document is still worth reading
+                    page_results = [(page_number, "", 0.0, str(range_error)) for page_number in range(first, last)]
+                yield from page_results
+        finally:
+            for future, _, _ in in_flight:
+                future.cancel()
+
+
+EXTRACTORS = {".docx": _extract_docx, ".pdf": _extract_pdf}
+SUPPORTED_EXTENSIONS = tuple(EXTRACTORS)
+
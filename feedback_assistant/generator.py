@@ -0,0 +1,118 @@
+import os
+import tempfile
+
+from feedback_assistant.extraction import extract_text
+from feedback_assistant.rate_limiter import estimate_tokens
+from feedback_assistant.tokens import usage_from_response
+
+# --- Embedding API ---
+# The steps generate_feedback.py runs for each paper (extraction, prompt rendering,
+# generation, writing the letter), for programs that want feedback one paper at a time, such as
+# a grading service. A FeedbackGenerator holds on to its backend, so the API client and any
+# cached prompt prefix stay warm across calls.
+#
+# Importing this module is cheap. docx/PyPDF2 are imported by the extraction of the file type at
+# hand, and google.generativeai when a GeminiBackend is created.
+#
+#   from feedback_assistant.backends import GeminiBackend
+#   from feedback_assistant.generator import FeedbackGenerator
+#   generator = FeedbackGenerator(GeminiBackend(model_name, template, pricing), template)
+#   result = generator.feedback_for("papers/jdoe_1234_5678_Essay.docx", output_folder="feedback")
+
+DEFAULT_IDENTIFIER = "Unknown_Student"
+
+
+def identifier_from_filename(filename):
+    # Canvas names submission downloads username_userid_submissionid_OriginalName.ext; the
+    # username (everything before the first underscore) identifies the student.
+    # Returns None if the name has nothing usable.
+    base_name = os.path.splitext(os.path.basename(filename))[0]
+    return base_name.split("_", 1)[0].strip() or base_name.strip() or None
+
+
+def response_text(response):
+    # The letter in a (complete) response: its text parts joined, or "" if there are none
+    if response.parts:
+        return "".join(part.text for part in response.parts).strip()
+    # Sometimes .text works even if .parts is empty
+    return response.text.strip()
+
+
+def write_output(path, text):
+    # Letters and error reports are written to a temporary file and renamed into place, so
+    # nobody reading the output folder (or another worker sharing it) sees half a file
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+class FeedbackGenerator:
+    # retry_policy (retry.RetryPolicy) and rate_limiter (rate_limiter.RateLimiter) are optional;
+    # share one rate limiter between generators that use the same API key. log receives the
+    # retry messages.
+
+    def __init__(self, backend, template, generation_config=None, retry_policy=None, rate_limiter=None,
+                 expected_output_tokens=1000, extraction_limits=None, log=print):
+        self.backend = backend
+        self.template = template
+        self.generation_config = generation_config
+        self.retry_policy = retry_policy
+        self.rate_limiter = rate_limiter
+        self.expected_output_tokens = expected_output_tokens
+        self.extraction_limits = extraction_limits
+        self.log = log
+
+    def extract(self, path):
+        # -> extraction dict (see feedback_assistant.extraction); status "ok" if there is text
+        return extract_text(path, self.extraction_limits)
+
+    def render(self, **fields):
+        # The per-student part of the prompt; the backend adds the shared prefix
+        return self.template.render_student_part(**fields)
+
+    def generate(self, student_part, student_identifier=None):
+        # -> (letter, usage). Returns "" as the letter if the response was blocked or empty;
+        # API errors are raised (after retries, with a retry policy).
+        estimated_tokens = self.template.prefix_tokens + estimate_tokens(student_part) + self.expected_output_tokens
+
+        def call_api():
+            if self.rate_limiter:
+                self.rate_limiter.acquire(estimated_tokens)
+            return self.backend.generate(student_part, generation_config=self.generation_config)
+
+        response = self.retry_policy.call(call_api, self.log) if self.retry_policy else call_api()
+        usage = usage_from_response(response)
+        if self.rate_limiter:
+            self.rate_limiter.record_usage(estimated_tokens, usage["total_tokens"])
+        letter = response_text(response)
+        if student_identifier:
+            # The model occasionally copies the template's "Dear {student_identifier}," verbatim
+            letter = letter.replace("{student_identifier}", student_identifier)
+        return letter, usage
+
+    def feedback_for(self, path, output_folder=None):
+        # Runs every step for one paper. Returns a dict with student_identifier, status (the
+        # extraction status, or "empty" for a blocked/empty response), feedback, usage, messages
+        # and output_path (set when the letter was written to output_folder).
+        identifier = identifier_from_filename(path) or DEFAULT_IDENTIFIER
+        extraction = self.extract(path)
+        result = {"student_identifier": identifier, "status": extraction["status"], "feedback": "", "usage": None,
+                  "messages": extraction["messages"], "output_path": None}
+        if extraction["status"] != "ok":
+            return result
+        student_part = self.render(student_identifier=identifier, paper_text=extraction["text"])
+        result["feedback"], result["usage"] = self.generate(student_part, identifier)
+        if not result["feedback"]:
+            result["status"] = "empty"
+        elif output_folder:
+            result["output_path"] = os.path.join(output_folder, f"{identifier}_feedback.txt")
+            write_output(result["output_path"], result["feedback"])
+        return result
+
+    def close(self):
+        self.backend.close()
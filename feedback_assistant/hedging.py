@@ -0,0 +1,261 @@
+import collections
+import contextlib
+import queue
+import threading
+import time
+
+from feedback_assistant.metrics import percentile
+
+# --- Deadlines & Hedged Requests ---
+# A request that hangs would otherwise hold its worker (and, with one worker, the whole run)
+# forever, and a few very slow generations decide when a batch finishes. Hedger runs each
+# request in a thread and waits for it with two clocks:
+#   deadline - once the request has been running for deadline_seconds it is abandoned and
+#              RequestDeadlineExceeded (a TimeoutError, so retry.py retries it) is raised
+#   hedge    - once it has been running longer than the model's recent p95 latency (see
+#              LatencyStats), a duplicate request is sent and whichever answers first wins
+# Hedging is capped: at most max_hedge_fraction of all requests get a duplicate, and each
+# duplicate must be allowed by start_hedge() (budget and rate-limit checks in the caller).
+# Only a request that may get a duplicate runs in its own thread; any other request runs in
+# the caller's thread, and the API client's own timeout (the same deadline) ends it.
+# The answer that loses the race is still billed; once both have finished, finish_hedge()
+# is given any unused successful answer so its cost can be accounted for.
+#
+# An abandoned request can't be cancelled from here; pass the same deadline to the API client
+# (Gemini's request_options timeout) so its thread doesn't live on for long. Until it ends it
+# still counts against max_in_flight, the number of requests allowed to be open at once
+# (duplicates need a free place too), so retries and the next papers wait for it. If it still
+# answers after the deadline, that answer is billed too: it is logged as late and discarded,
+# and handed to finish_hedge() like a losing duplicate (with no token if nothing was hedged).
+
+
+class RequestDeadlineExceeded(TimeoutError):
+    pass
+
+
+class LatencyStats:
+    # Recent latencies of successful requests, per model. Thread-safe.
+
+    def __init__(self, window=200, min_samples=20):
+        self.window = window
+        self.min_samples = min_samples
+        self.samples = {} # model name -> deque of seconds
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    def record(self, model_name, seconds):
+        with self.lock:
+            self.samples.setdefault(model_name, collections.deque(maxlen=self.window)).append(seconds)
+            self.counts[model_name] += 1
+
+    def percentile(self, model_name, pct):
+        # The pct-th percentile of the model's recent latencies, or None before min_samples
+        with self.lock:
+            samples = sorted(self.samples.get(model_name, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return percentile(samples, pct)
+
+    def summary(self):
+        with self.lock:
+            models = {model_name: sorted(samples) for model_name, samples in self.samples.items()}
+        return {model_name: {"count": self.counts[model_name], "window": len(samples),
+                             "p50_s": round(percentile(samples, 50), 3), "p95_s": round(percentile(samples, 95), 3)}
+                for model_name, samples in models.items() if samples}
+
+
+class Hedger:
+    # Shared by all API workers.
+
+    def __init__(self, stats, deadline_seconds=None, hedge=False, hedge_percentile=95, min_hedge_delay=5.0,
+                 max_hedge_fraction=0.1, max_in_flight=None):
+        self.stats = stats
+        self.deadline_seconds = deadline_seconds
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.max_hedge_fraction = max_hedge_fraction
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0 # Requests open now, including abandoned ones that haven't ended
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.deadline_misses = 0
+        self.late_answers = 0
+        self.extra_cost = 0.0
+        self.lock = threading.Lock()
+        self.slot_freed = threading.Condition(self.lock)
+
+    def acquire_slot(self, blocking=True):
+        # Counts a request against max_in_flight. Waits for a free place, or returns False
+        # if there is none and blocking is False.
+        with self.slot_freed:
+            while self.max_in_flight and self.in_flight >= self.max_in_flight:
+                if not blocking:
+                    return False
+                self.slot_freed.wait()
+            self.in_flight += 1
+            return True
+
+    def release_slot(self):
+        with self.slot_freed:
+            self.in_flight -= 1
+            self.slot_freed.notify()
+
+    @contextlib.contextmanager
+    def slot(self):
+        # For requests sent without call() (e.g. streamed ones)
+        self.acquire_slot()
+        try:
+            yield
+        finally:
+            self.release_slot()
+
+    def hedge_delay(self, model_name):
+        # Seconds after which a request to this model gets a duplicate, or None (not enough
+        # samples yet, or the deadline would come first)
+        if not self.hedge:
+            return None
+        latency = self.stats.percentile(model_name, self.hedge_percentile)
+        if latency is None:
+            return None
+        delay = max(self.min_hedge_delay, latency)
+        if self.deadline_seconds and delay >= self.deadline_seconds:
+            return None
+        return delay
+
+    def call(self, model_name, request, start_hedge=None, finish_hedge=None, log=print):
+        # Returns request()'s response (from the original or the duplicate request).
+        #   start_hedge()                  - a token (e.g. a budget reservation) if a duplicate may be
+        #                                    sent now, else None; without it, nothing is hedged
+        #   finish_hedge(token, responses) - called once both requests have finished, with the
+        #                                    successful responses that weren't used; returns their cost.
+        #                                    Also called (token None) for late answers to a request
+        #                                    abandoned at its deadline that had no duplicate
+        with self.lock:
+            self.requests += 1
+        delay = self.hedge_delay(model_name) if start_hedge else None
+        if delay is None:
+            # Nothing to race it against: the API client's timeout enforces the deadline
+            with self.slot():
+                started = time.perf_counter()
+                try:
+                    response = request()
+                except Exception:
+                    if self.deadline_seconds and time.perf_counter() - started >= self.deadline_seconds:
+                        with self.lock:
+                            self.deadline_misses += 1
+                        self.stats.record(model_name, self.deadline_seconds)
+                    raise
+            self.stats.record(model_name, time.perf_counter() - started)
+            return response
+
+        results = queue.Queue()
+        state = {"started": 0, "finished": 0, "winner": None, "abandoned": False, "unused": [], "hedge_token": None}
+        state_lock = threading.Lock()
+
+        def attempt(index):
+            # Holds its place in max_in_flight (taken before launch) until the request ends
+            started = time.perf_counter()
+            try:
+                response, error = request(), None
+            except Exception as e:
+                response, error = None, e
+            finally:
+                self.release_slot()
+            if error is None:
+                self.stats.record(model_name, time.perf_counter() - started)
+            with state_lock:
+                state["finished"] += 1
+                if error is None:
+                    if state["winner"] is None and not state["abandoned"]:
+                        state["winner"] = index
+                    else:
+                        state["unused"].append(response)
+                results.put((index, response, error)) # Under the lock, so the first winner is read first
+                done = state["finished"] == state["started"]
+                abandoned = state["abandoned"]
+                hedge_token = state["hedge_token"]
+                unused = list(state["unused"])
+            if error is None and abandoned:
+                log(f"  A request to {model_name} answered after its deadline (late, discarded; still billed).")
+            if done and (hedge_token is not None or (abandoned and unused)):
+                cost = finish_hedge(hedge_token, unused) if finish_hedge else None
+                with self.lock:
+                    self.extra_cost += cost or 0.0
+                    if abandoned:
+                        self.late_answers += len(unused)
+
+        def launch(index):
+            threading.Thread(target=attempt, args=(index,), name=f"request-{model_name}-{index}", daemon=True).start()
+
+        self.acquire_slot() # Before the clocks start: waiting for a place isn't the request's fault
+        now = time.monotonic()
+        hedge_at = now + delay if delay is not None else None
+        deadline_at = now + self.deadline_seconds if self.deadline_seconds else None
+        state["started"] = 1
+        launch(0)
+        pending, first_error = 1, None
+        while True:
+            wake_at = min([t for t in (hedge_at, deadline_at) if t is not None], default=None)
+            try:
+                index, response, error = results.get(timeout=None if wake_at is None else max(0.0, wake_at - time.monotonic()))
+            except queue.Empty:
+                if hedge_at is not None and time.monotonic() >= hedge_at:
+                    hedge_at = None
+                    if self._start_hedge(state, state_lock, start_hedge, finish_hedge):
+                        log(f"  No answer after {delay:.1f}s (p{self.hedge_percentile} for {model_name}); "
+                            "sending a duplicate request...")
+                        launch(1)
+                        pending += 1
+                    continue
+                with state_lock:
+                    if state["winner"] is None:
+                        state["abandoned"] = True
+                if not state["abandoned"]:
+                    continue # An answer came in just now and is waiting in the queue
+                with self.lock:
+                    self.deadline_misses += 1
+                # Counted at the deadline, so a model that keeps timing out raises its own p95
+                self.stats.record(model_name, self.deadline_seconds)
+                raise RequestDeadlineExceeded(f"No answer from {model_name} within {self.deadline_seconds}s")
+            pending -= 1
+            if error is None:
+                if index == 1:
+                    with self.lock:
+                        self.hedge_wins += 1
+                    log("  The duplicate request answered first.")
+                return response
+            if first_error is None:
+                first_error = error
+            if pending == 0:
+                raise first_error
+
+    def _start_hedge(self, state, state_lock, start_hedge, finish_hedge):
+        with self.lock:
+            if self.hedged + 1 > self.max_hedge_fraction * self.requests:
+                return False
+        if not self.acquire_slot(blocking=False):
+            return False
+        token = start_hedge()
+        if token is None:
+            self.release_slot()
+            return False
+        with state_lock:
+            if state["finished"]:
+                # The answer (or error) came in meanwhile and is waiting in the queue
+                self.release_slot()
+                if finish_hedge:
+                    finish_hedge(token, [])
+                return False
+            state["hedge_token"] = token
+            state["started"] += 1
+        with self.lock:
+            self.hedged += 1
+        return True
+
+    def summary(self):
+        with self.lock:
+            return {"requests": self.requests, "hedged": self.hedged, "hedge_wins": self.hedge_wins,
+                    "deadline_misses": self.deadline_misses, "late_answers": self.late_answers,
+                    "extra_cost_usd": round(self.extra_cost, 6)}
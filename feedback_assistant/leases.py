@@ -0,0 +1,208 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+# --- Lease Files ---
+# Lets several workers (processes on one machine, or on several machines sharing the folders
+# over NFS) split one papers folder. Before a worker touches a paper it claims a lease on it:
+# a small JSON file in the lease folder, created with link(2), which is atomic even over NFS.
+# If the link fails, another worker holds the lease.
+#
+# A worker renews its leases (touches their mtime) while it works. A lease that hasn't been
+# renewed for ttl_seconds belongs to a crashed worker and is taken over. Take-overs rename the
+# old file to a unique name first, so only one worker can win. Machines' clocks need to be
+# roughly in sync (NTP).
+#
+# A lease (e.g. on a student) can cover several pieces of work (e.g. the student's files). The
+# lease keeps a record of each one finished under it (file, content hash, prompt version,
+# outcome), carried over whenever the lease changes hands. Releasing the last piece doesn't
+# remove the file: it becomes a "done" record, so another worker that reaches the same work
+# later sees it is finished even if it hasn't seen the other worker's manifest.
+
+LEASE_SUFFIX = ".lease"
+
+
+class LeaseManager:
+
+    def __init__(self, folder, worker_id, ttl_seconds=600):
+        self.folder = folder
+        self.worker_id = worker_id
+        self.ttl_seconds = ttl_seconds
+        self.held = {} # key -> {"record": lease record (with this claim's unique token), "active": {work: details}}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        os.makedirs(folder, exist_ok=True)
+        self.heartbeat = threading.Thread(target=self._renew_leases, daemon=True)
+        self.heartbeat.start()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + LEASE_SUFFIX)
+
+    def claim(self, key, details, finished=None):
+        # details identifies the work (e.g. file, sha256, prompt_version); details["file"] names
+        # it among the work under the same key.
+        # Returns "claimed", "busy" (another worker holds the lease) or "done" (exactly this work
+        # was finished, by any worker, with an outcome in `finished`).
+        work = details.get("file", key)
+        with self.lock:
+            held = self.held.get(key)
+            if held is not None:
+                # This worker already holds the lease (for other work under the same key)
+                if _is_finished(held["record"]["finished"].get(work), details, finished):
+                    return "done"
+                held["active"][work] = details
+                return "claimed"
+        path = self._path(key)
+        record = {"worker": self.worker_id, "host": socket.gethostname(), "pid": os.getpid(),
+                  "token": uuid.uuid4().hex, "claimed_at": time.time(), "finished": {}}
+        for _ in range(3):
+            if self._create(path, record):
+                with self.lock:
+                    self.held[key] = {"record": record, "active": {work: details}}
+                return "claimed"
+            current = self._read(path)
+            if current is None:
+                continue # Released or taken over just now
+            previous = _finished_work(current)
+            if _is_finished(previous.get(work), details, finished):
+                return "done"
+            if not current.get("done") and not self._expired(path):
+                return "busy"
+            # Finished other work (or this work with other content/settings), or abandoned by a
+            # crashed worker; what was finished under it stays on record
+            if not self._take_over(path, current):
+                return "busy"
+            record["finished"] = {**previous, **record["finished"]}
+        return "busy"
+
+    def release(self, key, work, **outcome):
+        # Records `work` as finished with `outcome`. Once nothing else under the key is in
+        # progress, the lease is replaced by a done record.
+        with self.lock:
+            held = self.held.get(key)
+            if held is None:
+                return
+            record = held["record"]
+            record["finished"][work] = {**held["active"].pop(work, {}), **outcome}
+            last = not held["active"]
+            if last:
+                del self.held[key]
+            record = dict(record, finished=dict(record["finished"]))
+        if not self._owns(key, record):
+            return
+        if last:
+            self._write(self._path(key), _done_record(record))
+        else:
+            self._write(self._path(key), record) # Still held; keeps the finished work on record
+
+    def close(self):
+        # Gives up leases that were never released (e.g. the run was interrupted). Work already
+        # finished under them stays on record.
+        self.stopped.set()
+        with self.lock:
+            held, self.held = self.held, {}
+        for key, lease in held.items():
+            record = lease["record"]
+            if not self._owns(key, record):
+                continue
+            if record["finished"]:
+                self._write(self._path(key), _done_record(record))
+                continue
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _create(self, path, record):
+        # The lease appears complete or not at all: written to a private file, then linked into place
+        temp_path = f"{path}.{record['token']}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(record, f)
+        try:
+            os.link(temp_path, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(temp_path)
+
+    def _write(self, path, record):
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(record, f)
+        os.replace(temp_path, path)
+
+    def _read(self, path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _expired(self, path):
+        try:
+            return time.time() - os.stat(path).st_mtime > self.ttl_seconds
+        except FileNotFoundError:
+            return True
+
+    def _take_over(self, path, seen):
+        # Moves the lease we looked at out of the way. If a different lease was moved (another
+        # worker got there first), it is put back and the take-over fails.
+        stale_path = f"{path}.{uuid.uuid4().hex}.stale"
+        try:
+            os.rename(path, stale_path)
+        except FileNotFoundError:
+            return False
+        taken = self._read(stale_path) == seen
+        if not taken:
+            try:
+                os.link(stale_path, path)
+            except FileExistsError:
+                pass
+        os.remove(stale_path)
+        return taken
+
+    def _owns(self, key, record):
+        current = self._read(self._path(key))
+        return bool(current) and current.get("token") == record["token"]
+
+    def _renew_leases(self):
+        while not self.stopped.wait(self.ttl_seconds / 4):
+            with self.lock:
+                held = [(key, lease["record"]) for key, lease in self.held.items()]
+            for key, record in held:
+                if self._owns(key, record):
+                    try:
+                        os.utime(self._path(key))
+                        continue
+                    except OSError as renew_error:
+                        # e.g. removed or taken over between the check and the touch
+                        print(f"  Warning: Could not renew the lease '{key}' ({renew_error}); giving it up.")
+                # Taken over (this worker looked dead); the other worker has it now
+                with self.lock:
+                    if key in self.held and self.held[key]["record"]["token"] == record["token"]:
+                        del self.held[key]
+
+
+def _finished_work(record):
+    # {work: details and outcome} of a lease record (done records written before leases could
+    # cover several pieces of work hold one file's details at the top level)
+    if "finished" in record:
+        return record["finished"]
+    if record.get("done") and "file" in record:
+        return {record["file"]: record}
+    return {}
+
+
+def _is_finished(entry, details, finished):
+    return bool(entry) and entry.get("outcome") in (finished or ()) and all(
+        entry.get(name) == value for name, value in details.items())
+
+
+def _done_record(record):
+    done = {name: value for name, value in record.items() if name != "token"}
+    done.update(done=True, released_at=time.time())
+    return done
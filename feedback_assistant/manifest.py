@@ -0,0 +1,127 @@
+import glob
+import hashlib
+import json
+import os
+import time
+
+# --- Run Manifest ---
+# A journal kept in the output folder that remembers, for every input file, what it looked
+# like (size, mtime, SHA-256 of its contents), which prompt version it was processed with,
+# and how that went. On the next run only new or changed files, files processed with a
+# different prompt, and files that previously failed are sent to the API again.
+#
+# The journal is append-only JSON lines, so a crash part-way through a run loses nothing:
+# the last line for a file wins. It is compacted (one line per file) at the end of each run.
+#
+# With several workers (--worker), each appends to its own journal next to the main one
+# (.run_manifest.<worker>.jsonl), since appends from several machines to one file over NFS
+# can interleave. Every journal is read at start-up; the most recent entry for a file wins.
+
+MANIFEST_FILENAME = ".run_manifest.jsonl"
+
+# Outcomes that don't need another attempt unless the file or prompt changes.
+# "failed" (API or extraction errors) is always retried on the next run.
+FINISHED_OUTCOMES = {"success", "blocked", "skipped"}
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def prompt_version(*parts):
+    # Short fingerprint of everything that shapes the feedback (prompt text, model, settings).
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(repr(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:12]
+
+
+def worker_journal_path(path, worker_id):
+    stem, extension = os.path.splitext(path)
+    return f"{stem}.{worker_id}{extension}"
+
+
+class RunManifest:
+
+    def __init__(self, path, worker_id=None):
+        self.path = worker_journal_path(path, worker_id) if worker_id else path
+        self.entries = {}
+        stem, extension = os.path.splitext(path)
+        for journal in [path] + sorted(glob.glob(glob.escape(stem) + ".*" + extension)):
+            self._load(journal)
+
+    def _load(self, path):
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            for line_number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Most likely a line cut short by a crash; everything else is still usable
+                    print(f"  Warning: Ignoring unreadable line {line_number} in '{path}'.")
+                    continue
+                previous = self.entries.get(entry["file"])
+                if previous is None or entry.get("recorded_at", "") >= previous.get("recorded_at", ""):
+                    self.entries[entry["file"]] = entry
+
+    def fingerprint(self, filename, path):
+        # Size + mtime + content hash. The file is only re-hashed when its size or mtime
+        # changed since the last run, so unchanged folders are checked almost instantly.
+        stat = os.stat(path)
+        previous = self.entries.get(filename)
+        if previous and previous.get("size") == stat.st_size and previous.get("mtime_ns") == stat.st_mtime_ns:
+            sha256 = previous["sha256"]
+        else:
+            sha256 = file_sha256(path)
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256}
+
+    def archive_fingerprint(self, filename, archive):
+        # The same for a paper in a canvas.SubmissionArchive. Size, mtime and CRC-32 come from the
+        # archive's directory; the member is only decompressed and hashed when one of them changed.
+        size, mtime_ns, crc32 = archive.info(filename)
+        previous = self.entries.get(filename)
+        if (previous and previous.get("size") == size and previous.get("mtime_ns") == mtime_ns
+                and previous.get("crc32") == crc32):
+            sha256 = previous["sha256"]
+        else:
+            sha256 = archive.sha256(filename)
+        return {"size": size, "mtime_ns": mtime_ns, "crc32": crc32, "sha256": sha256}
+
+    def is_up_to_date(self, filename, fingerprint, current_prompt_version):
+        previous = self.entries.get(filename)
+        return bool(
+            previous
+            and previous.get("sha256") == fingerprint["sha256"]
+            and previous.get("prompt_version") == current_prompt_version
+            and previous.get("outcome") in FINISHED_OUTCOMES
+        )
+
+    def record(self, filename, fingerprint, current_prompt_version, outcome, **details):
+        entry = {
+            "file": filename,
+            **fingerprint,
+            "prompt_version": current_prompt_version,
+            "outcome": outcome,
+            "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            **details,
+        }
+        self.entries[filename] = entry
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def compact(self):
+        # Rewrites the journal with only the latest entry per file (from all journals).
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for filename in sorted(self.entries):
+                f.write(json.dumps(self.entries[filename]) + "\n")
+        os.replace(temp_path, self.path)
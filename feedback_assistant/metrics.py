@@ -0,0 +1,130 @@
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# --- Run Metrics ---
+# Timing hooks around each stage of the per-paper flow (filename parsing, extraction, prompt
+# building, rate-limit waits, the API call, retries, saving). Every sample is a duration plus
+# optional byte and token counts; the report gives count, total and p50/p95/p99 per stage,
+# so a slow run shows where its time went.
+#
+# Extraction runs in worker processes, so it is measured there with measured_call(), which
+# can also profile the call (cProfile or tracemalloc) and returns everything as plain data.
+
+PROFILE_MODES = ("cprofile", "tracemalloc")
+
+
+def percentile(sorted_values, pct):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class StageMetrics:
+    # Thread-safe collector shared by all workers.
+
+    def __init__(self):
+        self.stages = {} # stage -> {"seconds": [...], "bytes": n, "tokens": n}
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+
+    def record(self, stage, seconds, bytes=0, tokens=0):
+        with self.lock:
+            samples = self.stages.setdefault(stage, {"seconds": [], "bytes": 0, "tokens": 0})
+            samples["seconds"].append(seconds)
+            samples["bytes"] += bytes or 0
+            samples["tokens"] += tokens or 0
+
+    @contextmanager
+    def timer(self, stage, **amounts):
+        # with metrics.timer("save") as sample: ... ; sample["bytes"] = n
+        # (the sample is recorded even if the block raises)
+        sample = dict(amounts)
+        started = time.perf_counter()
+        try:
+            yield sample
+        finally:
+            self.record(stage, time.perf_counter() - started, sample.get("bytes", 0), sample.get("tokens", 0))
+
+    def summary(self):
+        with self.lock:
+            stages = {stage: dict(samples, seconds=sorted(samples["seconds"])) for stage, samples in self.stages.items()}
+        report = {}
+        for stage, samples in stages.items():
+            seconds = samples["seconds"]
+            report[stage] = {
+                "count": len(seconds),
+                "total_s": round(sum(seconds), 4),
+                "mean_s": round(sum(seconds) / len(seconds), 4),
+                "p50_s": round(percentile(seconds, 50), 4),
+                "p95_s": round(percentile(seconds, 95), 4),
+                "p99_s": round(percentile(seconds, 99), 4),
+                "max_s": round(seconds[-1], 4),
+                "bytes": samples["bytes"],
+                "tokens": samples["tokens"],
+            }
+        return report
+
+    def write_report(self, path, **run_info):
+        report = dict(run_info)
+        report["wall_clock_s"] = round(time.monotonic() - self.started_at, 3)
+        report["stages"] = self.summary()
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        return report
+
+
+def measured_call(func, filepath, profile_mode=None, profile_path=None):
+    # Runs func(filepath) (in a worker process) and returns (result, measurement), where
+    # measurement has wall/CPU seconds and the file size, plus:
+    #   profile_mode "cprofile"    - stats dumped to profile_path (combine with combine_profiles())
+    #   profile_mode "tracemalloc" - peak traced memory and the top allocation sites
+    measurement = {"bytes": os.path.getsize(filepath) if os.path.exists(filepath) else 0}
+    profiler = None
+    if profile_mode == "cprofile":
+        import cProfile
+        profiler = cProfile.Profile()
+    elif profile_mode == "tracemalloc":
+        import tracemalloc
+        tracemalloc.start()
+
+    started, cpu_started = time.perf_counter(), time.process_time()
+    try:
+        if profiler:
+            result = profiler.runcall(func, filepath)
+        else:
+            result = func(filepath)
+    finally:
+        measurement["seconds"] = time.perf_counter() - started
+        measurement["cpu_seconds"] = time.process_time() - cpu_started
+        if profiler:
+            profiler.dump_stats(profile_path)
+        elif profile_mode == "tracemalloc":
+            measurement["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+            top = tracemalloc.take_snapshot().statistics("lineno")[:10]
+            measurement["top_allocations"] = [str(stat) for stat in top]
+            tracemalloc.stop()
+    return result, measurement
+
+
+def combine_profiles(profile_paths, output_path, text_path, top=40):
+    # Merges per-paper cProfile dumps into one .prof file plus a readable summary.
+    # The per-paper dumps are removed.
+    import pstats
+
+    profile_paths = [path for path in profile_paths if os.path.exists(path)]
+    if not profile_paths:
+        return False
+    stats = pstats.Stats(*profile_paths)
+    stats.dump_stats(output_path)
+    with open(text_path, "w", encoding="utf-8") as f:
+        stats.stream = f
+        stats.sort_stats("cumulative").print_stats(top)
+    for path in profile_paths:
+        os.remove(path)
+    return True
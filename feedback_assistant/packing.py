@@ -0,0 +1,116 @@
+import json
+
+from feedback_assistant.batch import generation_config_as_dict
+from feedback_assistant.prompt_template import PromptTemplate
+
+# --- Packing Several Papers into One Request ---
+# Short papers pay the full cost of the shared prompt prefix (assignment description, example
+# letter, template) for a few hundred tokens of their own. Packing sends several of them in one
+# request after a single copy of the prefix and asks for JSON output: one letter per student,
+# keyed by Student Identifier. The letters are then split back into the usual files.
+# Anything that can't be matched up cleanly is sent again as an ordinary single-paper request.
+
+PACK_HEADER = """
+**Multiple Papers in This Request:**
+This request contains {paper_count} separate student papers, each between "=== Paper N ===" and "=== End of Paper N ===" markers.
+Follow ALL of the instructions above for EACH paper separately: write one complete, independent feedback letter per paper, using the Feedback Template each time, and never mix up details from different papers.
+"""
+
+PACK_PAPER = """
+=== Paper {paper_number} ===
+**Student Identifier:** {student_identifier}
+
+**Student Paper Text:**
+{paper_text}
+=== End of Paper {paper_number} ===
+"""
+
+PACK_FOOTER = """
+**Output Format:**
+Respond with a single JSON object and nothing else. Use each Student Identifier exactly as given above as a key, and that student's complete feedback letter (a plain string) as the value.
+
+**Generate the feedback letters now, following all instructions carefully:**
+"""
+
+_header_template = PromptTemplate("", PACK_HEADER, fields=("paper_count",))
+_paper_template = PromptTemplate("", PACK_PAPER, fields=("paper_number", "student_identifier", "paper_text"))
+
+
+class Packer:
+    # Groups jobs into packs of at most max_papers papers and max_tokens student tokens.
+    # Jobs are dicts with at least "student_identifier"; identifiers must be unique in a pack
+    # because they are the JSON keys of the answer.
+
+    def __init__(self, max_papers, max_tokens):
+        self.max_papers = max_papers
+        self.max_tokens = max_tokens
+        self.jobs = []
+        self.tokens = 0
+
+    def add(self, job, tokens):
+        # Returns the packs (lists of jobs) that are ready to send after adding this job.
+        ready = []
+        if self.jobs and (self.tokens + tokens > self.max_tokens
+                          or job["student_identifier"] in {j["student_identifier"] for j in self.jobs}):
+            ready.append(self.flush())
+        self.jobs.append(job)
+        self.tokens += tokens
+        if len(self.jobs) >= self.max_papers:
+            ready.append(self.flush())
+        return ready
+
+    def flush(self):
+        pack, self.jobs, self.tokens = self.jobs, [], 0
+        return pack
+
+
+def render_pack(jobs):
+    # The per-request part of a packed prompt (goes after the shared prefix)
+    parts = [_header_template.render_student_part(paper_count=str(len(jobs)))]
+    for number, job in enumerate(jobs, start=1):
+        parts.append(_paper_template.render_student_part(
+            paper_number=str(number), student_identifier=job["student_identifier"], paper_text=job["paper_text"]))
+    parts.append(PACK_FOOTER)
+    return "".join(parts)
+
+
+def pack_generation_config(generation_config, identifiers):
+    # The run's generation settings plus JSON output with exactly one string per student
+    config = generation_config_as_dict(generation_config) or {}
+    config["response_mime_type"] = "application/json"
+    config["response_schema"] = {
+        "type": "object",
+        "properties": {identifier: {"type": "string"} for identifier in identifiers},
+        "required": list(identifiers),
+    }
+    return config
+
+
+def split_packed_response(text, identifiers):
+    # Returns ({identifier: letter}, [identifiers without a usable letter]).
+    # A response that isn't a JSON object leaves every identifier unmatched.
+    try:
+        data = json.loads(_strip_code_fence(text))
+    except ValueError:
+        return {}, list(identifiers)
+    if not isinstance(data, dict):
+        return {}, list(identifiers)
+    letters = {}
+    missing = []
+    for identifier in identifiers:
+        letter = data.get(identifier)
+        if isinstance(letter, str) and letter.strip():
+            letters[identifier] = letter.strip()
+        else:
+            missing.append(identifier)
+    return letters, missing
+
+
+def _strip_code_fence(text):
+    # Models sometimes wrap JSON in ```json ... ``` even when asked not to
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+        if text.rstrip().endswith("```"):
+            text = text.rstrip()[:-3]
+    return text
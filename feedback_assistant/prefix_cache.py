@@ -0,0 +1,68 @@
+import datetime
+import threading
+import time
+
+# --- Prompt Prefix Caching ---
+# Every request starts with the same multi-kilobyte prefix (see prompt_template.py).
+# A prefix cache decides what is actually sent for each paper:
+#   NoPrefixCache     - the full prompt every time (works with any model and key)
+#   GeminiPrefixCache - the prefix is uploaded once as Gemini "cached content"; each request
+#                       then only sends the student part, which cuts input tokens and latency.
+# Other implementations only need the same three methods: contents(), model() and close().
+
+
+class NoPrefixCache:
+    name = "none"
+
+    def contents(self, template, student_part):
+        return template.prefix + student_part
+
+    def model(self, default_model):
+        return default_model
+
+    def close(self):
+        pass
+
+
+class GeminiPrefixCache:
+    # Notes on Gemini context caching:
+    #   * it needs an explicit model version (e.g. 'gemini-2.0-flash-001') and a minimum prefix
+    #     size, so creation can fail - callers should fall back to NoPrefixCache;
+    #   * cached content expires after its TTL, so it is extended while the run is still busy.
+    name = "gemini"
+
+    def __init__(self, model_name, template, ttl_minutes=60, generation_config=None):
+        import google.generativeai as genai
+        from google.generativeai import caching
+
+        self.ttl = datetime.timedelta(minutes=ttl_minutes)
+        model_path = model_name if model_name.startswith("models/") else f"models/{model_name}"
+        self.cached_content = caching.CachedContent.create(
+            model=model_path,
+            display_name=f"feedback-prompt-{template.prefix_digest}",
+            contents=[template.prefix],
+            ttl=self.ttl,
+        )
+        self._model = genai.GenerativeModel.from_cached_content(
+            cached_content=self.cached_content, generation_config=generation_config
+        )
+        self._refreshed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def contents(self, template, student_part):
+        return student_part
+
+    def model(self, default_model):
+        # Push the expiry out again once half the TTL has passed
+        with self._lock:
+            if time.monotonic() - self._refreshed_at > self.ttl.total_seconds() / 2:
+                self.cached_content.update(ttl=self.ttl)
+                self._refreshed_at = time.monotonic()
+        return self._model
+
+    def close(self):
+        # Cached content is billed per hour of storage, so don't leave it behind
+        try:
+            self.cached_content.delete()
+        except Exception as delete_error:
+            print(f"  Warning: Could not delete cached prompt prefix {self.cached_content.name}: {delete_error}")
@@ -0,0 +1,57 @@
+import hashlib
+import re
+
+from feedback_assistant.rate_limiter import estimate_tokens
+
+# --- Compiled Prompt Template ---
+# The prompt is split into two parts:
+#   prefix       - identical for every paper (instructions, assignment context, example letter,
+#                  feedback template). Kept as one string and never copied or re-scanned, so it
+#                  can also be uploaded once as cached content (see prefix_cache.py).
+#   student part - the short per-paper part with {field} placeholders (identifier, paper text).
+#
+# The student part is compiled once into literal segments and field slots. Rendering is a
+# single join over those slots, so text inserted for one field is never searched for other
+# placeholders (a paper that happens to contain "{student_identifier}" is left alone).
+
+FIELD_PATTERN = re.compile(r"\{([A-Za-z_][A-Za-z0-9_]*)\}")
+
+
+class PromptTemplate:
+
+    def __init__(self, prefix, student_part, fields):
+        self.prefix = prefix
+        self.fields = tuple(fields)
+        # Identifies the prefix in cache keys and manifests without hashing it for every paper
+        self.prefix_digest = hashlib.sha256(prefix.encode("utf-8")).hexdigest()[:16]
+        self.prefix_tokens = estimate_tokens(prefix)
+        self._segments = self._compile(student_part)
+
+    def _compile(self, text):
+        # -> list of (is_field, value); only the declared fields are placeholders,
+        #    any other {braces} are kept as literal text.
+        segments = []
+        position = 0
+        for match in FIELD_PATTERN.finditer(text):
+            if match.group(1) not in self.fields:
+                continue
+            if match.start() > position:
+                segments.append((False, text[position:match.start()]))
+            segments.append((True, match.group(1)))
+            position = match.end()
+        if position < len(text):
+            segments.append((False, text[position:]))
+        missing = set(self.fields) - {value for is_field, value in segments if is_field}
+        if missing:
+            raise ValueError(f"Student prompt is missing placeholder(s): {', '.join(sorted(missing))}")
+        return segments
+
+    def render_student_part(self, **values):
+        try:
+            return "".join(values[value] if is_field else value for is_field, value in self._segments)
+        except KeyError as missing:
+            raise ValueError(f"No value given for prompt field {missing}") from None
+
+    def render(self, **values):
+        # The complete prompt, for requests that don't use a cached prefix
+        return self.prefix + self.render_student_part(**values)
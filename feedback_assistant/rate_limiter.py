@@ -0,0 +1,94 @@
+import threading
+import time
+
+# --- Rate Limiting for the Gemini API ---
+# Gemini quotas are expressed as requests-per-minute (RPM) and tokens-per-minute (TPM).
+# Instead of a fixed pause after every paper we keep one token bucket per quota and
+# block a worker only as long as needed for the bucket to refill.
+
+# Rough rule of thumb for Gemini models: ~4 characters of English text per token.
+# Only used to estimate a prompt's size before it is sent.
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+class TokenBucket:
+    # A bucket that holds at most `capacity` units and refills continuously at
+    # `per_minute` units per minute. A full minute's quota is the default capacity,
+    # so a fresh run can start a short burst and then settles to the steady rate.
+
+    def __init__(self, per_minute, capacity=None):
+        if per_minute <= 0:
+            raise ValueError("per_minute must be a positive number")
+        self.rate = per_minute / 60.0  # units per second
+        self.capacity = float(capacity if capacity is not None else per_minute)
+        self.available = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, amount=1):
+        # A single request bigger than the whole bucket would otherwise wait forever;
+        # let it through once the bucket is completely full.
+        amount = min(float(amount), self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+                wait_seconds = (amount - self.available) / self.rate
+            time.sleep(wait_seconds)
+
+    def try_acquire(self, amount=1):
+        # Like acquire(), but returns False instead of waiting
+        amount = min(float(amount), self.capacity)
+        with self.lock:
+            self._refill()
+            if self.available < amount:
+                return False
+            self.available -= amount
+            return True
+
+    def adjust(self, amount):
+        # Credit (negative amount) or debit (positive amount) the bucket after the fact,
+        # e.g. when the real token usage of a response differs from our estimate.
+        # The bucket may go negative, which simply delays the next acquire.
+        with self.lock:
+            self._refill()
+            self.available = min(self.capacity, self.available - amount)
+
+
+class RateLimiter:
+    # Combines the RPM and (optional) TPM buckets. Workers call acquire() before each
+    # API request and record_usage() once the response tells us how many tokens were used.
+
+    def __init__(self, requests_per_minute, tokens_per_minute=None):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def acquire(self, estimated_tokens=0):
+        self.requests.acquire(1)
+        if self.tokens and estimated_tokens:
+            self.tokens.acquire(estimated_tokens)
+
+    def try_acquire(self, estimated_tokens=0):
+        # For optional requests (a hedged duplicate): only if both limits have room right now
+        if not self.requests.try_acquire(1):
+            return False
+        if self.tokens and estimated_tokens and not self.tokens.try_acquire(estimated_tokens):
+            self.requests.adjust(-1) # Give the request slot back
+            return False
+        return True
+
+    def record_usage(self, estimated_tokens, actual_tokens):
+        if self.tokens and actual_tokens:
+            self.tokens.adjust(actual_tokens - estimated_tokens)
+
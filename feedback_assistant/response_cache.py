@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+# --- On-disk Cache for API Responses ---
+# Every successful response is stored under a hash of everything that determines it:
+# the model name, the generation settings and the fully rendered prompt (which already
+# contains the assignment description, example letter, template and paper text).
+# Re-running the script after a crash, or on an unchanged folder, then costs nothing for
+# papers that were already answered.
+#
+# Layout: <cache_folder>/<first 2 hex chars>/<sha256>.json  (sharded to keep folders small)
+# A file's mtime doubles as its "last used" time, which drives age/size eviction.
+
+CACHE_FORMAT_VERSION = 1
+
+
+def cache_key(model_name, prompt, generation_config=None):
+    payload = json.dumps(
+        {
+            "version": CACHE_FORMAT_VERSION,
+            "model": model_name,
+            "generation_config": generation_config,
+            "prompt": prompt,
+        },
+        sort_keys=True,
+        default=str,  # GenerationConfig objects etc. fall back to their repr
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+
+    def __init__(self, folder, max_age_days=30, max_size_mb=200):
+        self.folder = folder
+        self.max_age_seconds = max_age_days * 86400 if max_age_days else None
+        self.max_size_bytes = max_size_mb * 1024 * 1024 if max_size_mb else None
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.folder, key[:2], f"{key}.json")
+
+    def get(self, key):
+        # Returns the cached entry (a dict with at least "feedback_text") or None.
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self.max_age_seconds and time.time() - entry.get("created_at", 0) > self.max_age_seconds:
+            return None
+        try:
+            os.utime(path)  # Mark as recently used so size-based eviction keeps it
+        except OSError:
+            pass
+        return entry
+
+    def put(self, key, feedback_text, **extra):
+        entry = {"created_at": time.time(), "feedback_text": feedback_text, **extra}
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temp file first so concurrent readers never see a half-written entry
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def prune(self):
+        # Removes entries older than max_age_days, then the least recently used entries
+        # until the cache fits in max_size_mb. Returns the number of files removed.
+        entries = []
+        for root, _dirs, files in os.walk(self.folder):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        now = time.time()
+        removed = 0
+        kept = []
+        for mtime, size, path in entries:
+            # Stale temp files from an interrupted write, or expired entries
+            expired = self.max_age_seconds and now - mtime > self.max_age_seconds
+            if (path.endswith(".tmp") and now - mtime > 3600) or expired:
+                removed += _remove(path)
+            else:
+                kept.append((mtime, size, path))
+
+        if self.max_size_bytes:
+            total_size = sum(size for _, size, _ in kept)
+            for mtime, size, path in sorted(kept):  # oldest first
+                if total_size <= self.max_size_bytes:
+                    break
+                removed += _remove(path)
+                total_size -= size
+        return removed
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+        return 1
+    except OSError:
+        return 0
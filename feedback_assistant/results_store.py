@@ -0,0 +1,280 @@
+import glob
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from feedback_assistant.canvas import latest_attempts
+from feedback_assistant.generator import write_output
+
+# --- Results Store ---
+# By default every outcome becomes its own text file in the output folder: a letter, or an
+# _ERROR_ file. For a whole term, that makes thousands of small files, each written and
+# fsynced on its own. A results store keeps one row per paper instead:
+#   sqlite - a SQLite database in WAL mode, indexed by file, student and status
+#   jsonl  - an append-only JSON lines file (the last line for a file wins), for shared
+#            folders where SQLite's locking can't be trusted (NFS)
+# Rows are buffered and written in batches (every batch_size rows or flush_seconds), so the
+# API workers never wait on the disk for long. export_results() writes the usual per-student
+# files from the rows on demand.
+#
+# A row holds: file, student_identifier, status (see OUTPUT_FILES), feedback, block_reason,
+# safety_ratings, error, model, prompt_tokens, output_tokens, cached_tokens, cost_usd,
+# timings (a dict of seconds), prompt_version, recorded_at and output_name.
+#
+# Files are named after the student ({student_identifier}_feedback.txt). A student with more
+# than one paper in a run (several files in one attempt, or --all-attempts) gets files named
+# after each paper instead (e.g. jdoe_12345_67890_essay_docx_feedback.txt), so that one
+# paper's letter doesn't overwrite another's; see output_name(). Each row keeps the name the
+# run chose (output_name), so export_results() writes the same files the run would have.
+#
+# With several workers (--worker), each writes its own store next to the main one
+# (results.<worker>.sqlite3); read_results() merges them, the most recent row for a file winning.
+
+STORE_EXTENSIONS = {"sqlite": ".sqlite3", "jsonl": ".jsonl"}
+
+# The file each status is exported to, and its contents (the same files as without a store)
+OUTPUT_FILES = {
+    "success": ("{output_name}_feedback.txt", "{feedback}"),
+    "blocked": ("{output_name}_ERROR_FeedbackBlockedOrEmpty.txt",
+                "Feedback generation blocked or empty for {file} (Identifier: {student_identifier}).\n"
+                "Block Reason: {block_reason}\n"
+                "Safety Ratings: {safety_ratings}\n"),
+    "empty": ("{output_name}_ERROR_EmptyResponse.txt",
+              "API returned an empty response for {file} (Identifier: {student_identifier}).\n"),
+    "api_error": ("{output_name}_ERROR_API_Call_Failed.txt",
+                  "API call failed for {file} (Identifier: {student_identifier}).\n"
+                  "Error ({error_kind}): {error}\n"),
+    "file_error": ("{output_name}_ERROR_File_Processing.txt",
+                   "Unexpected error processing file {file} (Identifier: {student_identifier}) before API call.\n"
+                   "Error: {error}\n"),
+}
+
+COLUMNS = ("file", "student_identifier", "status", "feedback", "block_reason", "safety_ratings", "error",
+           "error_kind", "model", "prompt_tokens", "output_tokens", "cached_tokens", "cost_usd", "timings",
+           "prompt_version", "recorded_at", "output_name")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    file TEXT PRIMARY KEY,          -- latest result per paper
+    student_identifier TEXT NOT NULL,
+    status TEXT NOT NULL,
+    feedback TEXT,
+    block_reason TEXT,
+    safety_ratings TEXT,
+    error TEXT,
+    error_kind TEXT,
+    model TEXT,
+    prompt_tokens INTEGER,
+    output_tokens INTEGER,
+    cached_tokens INTEGER,
+    cost_usd REAL,
+    timings TEXT,                   -- JSON object of seconds
+    prompt_version TEXT,
+    recorded_at REAL NOT NULL,
+    output_name TEXT                -- what the paper's files are named after (see output_name())
+);
+CREATE INDEX IF NOT EXISTS results_by_student ON results (student_identifier);
+CREATE INDEX IF NOT EXISTS results_by_status ON results (status);
+"""
+
+
+def output_name(filename, student_identifier, per_paper=False):
+    # What a paper's output files are named after: the student, or with per_paper=True (the
+    # student has more than one paper) the paper's file name, starting with the student's
+    # identifier
+    if not per_paper:
+        return student_identifier
+    name = os.path.basename(filename).replace(".", "_")
+    return name if name.startswith(f"{student_identifier}_") else f"{student_identifier}_{name}"
+
+
+def output_file(row, per_paper=False):
+    # -> (file name, contents) of the file for a row: named after the row's output_name if it
+    # has one, else as output_name() names it
+    name, contents = OUTPUT_FILES[row["status"]]
+    fields = {column: row.get(column) for column in COLUMNS}
+    fields["output_name"] = fields["output_name"] or output_name(row["file"], row["student_identifier"], per_paper)
+    return name.format(**fields), contents.format(**fields)
+
+
+def store_path(folder, filename, kind):
+    return os.path.join(folder, filename + STORE_EXTENSIONS[kind])
+
+
+class ResultsStore:
+    # Buffers rows and writes them in batches. Safe to use from several threads.
+
+    def __init__(self, path, batch_size=50, flush_seconds=5):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.pending = {} # file -> row not written yet
+        self.flushed_at = time.monotonic()
+        self.lock = threading.Lock()
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+    def add(self, row):
+        row = {column: row.get(column) for column in COLUMNS}
+        if row["recorded_at"] is None:
+            row["recorded_at"] = time.time()
+        with self.lock:
+            self.pending[row["file"]] = row
+            if len(self.pending) >= self.batch_size or time.monotonic() - self.flushed_at >= self.flush_seconds:
+                self._flush()
+
+    def get(self, filename):
+        # The latest row for a paper in this store, or None
+        with self.lock:
+            row = self.pending.get(filename)
+            return dict(row) if row else self._get(filename)
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.pending:
+            self._write(list(self.pending.values()))
+            self.pending = {}
+        self.flushed_at = time.monotonic()
+
+
+class SQLiteResultsStore(ResultsStore):
+
+    def __init__(self, path, batch_size=50, flush_seconds=5):
+        super().__init__(path, batch_size, flush_seconds)
+        # Written from the API worker threads, always under self.lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL") # WAL stays consistent; a crash loses at most the last batch
+        self.connection.executescript(_SCHEMA)
+        if "output_name" not in {column[1] for column in self.connection.execute("PRAGMA table_info(results)")}:
+            # A store written before rows kept their output name
+            self.connection.execute("ALTER TABLE results ADD COLUMN output_name TEXT")
+        self.connection.commit()
+
+    def _write(self, rows):
+        with self.connection: # One transaction per batch
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO results VALUES ({', '.join('?' * len(COLUMNS))})",
+                [tuple(json.dumps(row[column]) if column == "timings" else row[column] for column in COLUMNS)
+                 for row in rows],
+            )
+
+    def _get(self, filename):
+        cursor = self.connection.execute("SELECT * FROM results WHERE file = ?", (filename,))
+        row = cursor.fetchone()
+        return _row_from_sqlite(cursor, row) if row else None
+
+    def rows(self):
+        with self.lock:
+            self._flush()
+            return _sqlite_rows(self.connection)
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+class JSONLResultsStore(ResultsStore):
+
+    def _write(self, rows):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(row) + "\n" for row in rows))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _get(self, filename):
+        # A scan of the whole file; only used for the occasional duplicate submission
+        latest = None
+        for row in _jsonl_rows(self.path):
+            if row["file"] == filename:
+                latest = row
+        return latest
+
+    def rows(self):
+        self.flush()
+        return _latest(_jsonl_rows(self.path))
+
+    def close(self):
+        self.flush()
+
+
+def open_results_store(kind, path, batch_size=50, flush_seconds=5):
+    store_class = SQLiteResultsStore if kind == "sqlite" else JSONLResultsStore
+    return store_class(path, batch_size, flush_seconds)
+
+
+def _row_from_sqlite(cursor, row):
+    row = dict(zip([column[0] for column in cursor.description], row))
+    row["timings"] = json.loads(row["timings"]) if row["timings"] else {}
+    return row
+
+
+def _sqlite_rows(connection):
+    cursor = connection.execute("SELECT * FROM results ORDER BY file")
+    return [_row_from_sqlite(cursor, row) for row in cursor.fetchall()]
+
+
+def _jsonl_rows(path):
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue # A line cut short by a crash
+
+
+def _latest(rows):
+    # The most recent row per file, sorted by file
+    latest = {}
+    for row in rows:
+        current = latest.get(row["file"])
+        if current is None or row["recorded_at"] >= current["recorded_at"]:
+            latest[row["file"]] = row
+    return [latest[filename] for filename in sorted(latest)]
+
+
+def read_results(path):
+    # Every paper's latest row, from the store at path and any per-worker stores next to it
+    stem, extension = os.path.splitext(path)
+    rows = []
+    for store in [path] + sorted(glob.glob(glob.escape(stem) + ".*" + extension)):
+        if not os.path.exists(store):
+            continue
+        if extension == STORE_EXTENSIONS["sqlite"]:
+            connection = sqlite3.connect(store)
+            try:
+                rows.extend(_sqlite_rows(connection))
+            finally:
+                connection.close()
+        else:
+            rows.extend(_jsonl_rows(store))
+    return _latest(rows)
+
+
+def export_results(rows, folder, statuses=None):
+    # Writes the file of every row (or only rows with one of `statuses`) to folder, under the
+    # row's output_name. Rows from before output names were kept are named by the run's rule:
+    # a file per paper for students with more than one paper in their latest attempt.
+    # Returns the number of files written.
+    os.makedirs(folder, exist_ok=True)
+    kept = set(latest_attempts([row["file"] for row in rows])[0])
+    papers = {} # student identifier -> their current papers
+    for row in rows:
+        if row["file"] in kept:
+            papers.setdefault(row["student_identifier"], set()).add(row["file"])
+    written = 0
+    for row in sorted(rows, key=lambda row: row["recorded_at"]):
+        if statuses and row["status"] not in statuses:
+            continue
+        name, contents = output_file(row, len(papers.get(row["student_identifier"], ())) > 1)
+        write_output(os.path.join(folder, name), contents)
+        written += 1
+    return written
@@ -0,0 +1,151 @@
+import random
+import re
+import threading
+import time
+
+# --- Retrying Failed API Calls ---
+# Errors from generate_content fall into two groups:
+#   * retryable - quota (429), overload (500/502/503), timeouts (408/504), dropped connections.
+#     These usually succeed if we wait a bit, so we back off and try again.
+#   * permanent - blocked prompts, invalid arguments, bad API key, unknown model...
+#     Retrying these only burns quota, so they fail immediately.
+# Classification only looks at the HTTP-style status code and exception class names, so it
+# works with google.api_core exceptions without importing them here.
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+RETRYABLE_EXCEPTION_NAMES = {
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+    "BadGateway", "GatewayTimeout", "DeadlineExceeded", "Aborted", "RetryError",
+}
+PERMANENT_EXCEPTION_NAMES = {"BlockedPromptException", "StopCandidateException"}
+
+RETRYABLE = "retryable"
+PERMANENT = "permanent"
+
+
+def classify_error(error):
+    # Returns RETRYABLE or PERMANENT for an exception raised by the API call.
+    names = {cls.__name__ for cls in type(error).__mro__}
+    if names & PERMANENT_EXCEPTION_NAMES:
+        return PERMANENT
+    if names & RETRYABLE_EXCEPTION_NAMES:
+        return RETRYABLE
+    code = getattr(error, "code", None)
+    if isinstance(code, int) and code in RETRYABLE_STATUS_CODES:
+        return RETRYABLE
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return RETRYABLE
+    return PERMANENT
+
+
+# "Please retry in 37.5s." (REST) or "retry_delay { seconds: 37 }" (gRPC error text)
+_RETRY_IN_PATTERN = re.compile(r"retry in\s+(\d+(?:\.\d+)?)\s*s", re.IGNORECASE)
+_RETRY_DELAY_PATTERN = re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)")
+
+
+def server_retry_delay(error):
+    # The delay (in seconds) the server asked us to wait before retrying, or None.
+    # Checked in order: google.rpc.RetryInfo details, a Retry-After header, the error message.
+    for detail in getattr(error, "details", None) or []:
+        retry_delay = getattr(detail, "retry_delay", None)
+        if retry_delay is not None:
+            return retry_delay.seconds + retry_delay.nanos / 1e9
+        if isinstance(detail, dict) and "retryDelay" in detail:
+            try:
+                return float(str(detail["retryDelay"]).rstrip("s"))
+            except ValueError:
+                pass
+
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers:
+        retry_after = headers.get("Retry-After")
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass  # HTTP-date form; rare for this API, fall through
+
+    message = str(error)
+    match = _RETRY_IN_PATTERN.search(message) or _RETRY_DELAY_PATTERN.search(message)
+    if match:
+        return float(match.group(1))
+    return None
+
+
+class RetriesExhausted(Exception):
+    # Raised when a retryable error is still failing after all attempts.
+    # `retry_after` is the earliest time.monotonic() at which another try makes sense.
+
+    def __init__(self, last_error, attempts, retry_after):
+        super().__init__(f"Gave up after {attempts} attempt(s): {last_error}")
+        self.last_error = last_error
+        self.attempts = attempts
+        self.retry_after = retry_after
+
+
+class RetryPolicy:
+    # Exponential backoff with "full jitter": the n-th wait is a random value between 0
+    # and min(max_delay, base_delay * 2**n), but never shorter than a delay the server asked for.
+    # Jitter keeps parallel workers that hit a 429 together from all retrying in lockstep.
+
+    def __init__(self, max_attempts=4, base_delay=2.0, max_delay=60.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff_delay(self, attempt, error):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        requested = server_retry_delay(error)
+        if requested is not None:
+            delay = max(delay, requested)
+        return delay
+
+    def call(self, func, log=print, on_backoff=None):
+        # Calls func() until it succeeds. Permanent errors are re-raised straight away;
+        # retryable errors raise RetriesExhausted once max_attempts have been used.
+        # on_backoff(delay) is called before each backoff sleep (e.g. for run metrics).
+        for attempt in range(self.max_attempts):
+            try:
+                return func()
+            except Exception as error:
+                if classify_error(error) == PERMANENT:
+                    raise
+                delay = self.backoff_delay(attempt, error)
+                if attempt + 1 >= self.max_attempts:
+                    raise RetriesExhausted(error, attempt + 1, time.monotonic() + delay) from error
+                log(f"  Retryable API error (attempt {attempt + 1}/{self.max_attempts}): {error}")
+                log(f"  Backing off for {delay:.1f}s before retrying...")
+                if on_backoff:
+                    on_backoff(delay)
+                time.sleep(delay)
+
+
+class DeferredQueue:
+    # Papers whose retries were exhausted during the main pass. They are drained after
+    # every other paper has been tried, giving the quota time to recover, instead of
+    # failing the paper outright.
+
+    def __init__(self):
+        self._items = []
+        self._lock = threading.Lock()
+
+    def put(self, item, retry_after):
+        with self._lock:
+            self._items.append((retry_after, item))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def pop_all(self):
+        # Returns (retry_after, item) pairs, earliest first, and empties the queue.
+        with self._lock:
+            items, self._items = self._items, []
+        return sorted(items, key=lambda pair: pair[0])
+
+
+def wait_until(monotonic_deadline):
+    remaining = monotonic_deadline - time.monotonic()
+    if remaining > 0:
+        time.sleep(remaining)
@@ -0,0 +1,51 @@
+# --- Model Routing ---
+# Every paper goes to the primary (fast, cheap) backend first. A paper goes to the escalation
+# (slower, higher-quality) backend instead when its prompt is larger than escalate_above_tokens,
+# or after the primary backend's letter fails the output checks. Without an escalation
+# backend everything stays on the primary one and no checks are run.
+
+
+def check_feedback(text, min_chars):
+    # Returns a list of problems with a generated letter (empty if it looks usable)
+    problems = []
+    if len(text) < min_chars:
+        problems.append(f"only {len(text)} characters")
+    if "[AI:" in text:
+        problems.append("template instructions left in the letter")
+    if "Dear" not in text[:300]:
+        problems.append("no salutation")
+    return problems
+
+
+class ModelRouter:
+
+    def __init__(self, primary, escalation=None, escalate_above_tokens=None, min_feedback_chars=0):
+        self.primary = primary
+        self.escalation = escalation
+        self.escalate_above_tokens = escalate_above_tokens
+        self.min_feedback_chars = min_feedback_chars
+
+    @property
+    def backends(self):
+        return [backend for backend in (self.primary, self.escalation) if backend is not None]
+
+    def first(self, input_tokens):
+        # The backend a paper of this size starts on
+        if self.escalation and self.escalate_above_tokens and input_tokens > self.escalate_above_tokens:
+            return self.escalation
+        return self.primary
+
+    def check(self, text):
+        if not self.escalation:
+            return []
+        return check_feedback(text, self.min_feedback_chars)
+
+    def escalation_for(self, backend):
+        # Where to send a paper whose letter from `backend` failed the checks (None: nowhere)
+        if self.escalation and backend is not self.escalation:
+            return self.escalation
+        return None
+
+    def close(self):
+        for backend in self.backends:
+            backend.close()
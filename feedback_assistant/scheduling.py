@@ -0,0 +1,135 @@
+import csv
+import datetime
+import os
+
+from feedback_assistant.generator import identifier_from_filename
+
+# --- Work Scheduling ---
+# The order papers are sent in decides how long each student waits for their letter. Folder
+# order lets one 90-page portfolio at the front hold up everyone behind it; sending the
+# smallest papers first gets the most letters out soonest (lowest mean time-to-feedback)
+# for the same total run time. order_papers() sorts the papers of a run by:
+#   1. urgency  - students in the schedule file with a `due` date (earliest first) and/or a
+#                 `priority` (smaller first) come before everyone else
+#   2. sections - among equally urgent papers, the sections (the schedule's `section`
+#                 column) take turns: the next paper always comes from the section that has
+#                 been given the least work (estimated size) so far, so a large section
+#                 can't starve a small one
+#   3. size     - within a section, smallest first (or in the given order, with shortest_first=False)
+#
+# A paper's size is its length in characters of text. Before a paper has been extracted only
+# its file size is known, and that means different things per format: a .docx is a zip with
+# ~35 KB of styles and fonts around a few bytes per word, so a two-page .docx is a larger file
+# than a ten-page .pdf. estimated_chars() takes that overhead off and scales the rest by type.
+#
+# The schedule file is a CSV with a header row and the columns
+#   student   - the student's username (as in the Canvas file name) or the paper's file name
+#   section   - optional, e.g. "HIST-101-02"
+#   priority  - optional number, 1 before 2
+#   due       - optional date or date and time, e.g. 2026-10-18 or 2026-10-18 09:00; due dates
+#               come first, so priorities only order students without one (or with the same one)
+# A row with only a section doesn't make a student urgent (a whole roster can be given to
+# share the work fairly between sections). A file without a header row is a plain list of
+# urgent students, one per line. Lines starting with "#" are ignored.
+
+SCHEDULE_COLUMNS = ("student", "section", "priority", "due")
+_LAST = float("inf")
+# File type -> (bytes of a file with no text, bytes per character of text); rough figures
+# for files saved by Word/Google Docs and text PDFs
+_FILE_FORMATS = {".docx": (35_000, 0.25), ".pdf": (1_000, 1.1), ".txt": (0, 1.0)}
+
+
+class ScheduleError(ValueError):
+    pass
+
+
+class Schedule:
+
+    def __init__(self, entries=None):
+        self.entries = entries or {} # student username or file name (lower case) -> {"section", "priority", "due"}
+
+    def lookup(self, filename):
+        # The entry for a paper: by its file name, then by the student's username
+        for key in (os.path.basename(filename), identifier_from_filename(filename)):
+            if key and key.lower() in self.entries:
+                return self.entries[key.lower()]
+        return {}
+
+    def sections(self):
+        return sorted({entry["section"] for entry in self.entries.values() if entry["section"]})
+
+    def urgent_count(self):
+        return sum(1 for entry in self.entries.values() if entry["priority"] is not None or entry["due"] is not None)
+
+
+def load_schedule(path):
+    # Raises ScheduleError (with the line number) for a row that can't be read
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        lines = [line for line in f if line.strip() and not line.lstrip().startswith("#")]
+    if not lines:
+        return Schedule()
+    header = [column.strip().lower() for column in next(csv.reader(lines[:1]))]
+    if "student" not in header:
+        # A plain list of urgent students
+        return Schedule({line.strip().lower(): {"section": "", "priority": 0, "due": None} for line in lines})
+    unknown = set(header) - set(SCHEDULE_COLUMNS)
+    if unknown:
+        raise ScheduleError(f"Unknown column(s) {', '.join(sorted(unknown))} (expected {', '.join(SCHEDULE_COLUMNS)})")
+    entries = {}
+    for line_number, row in enumerate(csv.DictReader(lines[1:], fieldnames=header), start=2):
+        student = (row.get("student") or "").strip()
+        if not student:
+            continue
+        try:
+            priority = float(row["priority"]) if (row.get("priority") or "").strip() else None
+            due = datetime.datetime.fromisoformat(row["due"].strip()).timestamp() if (row.get("due") or "").strip() else None
+        except ValueError as value_error:
+            raise ScheduleError(f"Line {line_number} ({student}): {value_error}")
+        entries[student.lower()] = {"section": (row.get("section") or "").strip(), "priority": priority, "due": due}
+    return Schedule(entries)
+
+
+def estimated_chars(filename, file_size):
+    # Roughly how many characters of text a file of file_size bytes holds
+    overhead, bytes_per_char = _FILE_FORMATS.get(os.path.splitext(filename)[1].lower(), (0, 1.0))
+    return max(0, file_size - overhead) / bytes_per_char
+
+
+def urgency(schedule, filename):
+    # Sort key of how soon a paper is due: papers with equal keys are equally urgent
+    entry = schedule.lookup(filename) if schedule else {}
+    priority, due = entry.get("priority"), entry.get("due")
+    urgent = priority is not None or due is not None
+    return (not urgent, _LAST if due is None else due, _LAST if priority is None else priority)
+
+
+def order_papers(filenames, size_of, schedule=None, shortest_first=True):
+    # -> filenames in the order they should be processed. size_of(filename) estimates the
+    # work a paper is, in characters (see estimated_chars).
+    schedule = schedule or Schedule()
+    tiers = {} # urgency -> section -> [(sort key, size, filename)]
+    for index, filename in enumerate(filenames):
+        size = size_of(filename)
+        sort_key = (size if shortest_first else 0, index)
+        tiers.setdefault(urgency(schedule, filename), {}).setdefault(
+            schedule.lookup(filename).get("section", ""), []).append((sort_key, size, filename))
+    ordered = []
+    for tier in sorted(tiers):
+        ordered.extend(_fair_share(tiers[tier]))
+    return ordered
+
+
+def _fair_share(sections):
+    # Merges the sections' papers: each next paper comes from the section given the least
+    # work so far (ties go to the first section by name)
+    queues = {section: sorted(papers, reverse=True) for section, papers in sorted(sections.items())}
+    given = {section: 0 for section in queues}
+    ordered = []
+    while queues:
+        section = min(queues, key=lambda name: given[name])
+        _, size, filename = queues[section].pop()
+        ordered.append(filename)
+        given[section] += size
+        if not queues[section]:
+            del queues[section]
+    return ordered
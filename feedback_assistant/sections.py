@@ -0,0 +1,88 @@
+from feedback_assistant.prompt_template import PromptTemplate
+from feedback_assistant.rate_limiter import CHARS_PER_TOKEN, estimate_tokens
+
+# --- Long Papers in Sections (Map-Reduce) ---
+# A very long paper or portfolio sent as one prompt is slow to answer (the longest request of a
+# run is often its tail) and can run into the model's context limit. Instead it can be read in
+# sections:
+#   map    - the paper is split at the blank lines between paragraphs/pages into sections of
+#            at most max_tokens, and each section is sent (in parallel) with the usual shared
+#            prefix, asking for reading notes rather than a letter
+#   reduce - the notes, in order, take the place of the paper text in one final request, which
+#            writes the letter with the Feedback Template like any other
+# Each request stays small, so the paper's latency is roughly that of its slowest section plus
+# one short letter, instead of one huge request.
+
+SECTION_PROMPT = """
+**Student Identifier:** {student_identifier}
+
+**Part of a Long Paper:**
+This paper is too long to read in one go, so you are given section {section_number} of {section_count}.
+
+**Student Paper Text (section {section_number} of {section_count}):**
+{section_text}
+
+**Do NOT write the feedback letter yet.** Write concise reading notes on this section only (at most about 300 words), which will be used later to write the letter for the whole paper:
+- What this section argues or does, and how it fits the assignment.
+- Its strongest moments, each with a short quotation.
+- Its most important problems (argument, use of evidence, structure, clarity), each with a short quotation.
+Respond with the notes only.
+"""
+
+REDUCE_PROMPT = """
+**Student Identifier:** {student_identifier}
+
+**Student Paper (read in sections):**
+This paper was too long to include in full. It was read in {section_count} sections, and the reading notes on each section follow, in order. Treat them as your reading of the whole paper, and quote only what the notes quote.
+
+{section_notes}
+
+**Generate the feedback letter now, following all instructions carefully:**
+"""
+
+_section_template = PromptTemplate("", SECTION_PROMPT, fields=("student_identifier", "section_number", "section_count", "section_text"))
+_reduce_template = PromptTemplate("", REDUCE_PROMPT, fields=("student_identifier", "section_count", "section_notes"))
+
+
+def split_sections(text, max_tokens):
+    # Groups the paper's paragraphs (separated by blank lines) into sections of at most
+    # max_tokens; a single paragraph longer than that is cut between words
+    sections, current, current_tokens = [], [], 0
+    for paragraph in text.split("\n\n"):
+        for piece in _pieces(paragraph, max_tokens):
+            tokens = estimate_tokens(piece)
+            if current and current_tokens + tokens > max_tokens:
+                sections.append("\n\n".join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += tokens
+    if current:
+        sections.append("\n\n".join(current))
+    return sections
+
+
+def _pieces(paragraph, max_tokens):
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    while len(paragraph) > max_chars:
+        cut = paragraph.rfind(" ", 0, max_chars)
+        if cut <= 0:
+            cut = max_chars
+        yield paragraph[:cut]
+        paragraph = paragraph[cut:].lstrip()
+    if paragraph.strip():
+        yield paragraph
+
+
+def render_section(student_identifier, section_number, section_count, section_text):
+    # The per-request part of a map request (goes after the shared prefix)
+    return _section_template.render_student_part(
+        student_identifier=student_identifier, section_number=str(section_number),
+        section_count=str(section_count), section_text=section_text)
+
+
+def render_reduce(student_identifier, notes):
+    # The per-request part of the final request, built from every section's notes
+    section_notes = "\n\n".join(f"=== Notes on section {number} of {len(notes)} ===\n{note.strip() or '(No notes for this section.)'}"
+                                for number, note in enumerate(notes, start=1))
+    return _reduce_template.render_student_part(
+        student_identifier=student_identifier, section_count=str(len(notes)), section_notes=section_notes)
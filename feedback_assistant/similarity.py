@@ -0,0 +1,109 @@
+import hashlib
+import json
+
+# --- Duplicate and Near-Duplicate Submissions ---
+# Every paper's extracted text is added to a SimilarityIndex before it goes to the API:
+#   exact duplicates - same text once whitespace and case are ignored (a second Canvas attempt
+#                      with the same file, a group uploading one file several times). Found by
+#                      a hash lookup.
+#   near duplicates  - estimated Jaccard similarity of the papers' 5-word shingles at or above a
+#                      threshold. Found with MinHash signatures and locality-sensitive hashing
+#                      (LSH), so a paper is only compared with the few papers that share a
+#                      signature band with it, not with every paper in the index.
+#
+# The signatures use one-permutation MinHash: each shingle is hashed once, the hash picks one
+# of SIGNATURE_SIZE bins, and each bin keeps its smallest value. That makes a signature a
+# single pass over the text (a few milliseconds per paper) rather than one pass per hash function.
+
+SHINGLE_WORDS = 5
+SIGNATURE_SIZE = 128            # Bins per signature
+BAND_ROWS = 8                   # Bins per LSH band (16 bands: pairs above ~0.7 become candidates)
+EMPTY_BIN = None
+
+
+def normalized_words(text):
+    return text.lower().split()
+
+
+def content_hash(text):
+    # Identical for texts that differ only in whitespace or case
+    return hashlib.sha256(" ".join(normalized_words(text)).encode("utf-8")).hexdigest()
+
+
+def signature(text):
+    words = normalized_words(text)
+    count = max(1, len(words) - SHINGLE_WORDS + 1)
+    bins = [EMPTY_BIN] * SIGNATURE_SIZE
+    for start in range(count):
+        shingle = " ".join(words[start:start + SHINGLE_WORDS]).encode("utf-8")
+        value = int.from_bytes(hashlib.blake2b(shingle, digest_size=8).digest(), "big")
+        index, value = value % SIGNATURE_SIZE, value // SIGNATURE_SIZE
+        if bins[index] is EMPTY_BIN or value < bins[index]:
+            bins[index] = value
+    return tuple(bins)
+
+
+def estimated_similarity(first, second):
+    # Estimated Jaccard similarity of the two papers' shingle sets
+    used = matching = 0
+    for a, b in zip(first, second):
+        if a is EMPTY_BIN and b is EMPTY_BIN:
+            continue
+        used += 1
+        matching += a == b
+    return matching / used if used else 0.0
+
+
+class SimilarityIndex:
+
+    def __init__(self, threshold=0.8):
+        self.threshold = threshold
+        self.exact = {} # content hash -> first paper added with that text
+        self.duplicates_of = {} # paper -> the first paper with the same text
+        self.signatures = {}
+        self.bands = {} # (band number, band values) -> papers
+        self.near_duplicates = [] # (paper, earlier paper, estimated similarity)
+
+    def add(self, key, text):
+        # Indexes one paper. Returns (the earlier paper with the same text or None,
+        # [(earlier paper, similarity)] for earlier papers that are near duplicates)
+        digest = content_hash(text)
+        original = self.exact.get(digest)
+        if original is not None:
+            self.duplicates_of[key] = original
+            return original, []
+        self.exact[digest] = key
+
+        paper_signature = signature(text)
+        candidates = set()
+        for band in range(0, SIGNATURE_SIZE, BAND_ROWS):
+            bucket = self.bands.setdefault((band, paper_signature[band:band + BAND_ROWS]), [])
+            candidates.update(bucket)
+            bucket.append(key)
+        similar = []
+        for candidate in candidates:
+            similarity = estimated_similarity(paper_signature, self.signatures[candidate])
+            if similarity >= self.threshold:
+                similar.append((candidate, similarity))
+        similar.sort(key=lambda item: item[1], reverse=True)
+        self.signatures[key] = paper_signature
+        self.near_duplicates.extend((key, candidate, similarity) for candidate, similarity in similar)
+        return None, similar
+
+    def report(self):
+        groups = {}
+        for key, original in self.duplicates_of.items():
+            groups.setdefault(original, [original]).append(key)
+        return {
+            "threshold": self.threshold,
+            "papers_indexed": len(self.signatures) + len(self.duplicates_of),
+            "exact_duplicates": sorted(groups.values()),
+            "near_duplicates": [{"paper": key, "similar_to": candidate, "estimated_similarity": round(similarity, 3)}
+                                for key, candidate, similarity in self.near_duplicates],
+        }
+
+    def write_report(self, path):
+        report = self.report()
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        return report
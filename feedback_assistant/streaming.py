@@ -0,0 +1,110 @@
+import os
+import time
+
+# --- Streaming Responses ---
+# With stream=True the API sends the letter in chunks while it is being generated. Each chunk
+# goes straight to disk: into "<feedback file>.partial", which is renamed to the real name only
+# once the response is complete, so an interrupted run never leaves a half-written letter
+# that looks finished. Without a path (e.g. when letters go to a results store), the letter
+# is only collected in memory. The time to the first chunk and the total generation time are
+# measured for every paper.
+
+PARTIAL_SUFFIX = ".partial"
+
+
+def chunk_text(chunk):
+    # Text of one streamed chunk ("" for chunks that only carry metadata)
+    try:
+        return "".join(part.text for part in chunk.parts)
+    except Exception:
+        return ""
+
+
+class FeedbackStream:
+    # Writes streamed text to `path` (or only to memory, with path=None), stripped of
+    # leading/trailing whitespace like the non-streaming path. `replacements` ({old: new}) are
+    # applied even when `old` arrives split across two chunks.
+
+    def __init__(self, path, replacements=None):
+        self.path = path
+        self.partial_path = path + PARTIAL_SUFFIX if path else None
+        self.replacements = replacements or {}
+        # Enough trailing characters to hold back an incomplete `old`
+        self.hold_back = max((len(old) for old in self.replacements), default=1) - 1
+        self.file = None
+        self.start()
+
+    def start(self):
+        # (Re)starts the stream; called before each attempt, so a retry starts a fresh file
+        self.discard()
+        self.pending = ""
+        self.characters = 0
+        self.written = [] # Everything written so far (the letter, once committed)
+        self.started_at = time.monotonic()
+        self.first_chunk_at = None
+        self.finished_at = None
+
+    def write(self, text):
+        if not text:
+            return
+        if self.first_chunk_at is None:
+            self.first_chunk_at = time.monotonic()
+        self.pending += text
+        if not self.characters:
+            self.pending = self.pending.lstrip()
+        for old, new in self.replacements.items():
+            self.pending = self.pending.replace(old, new)
+        keep = max(len(self.pending) - len(self.pending.rstrip()), self.hold_back)
+        if len(self.pending) > keep:
+            self._write_out(self.pending[:len(self.pending) - keep])
+            self.pending = self.pending[len(self.pending) - keep:]
+
+    def _write_out(self, text):
+        if self.path:
+            if self.file is None:
+                self.file = open(self.partial_path, "w", encoding="utf-8")
+            self.file.write(text)
+            self.file.flush() # Lets you watch a long letter being written
+        self.written.append(text)
+        self.characters += len(text)
+
+    @property
+    def text(self):
+        return "".join(self.written)
+
+    def finish(self):
+        # Marks the end of generation (call once the stream is exhausted)
+        self.finished_at = time.monotonic()
+
+    def commit(self):
+        # Moves the finished letter into place. Returns False (and writes nothing) if the
+        # response had no text at all.
+        tail = self.pending.rstrip()
+        if tail:
+            self._write_out(tail)
+        self.pending = ""
+        if not self.characters:
+            self.discard()
+            return False
+        if self.path:
+            self.file.close()
+            self.file = None
+            os.replace(self.partial_path, self.path)
+        return True
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.partial_path and os.path.exists(self.partial_path):
+            os.remove(self.partial_path)
+
+    @property
+    def timings(self):
+        # Seconds, rounded for the report; None if there was no text / the stream isn't finished
+        timings = {"time_to_first_token_s": None, "generation_s": None}
+        if self.first_chunk_at is not None:
+            timings["time_to_first_token_s"] = round(self.first_chunk_at - self.started_at, 3)
+        if self.finished_at is not None:
+            timings["generation_s"] = round(self.finished_at - self.started_at, 3)
+        return timings
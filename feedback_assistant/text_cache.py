@@ -0,0 +1,90 @@
+import json
+import os
+import sqlite3
+import time
+
+# --- Cache of Extracted Paper Text ---
+# Parsing DOCX/PDF files is the slowest local step, and the result only depends on the
+# file's bytes and on the extraction code. Results are stored in a small SQLite database
+# keyed by (content SHA-256, extractor version), so changing the prompt or model and
+# re-running skips parsing entirely. Extraction warnings are stored alongside the text
+# and reported again on a cache hit.
+#
+# Only used from the main thread (see run_pipeline in generate_feedback.py).
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS extracted_text (
+    sha256 TEXT NOT NULL,
+    extractor_version TEXT NOT NULL,    -- extraction.extractor_version(): version plus limits
+    status TEXT NOT NULL,
+    text TEXT NOT NULL,
+    warnings TEXT NOT NULL,      -- JSON list of warning lines
+    created_at REAL NOT NULL,
+    last_used_at REAL NOT NULL,
+    PRIMARY KEY (sha256, extractor_version)
+)
+"""
+
+# Only outcomes that depend solely on the file are cached; "exception" results may be
+# caused by a temporary problem (file still being copied, out of memory...).
+CACHEABLE_STATUSES = ("ok", "failed")
+
+
+class TextCache:
+
+    def __init__(self, path, extractor_version):
+        self.extractor_version = extractor_version
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(_SCHEMA)
+        self.connection.commit()
+
+    def get(self, sha256):
+        # Returns an extraction result dict (same shape as extract_text()) or None.
+        row = self.connection.execute(
+            "SELECT status, text, warnings FROM extracted_text WHERE sha256 = ? AND extractor_version = ?",
+            (sha256, self.extractor_version),
+        ).fetchone()
+        if row is None:
+            return None
+        self.connection.execute(
+            "UPDATE extracted_text SET last_used_at = ? WHERE sha256 = ? AND extractor_version = ?",
+            (time.time(), sha256, self.extractor_version),
+        )
+        self.connection.commit()
+        status, text, warnings = row
+        warnings = json.loads(warnings)
+        return {
+            "status": status,
+            "text": text,
+            "messages": ["  Using cached text extraction (file unchanged)."] + warnings,
+            "warnings": warnings,
+            "error": None,
+            "cacheable": True,
+        }
+
+    def put(self, sha256, result):
+        if result["status"] not in CACHEABLE_STATUSES or not result.get("cacheable", True):
+            return
+        now = time.time()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO extracted_text VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (sha256, self.extractor_version, result["status"], result["text"],
+             json.dumps(result["warnings"]), now, now),
+        )
+        self.connection.commit()
+
+    def prune(self, max_age_days):
+        # Drops entries from older extractor versions and entries not used for max_age_days.
+        cursor = self.connection.execute(
+            "DELETE FROM extracted_text WHERE extractor_version != ? OR last_used_at < ?",
+            (self.extractor_version, time.time() - max_age_days * 86400),
+        )
+        self.connection.commit()
+        return cursor.rowcount
+
+    def close(self):
+        self.connection.close()
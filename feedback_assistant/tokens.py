@@ -0,0 +1,205 @@
+import json
+import threading
+
+from feedback_assistant.rate_limiter import estimate_tokens
+
+# --- Token Accounting and Budgets ---
+# Every prompt is measured before it is sent (offline estimate, or the API's count_tokens),
+# the real usage is taken from each response's usage_metadata, and a run can be capped by
+# total tokens and/or estimated cost. A paper whose request would push the run over budget
+# is not sent; it is recorded as "over_budget" and picked up again by the next run.
+
+
+class TokenCounter:
+    # Counts input tokens for a prompt made of the shared prefix plus a student part.
+    # The prefix is measured once; only the student part is counted per paper.
+    #   method "estimate" - offline, ~4 characters per token (instant, slightly inaccurate)
+    #   method "api"      - model.count_tokens() (exact, but one extra request per paper)
+    # With "api", each count waits for the rate_limiter like any other request and is retried
+    # by the retry_policy; if it still fails, the offline estimate is used instead, so a 429
+    # from count_tokens never fails a paper.
+
+    def __init__(self, method, template, model=None, rate_limiter=None, retry_policy=None):
+        if method not in ("estimate", "api"):
+            raise ValueError(f"Unknown token counting method: {method}")
+        self.method = method
+        self.model = model
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy
+        self.fallbacks = 0 # Counts that used the estimate because count_tokens failed
+        self.lock = threading.Lock()
+        self.prefix_tokens = self._count(template.prefix)
+
+    def _count(self, text):
+        if self.method == "api":
+            try:
+                return self._count_with_api(text)
+            except Exception as count_error:
+                with self.lock:
+                    self.fallbacks += 1
+                    first = self.fallbacks == 1
+                if first:
+                    print(f"  Warning: count_tokens failed ({count_error}); using the offline estimate instead.")
+        return estimate_tokens(text)
+
+    def _count_with_api(self, text):
+        def call_api():
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            return int(self.model.count_tokens(text).total_tokens)
+
+        if self.retry_policy:
+            return self.retry_policy.call(call_api, log=lambda message: None)
+        return call_api()
+
+    def count(self, student_part):
+        return self.prefix_tokens + self._count(student_part)
+
+
+def usage_from_response(response):
+    # Token usage reported by the API, from a response object or its JSON (batch results) form.
+    # Missing values are 0.
+    if isinstance(response, dict):
+        metadata = response.get("usageMetadata") or response.get("usage_metadata")
+    else:
+        metadata = getattr(response, "usage_metadata", None)
+    usage = {
+        "prompt_tokens": _usage_value(metadata, "promptTokenCount", "prompt_token_count"),
+        "output_tokens": _usage_value(metadata, "candidatesTokenCount", "candidates_token_count"),
+        "cached_tokens": _usage_value(metadata, "cachedContentTokenCount", "cached_content_token_count"),
+        "total_tokens": _usage_value(metadata, "totalTokenCount", "total_token_count"),
+    }
+    if not usage["total_tokens"]:
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["output_tokens"]
+    return usage
+
+
+def _usage_value(metadata, json_name, attribute_name):
+    if not metadata:
+        return 0
+    if isinstance(metadata, dict):
+        value = metadata.get(json_name, metadata.get(attribute_name))
+    else:
+        value = getattr(metadata, attribute_name, None)
+    return int(value or 0)
+
+
+class Pricing:
+    # Prices in USD per million tokens. Cached prompt tokens are billed at cached_input_price.
+    # `factor` scales everything (e.g. 0.5 for batch jobs, which are billed at half price).
+
+    def __init__(self, input_price, output_price, cached_input_price=None, factor=1.0):
+        self.input_price = input_price
+        self.output_price = output_price
+        self.cached_input_price = cached_input_price if cached_input_price is not None else input_price
+        self.factor = factor
+
+    def cost(self, prompt_tokens, output_tokens, cached_tokens=0):
+        uncached = max(0, prompt_tokens - cached_tokens)
+        return self.factor * (
+            uncached * self.input_price
+            + cached_tokens * self.cached_input_price
+            + output_tokens * self.output_price
+        ) / 1_000_000
+
+
+class TokenBudget:
+    # Thread-safe budget shared by all API workers. Each request reserves its expected size
+    # before it is sent; the reservation is replaced by the real usage once the response
+    # arrives (or released if the request failed), so parallel workers can't overshoot together.
+
+    def __init__(self, pricing, max_tokens=None, max_cost=None):
+        self.pricing = pricing
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
+        self.used_tokens = 0
+        self.used_cost = 0.0
+        self.reserved_tokens = 0
+        self.reserved_cost = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self, input_tokens, expected_output_tokens, pricing=None):
+        # Returns a reservation (pass it to settle/release), or None if it doesn't fit.
+        # `pricing` overrides the budget's default, e.g. for a more expensive model.
+        pricing = pricing or self.pricing
+        tokens = input_tokens + expected_output_tokens
+        cost = pricing.cost(input_tokens, expected_output_tokens)
+        with self.lock:
+            if self.max_tokens is not None and self.used_tokens + self.reserved_tokens + tokens > self.max_tokens:
+                return None
+            if self.max_cost is not None and self.used_cost + self.reserved_cost + cost > self.max_cost:
+                return None
+            self.reserved_tokens += tokens
+            self.reserved_cost += cost
+        return (tokens, cost, pricing)
+
+    def release(self, reservation):
+        with self.lock:
+            self.reserved_tokens -= reservation[0]
+            self.reserved_cost -= reservation[1]
+
+    def settle(self, reservation, usage):
+        # Returns the cost of the request
+        cost = reservation[2].cost(usage["prompt_tokens"], usage["output_tokens"], usage["cached_tokens"])
+        with self.lock:
+            self.reserved_tokens -= reservation[0]
+            self.reserved_cost -= reservation[1]
+            self.used_tokens += usage["total_tokens"]
+            self.used_cost += cost
+        return cost
+
+    def charge(self, usage, pricing=None):
+        # Counts a billed request that has no reservation (e.g. a late answer to a request
+        # abandoned at its deadline). Returns its cost.
+        return self.settle((0, 0.0, pricing or self.pricing), usage)
+
+
+class TokenLedger:
+    # Per-paper token records for the machine-readable report.
+
+    def __init__(self):
+        self.papers = {}
+        self.lock = threading.Lock()
+
+    def record(self, filename, **fields):
+        # Later calls for the same paper add to / overwrite earlier fields
+        with self.lock:
+            self.papers.setdefault(filename, {"file": filename}).update(fields)
+
+    def add(self, filename, **fields):
+        # Like record(), but numbers are added to what is already recorded
+        # (a paper can be part of a packed request and then be sent again on its own)
+        with self.lock:
+            paper = self.papers.setdefault(filename, {"file": filename})
+            for key, value in fields.items():
+                if isinstance(value, (int, float)) and isinstance(paper.get(key), (int, float)):
+                    value += paper[key]
+                paper[key] = value
+
+    def get(self, filename):
+        # A copy of one paper's record ({} if nothing was recorded)
+        with self.lock:
+            return dict(self.papers.get(filename, {}))
+
+    def values(self, field):
+        # The recorded values of one field across all papers (papers without it are left out)
+        with self.lock:
+            return [paper[field] for paper in self.papers.values() if paper.get(field) is not None]
+
+    def totals(self):
+        with self.lock:
+            papers = list(self.papers.values())
+        totals = {"papers": len(papers), "estimated_input_tokens": 0, "prompt_tokens": 0,
+                  "output_tokens": 0, "cached_tokens": 0, "total_tokens": 0, "cost_usd": 0.0}
+        for paper in papers:
+            for key in totals:
+                if key != "papers":
+                    totals[key] += paper.get(key, 0) or 0
+        totals["cost_usd"] = round(totals["cost_usd"], 6)
+        return totals
+
+    def write_report(self, path, **run_info):
+        with self.lock:
+            papers = sorted(self.papers.values(), key=lambda paper: paper["file"])
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({**run_info, "totals": self.totals(), "papers": papers}, f, indent=2)
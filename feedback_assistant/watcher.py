@@ -0,0 +1,164 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+# --- Watching the Papers Folder ---
+# Watch mode keeps one process (and one warm API client) running during a submission window
+# and processes submissions as they arrive. On Linux the folder is watched with inotify, so
+# only the files named in change events are looked at; elsewhere (or if inotify can't be set
+# up) the folder is scanned every poll_seconds.
+#
+# A file is only reported once its size and modification time have stayed the same for
+# settle_seconds, so copies, downloads and syncs that are still writing it are not picked up
+# half-finished. Hidden files and typical temporary/partial download names are ignored.
+
+IGNORED_PREFIXES = (".", "~$")
+IGNORED_SUFFIXES = (".part", ".partial", ".crdownload", ".download", ".tmp")
+
+# inotify event flags (see inotify(7))
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII") # wd, mask, cookie, len
+
+
+def is_candidate(name):
+    return not name.startswith(IGNORED_PREFIXES) and not name.lower().endswith(IGNORED_SUFFIXES)
+
+
+class Inotify:
+    # Minimal inotify binding through ctypes (Linux only, no extra dependency)
+
+    def __init__(self, folder):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f"inotify_add_watch failed for {folder}")
+
+    def read(self, timeout):
+        # Waits up to `timeout` seconds. Returns (names of changed files, overflowed)
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        names = set()
+        overflowed = False
+        while readable:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    overflowed = True
+                elif name:
+                    names.add(os.fsdecode(name))
+        return names, overflowed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FolderWatcher:
+
+    def __init__(self, folder, settle_seconds=3.0, poll_seconds=5.0, rescan_seconds=300.0, use_inotify=True):
+        self.folder = folder
+        self.settle_seconds = settle_seconds
+        self.poll_seconds = poll_seconds
+        self.rescan_seconds = rescan_seconds
+        self.inotify = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify(folder)
+            except (OSError, AttributeError):
+                self.inotify = None # Fall back to polling
+        self.mode = "inotify" if self.inotify else "polling"
+        # Files already handed out (or present at start), by (size, mtime): not reported again
+        # until they change
+        self.reported = self._scan()
+        self.pending = {} # name -> (stat, time it was first seen with that stat)
+        self.last_rescan = time.monotonic()
+
+    def _stat(self, name):
+        try:
+            info = os.stat(os.path.join(self.folder, name))
+        except OSError:
+            return None
+        if not os.path.isfile(os.path.join(self.folder, name)):
+            return None
+        return (info.st_size, info.st_mtime_ns)
+
+    def _scan(self):
+        stats = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.is_file() and is_candidate(entry.name):
+                    info = entry.stat()
+                    stats[entry.name] = (info.st_size, info.st_mtime_ns)
+        return stats
+
+    def _note(self, name, stat, now):
+        if stat is None or self.reported.get(name) == stat:
+            self.pending.pop(name, None)
+            return
+        if name not in self.pending or self.pending[name][0] != stat:
+            self.pending[name] = (stat, now) # New or still changing: (re)start the settle timer
+
+    def wait(self):
+        # Blocks until at least one new or changed file has settled; returns their names.
+        while True:
+            now = time.monotonic()
+            # Sleep until the next pending file could have settled (or the next poll)
+            timeout = self.poll_seconds
+            if self.pending:
+                settle_at = min(since for _, since in self.pending.values()) + self.settle_seconds
+                timeout = max(0.05, min(timeout, settle_at - now))
+
+            if self.inotify:
+                names, overflowed = self.inotify.read(timeout)
+                now = time.monotonic()
+                if overflowed or now - self.last_rescan > self.rescan_seconds:
+                    # Events may have been missed: look at everything
+                    names |= set(self._scan())
+                    self.last_rescan = now
+                for name in names:
+                    if is_candidate(name):
+                        self._note(name, self._stat(name), now)
+                # Files still settling have to be looked at again even without new events
+                for name in list(self.pending):
+                    self._note(name, self._stat(name), now)
+            else:
+                time.sleep(timeout)
+                now = time.monotonic()
+                stats = self._scan()
+                for name, stat in stats.items():
+                    self._note(name, stat, now)
+                for name in list(self.pending):
+                    if name not in stats:
+                        self.pending.pop(name)
+
+            ready = sorted(name for name, (stat, since) in self.pending.items() if now - since >= self.settle_seconds)
+            if ready:
+                for name in ready:
+                    self.reported[name] = self.pending.pop(name)[0]
+                return ready
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
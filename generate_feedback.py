@@ -1,53 +1,319 @@
-<<<<<<< HEAD
+import argparse
+import functools
+import itertools
+import json
 import os
-import google.generativeai as genai
-from docx import Document  # For reading .docx
-import PyPDF2  # For reading .pdf
-import time  # For rate limiting
+import random
+import re
+import statistics
 import sys  # To exit cleanly on error
+import threading  # For the worker pool
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from feedback_assistant.backends import GeminiBackend, LocalBackend
+from feedback_assistant.batch import BatchRequestError, GeminiBatchBackend, LocalBatchBackend, write_request_file
+from feedback_assistant.batch import FINISHED_STATES as FINISHED_BATCH_STATES, SUCCEEDED as BATCH_SUCCEEDED
+from feedback_assistant.batch import parse_response as parse_batch_response
+from feedback_assistant.canvas import SubmissionArchive, latest_attempts, parse_submission_name
+from feedback_assistant.conformance import LetterTemplate
+from feedback_assistant.extraction import ExtractionLimits, extract_member, extract_text, extractor_version
+from feedback_assistant.generator import DEFAULT_IDENTIFIER, identifier_from_filename, response_text, write_output
+from feedback_assistant.hedging import Hedger, LatencyStats
+from feedback_assistant.leases import LeaseManager
+from feedback_assistant.manifest import FINISHED_OUTCOMES, MANIFEST_FILENAME, RunManifest, prompt_version
+from feedback_assistant.metrics import PROFILE_MODES, StageMetrics, combine_profiles, measured_call
+from feedback_assistant.packing import Packer, pack_generation_config, render_pack, split_packed_response
+from feedback_assistant.prefix_cache import GeminiPrefixCache, NoPrefixCache
+from feedback_assistant.prompt_template import PromptTemplate
+from feedback_assistant.rate_limiter import RateLimiter, estimate_tokens
+from feedback_assistant.response_cache import ResponseCache, cache_key
+from feedback_assistant.results_store import export_results, open_results_store, output_file, output_name, read_results, store_path
+from feedback_assistant.retry import DeferredQueue, RetriesExhausted, RetryPolicy, classify_error, wait_until
+from feedback_assistant.routing import ModelRouter
+from feedback_assistant.scheduling import ScheduleError, estimated_chars, load_schedule, order_papers, urgency
+from feedback_assistant.sections import render_reduce, render_section, split_sections
+from feedback_assistant.similarity import SimilarityIndex
+from feedback_assistant.streaming import FeedbackStream, chunk_text
+from feedback_assistant.text_cache import TextCache
+from feedback_assistant.tokens import Pricing, TokenBudget, TokenCounter, TokenLedger, usage_from_response
+from feedback_assistant.watcher import FolderWatcher
 
 # --- Configuration ---
 
 # === IMPORTANT: Secure your API Key! ===
-# Reads the API key from an environment variable named GOOGLE_API_KEY
-api_key = os.environ.get("GOOGLE_API_KEY")
-if not api_key:
-    print("Error: GOOGLE_API_KEY environment variable not found.")
-    print("Please set the environment variable before running the script.")
-    print("Refer to instructions on how to set environment variables for your OS.")
-    print("Exiting.")
-    sys.exit(1) # Exit the script if key is not found
-
-# Configure the Gemini API client
-try:
-    genai.configure(api_key=api_key)
-except Exception as e:
-    print(f"Error configuring the Google AI client: {e}")
-    print("Please ensure your API key is valid.")
-    sys.exit(1)
+# The API key is read from an environment variable named GOOGLE_API_KEY when the run
+# starts (see init_model() below). Never paste the key itself into this file.
 
 # === Model Configuration ===
 # Consider later and/or pro models for potentially higher quality (check pricing/availability)
 MODEL_NAME = 'gemini-2.0-flash' # Flash is faster and cheaper, Pro might be better quality
-try:
-    model = genai.GenerativeModel(MODEL_NAME)
-    print(f"Using Generative Model: {MODEL_NAME}")
-except Exception as e:
-    print(f"Error initializing Generative Model ('{MODEL_NAME}'): {e}")
-    print("Check if the model name is correct and your API key has access.")
-    sys.exit(1)
+
+# Optional: Control generation parameters (also part of the response cache key below)
+# GENERATION_CONFIG = genai.types.GenerationConfig(
+#     # candidate_count=1, # Default is 1
+#     # stop_sequences=['\n\n\n'], # Example stop sequence
+#     # max_output_tokens=2048, # Limit output length
+#     temperature=0.7 # 0.0 = deterministic, 1.0 = max creativity
+# )
+GENERATION_CONFIG = None
+
+# === Model Backends & Routing ===
+# Every paper goes to MODEL_NAME first. With ESCALATION_MODEL_NAME set, a paper is re-sent to
+# that slower, higher-quality model when MODEL_NAME's letter fails the output checks (too
+# short, "[AI: ...]" template instructions left in, no salutation), and very long papers go
+# straight to it. Most papers then get flash-tier latency and cost; hard cases get a better letter.
+# MODEL_BACKEND = "local" answers with placeholder letters instead of calling Gemini (no API
+# key needed); useful for trying out the pipeline. Placeholder letters are never cached.
+MODEL_BACKEND = "gemini"        # "gemini" or "local"
+ESCALATION_MODEL_NAME = None    # e.g. 'gemini-2.5-pro'; None = never escalate
+ESCALATE_ABOVE_TOKENS = 12000   # Prompts larger than this go straight to the escalation model
+MIN_FEEDBACK_CHARS = 800        # Shorter letters fail the output checks
+ESCALATION_PRICE_PER_MILLION_INPUT_TOKENS = 1.25  # Check the current Gemini pricing
+ESCALATION_PRICE_PER_MILLION_OUTPUT_TOKENS = 10.00
+
+# === Letter Checks & Section Repairs ===
+# Every letter is checked against the section structure of feedback_template (below): missing
+# sections (headings with "Optional" may be left out), "[AI: ...]" instructions left in,
+# sections shorter than MIN_SECTION_CHARS, letters shorter than MIN_FEEDBACK_CHARS or longer
+# than MAX_FEEDBACK_CHARS. With REPAIR_SECTIONS, only the failing sections are requested again,
+# in one small follow-up request, and put into the letter in place - much cheaper and faster
+# than regenerating the whole letter. Letters that still fail are saved with a warning (and go
+# to ESCALATION_MODEL_NAME, if set). Not used for placeholder letters or in batch mode.
+CHECK_LETTERS = True
+REPAIR_SECTIONS = True
+MIN_SECTION_CHARS = 80
+MAX_FEEDBACK_CHARS = 8000
+REPAIR_OUTPUT_TOKENS = 300      # Expected output per repaired section, reserved like EXPECTED_OUTPUT_TOKENS
+
+# === Long Papers in Sections ===
+# Papers whose prompt is larger than SECTIONS_ABOVE_TOKENS are read in sections instead of
+# being sent whole: the text is split at paragraph/page breaks into sections of at most
+# SECTION_MAX_TOKENS, up to SECTION_WORKERS sections are sent at once asking for reading
+# notes, and one final request writes the letter (with the usual template) from the notes.
+# Long portfolios then take about as long as their slowest section plus one short letter
+# instead of holding up the end of the run. Not used in batch mode.
+SECTIONS_ABOVE_TOKENS = None    # e.g. 20000; None = always send the whole paper
+SECTION_MAX_TOKENS = 6000
+SECTION_WORKERS = 4             # Section requests in flight per long paper (still within the rate limits)
+SECTION_NOTES_TOKENS = 500      # Rough size of one section's notes, reserved like EXPECTED_OUTPUT_TOKENS
+
+# === Prompt Prefix Caching ===
+# The instructions, assignment context, example letter and template are identical for every
+# paper. With "gemini" they are uploaded once as Gemini cached content and each request only
+# sends the student's part, saving input tokens and latency. Context caching needs an explicit
+# model version (e.g. 'gemini-2.0-flash-001') and a minimum prompt size; if it can't be set up
+# the script falls back to "none" (send the full prompt every time).
+PROMPT_PREFIX_CACHE = "none"    # "none" or "gemini"
+PREFIX_CACHE_TTL_MINUTES = 60   # Extended automatically while the run is still going
+
+# === Throughput & Rate Limits ===
+# Set these to match your API tier (see the quota page in Google AI Studio).
+# Free tiers often have low limits (e.g., 15 RPM); paid tiers allow far more.
+MAX_CONCURRENT_REQUESTS = 4     # Papers processed in parallel (worker threads)
+REQUESTS_PER_MINUTE = 15        # Requests-per-minute (RPM) quota
+TOKENS_PER_MINUTE = 1_000_000   # Tokens-per-minute (TPM) quota; set to None to disable the token limit
+EXPECTED_OUTPUT_TOKENS = 1000   # Rough size of one feedback letter, reserved against the TPM quota up front
+
+# === Streaming (--stream) ===
+# Receives each letter in chunks as it is generated and writes them straight to the feedback
+# file (as "<name>.partial" until complete). Records time-to-first-token and generation time
+# per paper in the token report; useful for sizing MAX_CONCURRENT_REQUESTS.
+# Not used for packed requests (--pack), whose JSON answer has to be complete before splitting.
+STREAM_RESPONSES = False
+
+# === Token Accounting & Budget ===
+# Each prompt is measured before it is sent and the real usage is recorded from every response.
+# Totals appear in the summary and per-paper numbers in token_report.json in the output folder.
+# With a budget set, papers whose request would exceed it are not sent (they are picked up
+# again by the next run). Prices are USD per million tokens - check the current Gemini pricing.
+TOKEN_COUNTING = "estimate"     # "estimate" (offline, ~4 chars/token) or "api" (exact, uses count_tokens; counts against REQUESTS_PER_MINUTE)
+RUN_TOKEN_BUDGET = None         # Max total tokens for one run, e.g. 2_000_000 (None = no limit)
+RUN_COST_BUDGET_USD = None      # Max estimated cost for one run, e.g. 5.00 (None = no limit)
+BUDGET_ACTION = "stop"          # "stop": send nothing more once a request doesn't fit; "skip": keep trying smaller papers
+PRICE_PER_MILLION_INPUT_TOKENS = 0.10
+PRICE_PER_MILLION_CACHED_INPUT_TOKENS = 0.025
+PRICE_PER_MILLION_OUTPUT_TOKENS = 0.40
+BATCH_PRICE_FACTOR = 0.5        # Batch jobs are billed at a discount
+TOKEN_REPORT_FILENAME = 'token_report.json' # Written to the output folder
+
+# === Retries ===
+# Quota (429), overload (503) and timeout errors are retried with exponential backoff.
+# Papers still failing after MAX_RETRY_ATTEMPTS are retried once more at the end of the run.
+# Permanent errors (blocked prompt, invalid request) are never retried.
+MAX_RETRY_ATTEMPTS = 4          # Attempts per paper before it is deferred
+RETRY_BASE_DELAY = 2            # Seconds; doubled on each attempt (with random jitter)
+RETRY_MAX_DELAY = 60            # Upper bound for a single backoff, unless the server asks for longer
+
+# === Deadlines & Hedged Requests ===
+# A request with no answer after REQUEST_TIMEOUT_SECONDS is abandoned and retried like any
+# other timeout (see Retries), so one hung request can't stall the run. None = wait forever.
+# The API client is given the same timeout; until an abandoned request has really ended, it
+# still counts against MAX_CONCURRENT_REQUESTS (as do duplicates and section requests).
+# With HEDGE_REQUESTS (or --hedge), a request that is still running after the model's recent
+# p95 latency (HEDGE_PERCENTILE, over the last HEDGE_WINDOW answers) gets a duplicate, and the
+# first answer wins. This trims the slow tail at the end of a run, at the price of the extra
+# requests: at most HEDGE_MAX_FRACTION of all requests are duplicated, a duplicate is only sent
+# when the rate limits and the token/cost budget have room for it right away, and the losing
+# answer is counted against the budget. Streamed requests (--stream) are never duplicated.
+REQUEST_TIMEOUT_SECONDS = 300
+HEDGE_REQUESTS = False
+HEDGE_PERCENTILE = 95
+HEDGE_WINDOW = 200              # Recent answers per model the percentile is taken over
+HEDGE_MIN_SAMPLES = 20          # No duplicates until a model has answered this many requests
+HEDGE_MIN_DELAY_SECONDS = 10    # Never duplicate a request that has been running for less than this
+HEDGE_MAX_FRACTION = 0.1        # At most 10% extra requests
+
+# === Response Cache ===
+# Successful responses are cached on disk, keyed by model + generation config + full prompt.
+# Re-running on unchanged papers (e.g. after a crash) then skips the API entirely.
+# Delete the cache folder (or set USE_RESPONSE_CACHE = False) to force fresh feedback.
+USE_RESPONSE_CACHE = True
+RESPONSE_CACHE_FOLDER = '.feedback_cache/responses'
+RESPONSE_CACHE_MAX_AGE_DAYS = 30
+RESPONSE_CACHE_MAX_SIZE_MB = 200
+
+# === Incremental Runs ===
+# A manifest in the output folder records each paper's size, modification time, content hash,
+# prompt version and outcome. When True, re-runs only process new or changed papers, papers
+# that previously failed, and everything after the prompt/model settings change.
+# Set to False to reprocess the whole folder.
+ONLY_PROCESS_CHANGED = True
+
+# === Extraction Pipeline ===
+# Reading DOCX/PDF files is CPU-bound, so it runs in separate worker processes while the
+# API threads are busy waiting on the network. Extracted papers wait in a bounded queue
+# until an API worker is free; when the queue is full, extraction pauses.
+EXTRACTION_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1)) # Set to 0 to extract in the main process
+PROMPT_QUEUE_DEPTH = 8          # Ready-to-send prompts allowed to wait for an API worker
+# Long PDFs (portfolios with 100+ pages) are split into page ranges that several processes
+# extract in parallel; each maps the file rather than reading its own copy. Extraction stops
+# at MAX_EXTRACTED_CHARS characters or MAX_PDF_PAGES pages (None = no limit), and the
+# paper's log says when text was cut off. Per-page times appear as "pdf_page" in the run metrics.
+# Each extraction worker starts its own page processes, so up to EXTRACTION_WORKERS x
+# PDF_PAGE_WORKERS of them can run at once when several long PDFs come together; the default
+# divides the cores between the two pools.
+PDF_PAGE_WORKERS = max(1, (os.cpu_count() or 2) // max(1, EXTRACTION_WORKERS)) # Processes per long PDF; 1 = always one page at a time
+PDF_PARALLEL_MIN_PAGES = 40     # Shorter PDFs are read one page at a time
+PDF_PAGES_PER_TASK = 10         # Pages per range handed to a page worker
+MAX_PDF_PAGES = None            # e.g. 60 to only read the beginning of very long PDFs
+MAX_EXTRACTED_CHARS = 400000    # ~100k tokens; far longer than any paper worth sending whole
+
+# === Extracted Text Cache ===
+# Text extracted from each DOCX/PDF is cached by file content (plus extractor version),
+# so re-runs after changing only the prompt or model skip parsing entirely.
+# Set to False to always re-parse every file.
+USE_TEXT_CACHE = True
+TEXT_CACHE_PATH = '.feedback_cache/extracted_text.sqlite3'
+TEXT_CACHE_MAX_AGE_DAYS = 90    # Entries unused for this long are removed
+
+# === Packing Short Papers (--pack) ===
+# Sends several short papers in one request (one copy of the shared prompt) and asks for
+# JSON output with one letter per student, which is split back into the usual files.
+# Fewer requests and far fewer repeated prompt tokens; anything that can't be split cleanly
+# is sent again on its own.
+PACK_PAPERS = False
+PACK_MAX_PAPERS = 5             # Papers per packed request
+PACK_MAX_INPUT_TOKENS = 30000   # Student text per packed request (the shared prompt comes on top)
+PACK_MAX_PAPER_TOKENS = 3000    # Longer papers are always sent on their own
+
+# === Canvas Submissions ===
+# Canvas bulk downloads name each file username_userid_submissionid_OriginalName.ext, with
+# _LATE_ after the username for late submissions and "-1", "-2"... added to files uploaded
+# again for a later attempt. With LATEST_ATTEMPT_ONLY, only each student's newest attempt is
+# processed and their earlier attempts are skipped (--all-attempts processes every file).
+# Set papers_archive (or use --zip) to read the papers straight out of the Canvas
+# submissions.zip instead of unzipping it into papers_folder.
+LATEST_ATTEMPT_ONLY = True
+
+# === Work Scheduling ===
+# Papers are sent shortest first instead of in folder order, so one long portfolio doesn't
+# hold up everyone behind it and most students get their letter sooner. Length is the
+# paper's characters of text (from the text cache) or, before a paper has been extracted,
+# its file size with the overhead of the file type (e.g. a .docx's styles) taken off.
+# SCHEDULE_FILE (or --schedule) can put some students first - e.g. those with a conference
+# tomorrow - and split the class into sections that take turns. It is a CSV with a header row:
+#   student,section,priority,due
+#   jdoe,HIST-101-02,1,
+#   asmith,HIST-101-01,,2026-10-18 09:00
+# student is the username from the file name (or the file name); papers with a due date
+# (earliest first) or priority (smaller first) go before all others. Among papers equally
+# urgent, each section gets a fair share of the work. A file without a header row is simply a
+# list of students to do first. The mean time-to-feedback is shown in the summary.
+SCHEDULE_FILE = None            # e.g. 'schedule.csv'
+SHORTEST_FIRST = True           # False: folder order within each section
+
+# === Duplicate Submissions ===
+# Before the API stage every paper's text goes into a similarity index. A paper with exactly
+# the same text as one sent earlier in the run (a second Canvas attempt, a group uploading one
+# file several times) is not sent again: it gets a copy of that paper's letter with the
+# identifier swapped. Papers whose text is at least NEAR_DUPLICATE_THRESHOLD similar (or
+# identical to a paper from an earlier run) are only flagged, in the log and in the report.
+DETECT_DUPLICATES = True
+REUSE_DUPLICATE_FEEDBACK = True
+NEAR_DUPLICATE_THRESHOLD = 0.8  # Estimated share of 5-word phrases in common
+SIMILARITY_REPORT_FILENAME = 'similarity_report.json' # Written to the output folder
+
+# === Results Store ===
+# Without a store, each letter and each error report is its own text file in the output folder.
+# With RESULTS_STORE set (or --results-store), every outcome is a row in one file instead -
+# output_folder/results.sqlite3 or results.jsonl - with the student, status, letter or error,
+# tokens, cost and timings. Rows are written in batches, so thousands of papers don't mean
+# thousands of small file writes. Write the usual per-student files from the store at any time
+# with --export-results. Use "jsonl" with several workers on an NFS share (SQLite's locking
+# isn't reliable there); each worker writes its own store either way.
+RESULTS_STORE = None            # None (one file per outcome), "sqlite" or "jsonl"
+RESULTS_STORE_FILENAME = 'results' # Written to the output folder, plus .sqlite3 or .jsonl
+RESULTS_BATCH_SIZE = 50         # Rows written per batch
+RESULTS_FLUSH_SECONDS = 5       # ...or at least this often while papers finish
+
+# === Watch Mode (--watch) ===
+# Keeps running after the first pass and processes new or changed submissions as soon as
+# they land in the papers folder (inotify on Linux, folder scans elsewhere). Stop with Ctrl+C.
+WATCH_SETTLE_SECONDS = 3        # A file must stay unchanged this long before it is processed
+WATCH_POLL_SECONDS = 5          # Scan interval when inotify isn't available
+WATCH_RESCAN_SECONDS = 300      # Full rescans even with inotify, in case events were missed
+
+# === Multiple Workers (--worker NAME) ===
+# Several copies of the script - on one machine, or on several machines sharing the folders
+# over NFS - can split one papers folder. Start each with its own --worker name. A worker
+# claims each paper's student with a lease file in output_folder/.leases before extracting it,
+# so no two workers ever process (or write feedback for) the same student at the same time.
+# Leases of a crashed worker are taken over after LEASE_TTL_SECONDS. Each worker keeps its own
+# manifest journal, reports and text cache (SQLite shouldn't be shared over NFS). Papers a
+# worker found claimed by others are checked again every LEASE_RECHECK_SECONDS until done.
+# Workers skip papers another worker already finished with the same text and prompt; to
+# reprocess everything, delete output_folder/.leases.
+LEASE_FOLDER = '.leases'
+LEASE_TTL_SECONDS = 600         # Keep well above the longest request (leases are renewed while working)
+LEASE_RECHECK_SECONDS = 30
+
+# === Run Metrics ===
+# Every stage of the per-paper flow is timed (filename parsing, extraction, prompt building,
+# rate-limit waits, API calls, retry backoff, saving). Counts, p50/p95/p99 latency, bytes and
+# tokens per stage are written to run_metrics.json in the output folder after each run.
+# PROFILE_EXTRACTION (or --profile-extraction) additionally profiles the extraction stage:
+#   "cprofile"    - combined profile in extraction_profile.prof / extraction_profile.txt
+#   "tracemalloc" - peak memory and top allocation sites per paper, in run_metrics.json
+# Profiling bypasses the extracted text cache so every paper is really parsed.
+METRICS_REPORT_FILENAME = 'run_metrics.json'  # Written to the output folder
+PROFILE_EXTRACTION = None       # None, "cprofile" or "tracemalloc"
+
+# === Batch Mode (--batch) ===
+# Submits every paper as one offline batch job instead of individual requests.
+# Slower to finish (minutes to hours) but cheaper and not limited by RPM; good for end of term.
+BATCH_BACKEND = "gemini"        # "gemini" (Gemini Batch API) or "local" (offline stand-in for testing)
+BATCH_POLL_SECONDS = 60         # How often to check whether the job has finished
+BATCH_REQUESTS_FILENAME = 'batch_requests.jsonl' # Written to the output folder
+BATCH_STATE_FILENAME = '.batch_job.json'         # Remembers a submitted job until its results are saved
 
 
 # === Folder Paths === (Relative to where the script is run)
 papers_folder = 'papers'
+papers_archive = None # e.g. 'submissions.zip' (the Canvas bulk download); used instead of papers_folder
 output_folder = 'feedback'
-# Ensure input folder exists
-if not os.path.isdir(papers_folder):
-    print(f"Error: Input folder '{papers_folder}' not found.")
-    print("Please create it and place the paper files inside.")
-    sys.exit(1)
-# Ensure output folder exists
-os.makedirs(output_folder, exist_ok=True)
+extracted_text_folder = os.path.join(output_folder, 'extracted_text') # Written by --extract-only
 
 
 # === Assignment Context ===
@@ -125,7 +391,10 @@ Best regards,
 """
 
 # === Base Prompt for the AI ===
-# This combines all instructions, context, and placeholders.
+# This combines all instructions and context. It is the same for every paper, so it is built
+# once and can be cached by the API (see PROMPT_PREFIX_CACHE).
+# Note: {student_identifier} is left in place on purpose - the model fills it in from the
+# Student Identifier given in student_prompt below.
 base_prompt = f"""
 You are an AI teaching assistant providing feedback on a student's Project 1 analysis paper draft.
 Your goal is to generate helpful, specific, and constructive feedback to guide the student's revision process, aligning with the assignment's goals and the instructor's desired feedback style.
@@ -149,618 +418,1593 @@ This example shows the desired tone, style, and level of specificity (connecting
 
 **Feedback Template:**
 {feedback_template}
+"""
 
-**Student Identifier:** {{student_identifier_placeholder}}
+# === Per-Student Prompt ===
+# Appended to base_prompt for each paper. {student_identifier} and {paper_text} are filled in
+# (in a single pass, so a paper that contains these strings is not changed).
+student_prompt = """
+**Student Identifier:** {student_identifier}
 
 **Student Paper Text:**
-{{paper_text_placeholder}}
+{paper_text}
 
 **Generate the feedback letter now, following all instructions carefully:**
 """
 
-# --- Processing Loop ---
-print(f"\n--- Starting Batch Feedback Generation ---")
-
-try:
-    # List files, ignore hidden files/folders
-    paper_files = [f for f in os.listdir(papers_folder) if os.path.isfile(os.path.join(papers_folder, f)) and not f.startswith('.')]
-except FileNotFoundError:
-    print(f"Error: Input folder '{papers_folder}' not found.")
-    sys.exit(1)
+prompt_template = PromptTemplate(base_prompt, student_prompt, fields=("student_identifier", "paper_text"))
 
-if not paper_files:
-    print(f"No files found in the '{papers_folder}' folder.")
-    sys.exit(0)
 
-total_files = len(paper_files)
-processed_count = 0
-error_count = 0
+# --- Setup ---
 
-print(f"Found {total_files} files to process in '{papers_folder}'. Outputting to '{output_folder}'.")
+def init_model():
+    # google.generativeai takes about a second to import, so only runs that call the API load it
+    import google.generativeai as genai
 
-for index, filename in enumerate(paper_files):
-    print("-" * 50) # Separator for clarity
-    print(f"Processing file {index + 1}/{total_files}: {filename}")
-
-    full_text = ""
-    student_identifier = "Unknown_Student" # Default identifier
+    # Reads the API key from an environment variable named GOOGLE_API_KEY
+    api_key = os.environ.get("GOOGLE_API_KEY")
+    if not api_key:
+        print("Error: GOOGLE_API_KEY environment variable not found.")
+        print("Please set the environment variable before running the script.")
+        print("Refer to instructions on how to set environment variables for your OS.")
+        print("Exiting.")
+        sys.exit(1) # Exit the script if key is not found
 
-    # --- Extract Student Identifier (Handles username_ID_ID_OriginalName.ext) ---
+    # Configure the Gemini API client
     try:
-        base_name = os.path.splitext(filename)[0] # Remove extension
-        parts = base_name.split('_', 1) # Split only at the first underscore
-        if parts and parts[0].strip():
-            student_identifier = parts[0].strip()
-        elif base_name.strip(): # Fallback if no underscore
-             student_identifier = base_name.strip()
-        else:
-             print(f"  Warning: Could not extract a valid identifier from filename. Using default.")
-        print(f"  Extracted Identifier: {student_identifier}")
+        genai.configure(api_key=api_key)
     except Exception as e:
-        print(f"  Warning: Error extracting identifier from filename '{filename}'. Using default. Error: {e}")
-
-    filepath = os.path.join(papers_folder, filename)
-    file_processed = False # Flag for rate limiting
+        print(f"Error configuring the Google AI client: {e}")
+        print("Please ensure your API key is valid.")
+        sys.exit(1)
 
-    # --- Read File Content based on extension ---
     try:
-        if filename.lower().endswith(".docx"):
-            print("  Reading DOCX file...")
-            doc = Document(filepath)
-            paragraphs = [para.text for para in doc.paragraphs if para.text.strip()]
-            full_text = "\n\n".join(paragraphs) # Use double newline for better paragraph separation
-            if not full_text:
-                print(f"  Warning: No text extracted from DOCX file or file is empty.")
-                error_count += 1
-                continue
-
-        elif filename.lower().endswith(".pdf"):
-            print("  Reading PDF file...")
-            text_list = []
-            try:
-                with open(filepath, 'rb') as pdf_file:
-                    reader = PyPDF2.PdfReader(pdf_file)
-                    # Check for encryption
-                    if reader.is_encrypted:
-                        try:
-                            # Try decrypting with empty password (common case)
-                            if reader.decrypt('') == PyPDF2.PasswordType.NOT_DECRYPTED:
-                                print(f"  Warning: Skipping password-protected PDF: {filename}")
-                                error_count += 1
-                                continue # Skip this file
-                        except Exception as decrypt_err:
-                             print(f"  Warning: Skipping encrypted PDF (decryption failed): {filename} - {decrypt_err}")
-                             error_count += 1
-                             continue
-
-                    num_pages = len(reader.pages)
-                    # print(f"  Found {num_pages} page(s). Extracting text...") # Optional verbosity
-                    for page_num in range(num_pages):
-                        try:
-                            page = reader.pages[page_num]
-                            extracted = page.extract_text()
-                            if extracted:
-                                text_list.append(extracted.strip())
-                        except Exception as page_error:
-                             print(f"    Warning: Error extracting text from PDF page {page_num + 1}: {page_error}")
-                full_text = "\n\n".join(text_list).strip() # Join pages with double newline
-                if not full_text:
-                    print(f"  Warning: No text extracted from PDF (check if image-based or complex).")
-                    error_count += 1
-                    continue
-            except ImportError as ie:
-                 print(f"  Error: PyPDF2 dependency possibly missing or corrupt: {ie}")
-                 print(f"  Try: pip install --upgrade PyPDF2")
-                 error_count +=1
-                 continue
-            except Exception as pdf_err:
-                print(f"  Error reading PDF file structure {filename}: {pdf_err}")
-                error_count += 1
-                continue
-
-        else:
-            print(f"  Skipping unsupported file type: {filename}")
-            # Not counted as an error, just skipped.
-            continue
-
-        # --- If text was extracted successfully ---
-        if full_text:
-            print(f"  Extracted text length: ~{len(full_text)} characters.")
-            # --- Prepare the final prompt for the API ---
-            try:
-                # Replace ALL placeholders in the base prompt string
-                prompt_for_api = base_prompt.replace("{assignment_context_placeholder}", assignment_description)
-                prompt_for_api = prompt_for_api.replace("{example_feedback_placeholder}", example_feedback_letter)
-                prompt_for_api = prompt_for_api.replace("{student_identifier_placeholder}", student_identifier)
-                prompt_for_api = prompt_for_api.replace("{paper_text_placeholder}", full_text)
-                # Replace placeholder in the template part itself
-                prompt_for_api = prompt_for_api.replace("{student_identifier}", student_identifier)
-
-                # --- Call the Google Gemini API ---
-                print("  Sending request to Gemini API...")
-                response = model.generate_content(
-                    prompt_for_api,
-                    # Optional: Add safety settings if needed, balancing safety and utility
-                    # safety_settings=[
-                    #     {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_LOW_AND_ABOVE"}, # Stricter
-                    #     {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_LOW_AND_ABOVE"}, # Stricter
-                    #     {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                    #     {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                    # ]
-                    # Optional: Control generation parameters
-                    # generation_config=genai.types.GenerationConfig(
-                    #     # candidate_count=1, # Default is 1
-                    #     # stop_sequences=['\n\n\n'], # Example stop sequence
-                    #     # max_output_tokens=2048, # Limit output length
-                    #     temperature=0.7 # 0.0 = deterministic, 1.0 = max creativity
-                    # )
-                )
-
-                # --- Extract and Save Feedback ---
-                feedback_text = ""
-                try:
-                    # Accessing response text safely - check candidate parts
-                    if response.parts:
-                         feedback_text = "".join(part.text for part in response.parts).strip()
-                    else:
-                         # Sometimes .text might work even if .parts is empty, try as fallback
-                         feedback_text = response.text.strip()
-
-                except AttributeError:
-                     # Handle cases where .text might not exist if response failed early
-                     print("  Warning: Could not directly access .text attribute in API response.")
-                     feedback_text = "" # Ensure it's empty
-                except Exception as resp_err:
-                     print(f"  Warning: Could not extract text from API response parts. Error: {resp_err}")
-                     feedback_text = "" # Ensure it's empty
-
-                # Check if feedback is empty or blocked
-                if feedback_text:
-                    output_filename = os.path.join(output_folder, f"{student_identifier}_feedback.txt")
-                    with open(output_filename, 'w', encoding='utf-8') as f:
-                        f.write(feedback_text)
-                    print(f"  Successfully generated and saved feedback to '{output_filename}'")
-                    processed_count += 1
-                    file_processed = True
-                else:
-                    # Handle blocked prompts or genuinely empty responses
-                    print(f"  Warning: No feedback content generated for {filename}.")
-                    try:
-                        # Log safety feedback if available
-                        block_reason = response.prompt_feedback.block_reason
-                        safety_ratings = response.prompt_feedback.safety_ratings
-                        print(f"    Block Reason (if any): {block_reason}")
-                        print(f"    Safety Ratings: {safety_ratings}")
-                        error_filename = os.path.join(output_folder, f"{student_identifier}_ERROR_FeedbackBlockedOrEmpty.txt")
-                        with open(error_filename, 'w', encoding='utf-8') as f:
-                            f.write(f"Feedback generation blocked or empty for {filename} (Identifier: {student_identifier}).\n")
-                            f.write(f"Block Reason: {block_reason}\n")
-                            f.write(f"Safety Ratings: {safety_ratings}\n")
-                    except Exception:
-                         print("    Could not retrieve detailed safety/block feedback from response.")
-                         error_filename = os.path.join(output_folder, f"{student_identifier}_ERROR_EmptyResponse.txt")
-                         with open(error_filename, 'w', encoding='utf-8') as f:
-                            f.write(f"API returned an empty response for {filename} (Identifier: {student_identifier}).\n")
-                    error_count += 1
-                    continue # Skip saving/pausing
-
-            except Exception as api_error:
-                print(f"!! Error during API call or response processing for {filename}: {api_error}")
-                # You might want to log the specific error to a file here too
-                error_filename = os.path.join(output_folder, f"{student_identifier}_ERROR_API_Call_Failed.txt")
-                with open(error_filename, 'w', encoding='utf-8') as f:
-                   f.write(f"API call failed for {filename} (Identifier: {student_identifier}).\n")
-                   f.write(f"Error: {api_error}\n")
-                error_count += 1
-                continue # Skip to next file
-
-            # --- Rate Limiting ---
-            if file_processed: # Only pause if we successfully processed and saved
-                 print("  Pausing briefly to respect API rate limits...")
-                 # Adjust sleep time based on your API tier limits and observation
-                 # Free tiers often have low requests-per-minute limits (e.g., 15-60 RPM)
-                 time.sleep(4) # Pause for 4 seconds (adjust if needed)
-
-    except Exception as file_proc_error:
-        print(f"!! Unexpected error processing file {filename} before API call: {file_proc_error}")
-        error_filename = os.path.join(output_folder, f"{student_identifier}_ERROR_File_Processing.txt")
-        with open(error_filename, 'w', encoding='utf-8') as f:
-            f.write(f"Unexpected error processing file {filename} (Identifier: {student_identifier}) before API call.\n")
-            f.write(f"Error: {file_proc_error}\n")
-        error_count += 1
-        continue # Skip to next file
-
-# --- Final Summary ---
-print("-" * 50)
-print("\n--- Batch Feedback Generation Summary ---")
-print(f"Total files found in '{papers_folder}': {total_files}")
-print(f"Successfully generated feedback for: {processed_count} files")
-print(f"Files skipped or resulting in errors: {error_count}")
-print(f"Feedback files (and any error logs) saved in the '{output_folder}' folder.")
-print("\n--- IMPORTANT REMINDERS ---")
-print("1. REVIEW AND EDIT EACH feedback file carefully before sharing.")
-print("2. Manually replace the '{student_identifier}' (username) in each feedback letter with the student's actual name.")
-=======
-import os
-import google.generativeai as genai
-from docx import Document  # For reading .docx
-import PyPDF2  # For reading .pdf
-import time  # For rate limiting
-import sys  # To exit cleanly on error
-
-# --- Configuration ---
-
-# === IMPORTANT: Secure your API Key! ===
-# Reads the API key from an environment variable named GOOGLE_API_KEY
-api_key = os.environ.get("GOOGLE_API_KEY")
-if not api_key:
-    print("Error: GOOGLE_API_KEY environment variable not found.")
-    print("Please set the environment variable before running the script.")
-    print("Refer to instructions on how to set environment variables for your OS.")
-    print("Exiting.")
-    sys.exit(1) # Exit the script if key is not found
-
-# Configure the Gemini API client
-try:
-    genai.configure(api_key=api_key)
-except Exception as e:
-    print(f"Error configuring the Google AI client: {e}")
-    print("Please ensure your API key is valid.")
-    sys.exit(1)
-
-# === Model Configuration ===
-# Consider later and/or pro models for potentially higher quality (check pricing/availability)
-MODEL_NAME = 'gemini-2.0-flash' # Flash is faster and cheaper, Pro might be better quality
-try:
-    model = genai.GenerativeModel(MODEL_NAME)
-    print(f"Using Generative Model: {MODEL_NAME}")
-except Exception as e:
-    print(f"Error initializing Generative Model ('{MODEL_NAME}'): {e}")
-    print("Check if the model name is correct and your API key has access.")
-    sys.exit(1)
-
-
-# === Folder Paths === (Relative to where the script is run)
-papers_folder = 'papers'
-output_folder = 'feedback'
-# Ensure input folder exists
-if not os.path.isdir(papers_folder):
-    print(f"Error: Input folder '{papers_folder}' not found.")
-    print("Please create it and place the paper files inside.")
-    sys.exit(1)
-# Ensure output folder exists
-os.makedirs(output_folder, exist_ok=True)
-
-
-# === Assignment Context ===
-assignment_description = """
-Project 1: Analyzing a Text
-
-This project asks you to analyze one of the following texts from class -- Dungy, Bastian, or Young. Different from a summary where you share with your reader the main arguments of something you read, an analysis asks you to interpret why the author crafted their piece in the manner that they did and how that piece addresses a broader conversation.
-
-In class, we have been analyzing this texts by considering what each authors driving questions has been. What is the underlying question that pushes their thought and analysis forward? Your essay should have its own driving question (an alternative to a thesis statement) that motivates the analysis and argument of your essay writing and structure.
-
-This project also provides an opportunity to work on the following learning goals:
-- Engage with current conversations taking place around the climate crisis to develop critical reading and thinking skills
-- Reexamine and refine the processes of one’s own writing to enhance self-awareness as a writer and develop strategies for effectively communicating with diverse audiences.
-- Learn about and begin to develop ethical communication processes
-- Learn about the role of collaboration in the learning process
-- Reflect on the learning environment of the course and engage in co-creating learning experiences
-
-In order to complete this project you need to follow these steps:
-Step 1: Choose the text you wish to analyze (Dungy, Bastian, or Young)
-Step 2: Decide how you will analyze the text. Think about some of the questions discussed in class:
-    - What is the driving question that the author is trying to answer? What sub questions do they attempt to answer? Does the author identify a problem and/or propose a solution? What is the purpose of discussing these questions/solutions?
-    - Who are they posing this question to? Who is their audience? How can you tell? How do they appeal to their audience's values/knowledge/conventions?
-    - Who is the author? How does their intersectionality inform the text?
-    - What is the author’s positionality in relation to their driving question and/or audience? How does this positionality impact how they discuss their driving question?
-    - How does the author communicate their argument?  (You might consider using rhetorical devices such as humor,  or observe other strategies they use to craft their message.)
-    - What other authors/sources do they draw on as evidence to support their argument? How effectively do they build their case?
-You can focus on one of these questions to create your own driving question about the text.
-Step 3: Write a 3-4 page first draft of your analysis. Your analysis should include an argument or driving question in response to the question you chose to use to analyze the text. First focus on your analysis, and then think about the best way to present/craft the analysis in your text. You do not need to use a standard 5-paragraph essay.
-Step 4: Submit your first draft to your instructor, and be sure to also complete your pre-conference reflection.
-Step 5: Meet for a mid-term conference with your instructor to discuss your analysis.
-Step 6: After meeting with your instructor, revise your project. Submit your revision within a week after your conference. When submitting your revision, please include: The first draft, instructor comments, revised draft, and a pre-conference reflection.
-"""
-
-# === Example Feedback ===
-# Provides style, tone, and specificity guidance. AI should adapt content.
-example_feedback_letter = """
-Dear student,
-Thank you for sharing this essay with me. You’ve effectively identified Dungy’s core argument, and your use of evidence (Dungy’s childhood anecdotes, her discussion of ecopoetics, her rebuttal to counterarguments) is relevant to your interest in “different definitions of an environment.”
-For revision, I would focus on refining your core argument about Dungy’s paper. Your driving question currently reads like a rephrasing of Dungy’s, so I might suggest returning to your initial interest in “different definitions of an environment” and see if you can unpack the how behind Dungy’s argument. What literary strategies does she employ to capture these “different definitions”? How might you structure your paper in a way that allows you to compare and contrast these definitions that Dungy explores more clearly? Pay particular attention to the transitions between sections, and focus on telling a story for your reader.
-I would also suggest reading your essay aloud and proofreading it for clarity and flow. Certain word choices and typos (for example, “pressing” in the paper’s opening sentence, pronoun consistency, or “Ddungy” instead of “Dungy”) got in the way of my reading experience, so make sure every sentence conveys what you want it to say.
-Please let me know if you have any questions about my comments. I look forward to exploring the essay in more depth with you during the conference.
-"""
-
-# === Feedback Template (Revised) ===
-# The AI will fill in the bracketed parts based on its analysis.
-# Remember you will manually replace the {student_identifier} with the actual name later.
-feedback_template = """
-Dear {student_identifier},
-
-Thank you for submitting your Project 1 analysis. Here is your feedback:
-
-**Overall Analysis & Argument:**
-*   [AI: Comment on the clarity and insightfulness of the student's analysis of the chosen text (Dungy, Bastian, or Young). Does the essay move beyond summary? Does it seem guided by its own clear driving question or interpretive thesis, as requested in the assignment?]
-*   [AI: Identify a key strength in the analysis or argument, citing a specific example or quote from the student's essay.]
-
-**Use of Evidence & Examples:**
-*   [AI: Comment on how effectively the student uses evidence (quotes, specific examples) from the primary text (Dungy, Bastian, or Young) to support their analytical points. Are the examples well-chosen, integrated smoothly, and explained in relation to the student's argument?]
-*   [AI: Note a strength or area for improvement regarding evidence use, citing a specific example or quote from the student's essay.]
-
-**Structure & Clarity:**
-*   [AI: Comment on the overall organization and flow of the essay. Is the argument logical and easy to follow? Are transitions between paragraphs/ideas effective? Does the structure support the analysis? Consider the learning goals about communicating effectively.]
-*   [AI: Note a strength or area for improvement regarding structure or clarity, citing a specific example or quote from the student's essay.]
-
-**Areas for Revision Focus:**
-*   [AI: Based on the assignment goals (analysis vs summary, driving question, learning goals) and the analysis of this specific paper, suggest 1-2 concrete, actionable areas for the student to focus on during revision. Try to connect suggestions back to the assignment description.]
-*   [AI: Suggest specific strategies, questions for the student to consider, or parts of their essay to revisit during revision, aiming for the constructive and specific style shown in the example feedback.]
-
-**Proofreading Note (Optional but Recommended):**
-*   [AI: Briefly mention if consistent patterns of errors (grammar, typos, awkward phrasing, citation issues) significantly impeded readability. If so, gently suggest careful proofreading, perhaps reading aloud as mentioned in the example feedback.]
-
-I look forward to discussing your analysis further during our conference. Please come prepared with any questions you have about this feedback or your revision ideas.
-
-Best regards,
-[Your Name]
-"""
-
-# === Base Prompt for the AI ===
-# This combines all instructions, context, and placeholders.
-base_prompt = f"""
-You are an AI teaching assistant providing feedback on a student's Project 1 analysis paper draft.
-Your goal is to generate helpful, specific, and constructive feedback to guide the student's revision process, aligning with the assignment's goals and the instructor's desired feedback style.
-
-**Assignment Context:**
-This is the description for Project 1 the student was given. Pay close attention to the key requirements: analyzing (not summarizing) Dungy, Bastian, or Young; developing their *own* driving question; and the listed learning goals.
-{assignment_description}
-
-**Example of Desired Feedback:**
-This example shows the desired tone, style, and level of specificity (connecting comments to the text, offering concrete revision suggestions). Adapt the *content* to the student paper you analyze, but match the *style*. Note the example discusses Dungy; the current paper might analyze Bastian or Young.
-{example_feedback_letter}
-
-**Instructions for Generating Feedback:**
-1.  Thoroughly analyze the **Student Paper Text** provided below.
-2.  Identify which primary text (Dungy, Bastian, or Young) the student is analyzing.
-3.  Evaluate the paper based on the **Assignment Context**, focusing on analysis depth, the presence and clarity of the student's driving question/thesis, use of evidence, and structure.
-4.  Generate a feedback letter using the **Feedback Template** provided below.
-5.  **Adhere strictly to the structure** of the Feedback Template, filling in each bracketed `[AI: ...]` section.
-6.  Emulate the **constructive tone and specificity** shown in the **Example Feedback**. **Crucially, use specific examples or short quotes from the student's paper text** to justify your points in each section.
-7.  The student's identifier (likely their username) is provided. Use this identifier *only* in the salutation `Dear {{student_identifier}},` as shown in the template.
-
-**Feedback Template:**
-{feedback_template}
+        model = genai.GenerativeModel(MODEL_NAME)
+        print(f"Using Generative Model: {MODEL_NAME}")
+    except Exception as e:
+        print(f"Error initializing Generative Model ('{MODEL_NAME}'): {e}")
+        print("Check if the model name is correct and your API key has access.")
+        sys.exit(1)
+    return model
+
+
+def check_folders():
+    # Ensure input folder exists (a submissions archive is checked when it is opened)
+    if not archive and not os.path.isdir(papers_folder):
+        print(f"Error: Input folder '{papers_folder}' not found.")
+        print("Please create it and place the paper files inside.")
+        sys.exit(1)
+    # Ensure output folder exists
+    os.makedirs(output_folder, exist_ok=True)
+
+
+# --- Processing Pipeline ---
+# Each paper goes through three stages:
+#   1. extraction     - DOCX/PDF text, in a process pool (feedback_assistant.extraction)
+#   2. prompt         - identifier + prompt, in the main thread (prepare_job)
+#   3. API call       - rate limited and retried, in a pool of worker threads (generate_and_save)
+# The main thread feeds stage 3 through a bounded number of slots, so extraction never runs
+# too far ahead of the API and network-bound generation never waits on parsing.
+print_lock = threading.Lock()
+results_lock = threading.Lock()
+duplicates_lock = threading.Lock()
+rate_limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+retry_policy = RetryPolicy(MAX_RETRY_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY)
+deferred_queue = DeferredQueue()
+budget_exhausted = threading.Event()
+token_ledger = TokenLedger()
+latency_stats = LatencyStats(HEDGE_WINDOW, HEDGE_MIN_SAMPLES)
+
+# Set up by main()
+router = None
+hedger = None
+letter_template = None
+response_cache = None
+text_cache = None
+token_counter = None
+token_budget = None
+stream_responses = STREAM_RESPONSES
+manifest = None
+current_prompt_version = None
+fingerprints = {}
+counts = {"success": 0, "error": 0, "over_budget": 0, "other_workers": 0}
+metrics = StageMetrics()
+profile_extraction = PROFILE_EXTRACTION
+extraction_limits = None
+similarity_index = None
+previous_papers = set() # Papers from earlier runs in the similarity index
+worker_id = None
+leases = None
+archive = None # SubmissionArchive when reading from a ZIP
+results_store = None
+schedule = None # scheduling.Schedule from SCHEDULE_FILE
+queued_at = {} # filename -> time.monotonic() when it was scheduled, for time-to-feedback
+student_papers = {} # student identifier -> their current papers (see current_papers, per_paper_output)
+superseded = {} # earlier attempt -> the file that replaces it (see latest_attempts)
+all_attempts = False # --all-attempts
+leased = {} # filename -> student identifier this worker holds a lease for
+lease_waiting = [] # Papers claimed by other workers during the current pass
+duplicate_groups = {} # paper -> {"outcome": its outcome once known, "followers": [(job, log) of exact duplicates]}
+offline_mode = None # "extract-only" or "dry-run": no API calls, nothing recorded in the manifest
+extraction_profiles = [] # tracemalloc results per paper
+
+
+def make_logger(tag):
+    # Output from several workers is interleaved, so prefix every line with the paper it belongs to.
+    def log(message):
+        with print_lock:
+            print(f"[{tag}] {message}")
+    return log
+
+
+def job_cache_key(job, model_name=MODEL_NAME):
+    # Response-cache key of a single-paper request
+    return cache_key(model_name, [prompt_template.prefix_digest, job["student_prompt"]], GENERATION_CONFIG)
+
+
+def cached_response(job):
+    # A cached answer to this paper's request from any of the routed models, or None
+    for backend in router.backends:
+        if backend.cacheable:
+            cached = response_cache.get(job_cache_key(job, backend.model_name))
+            if cached:
+                return cached
+    return None
+
+
+def send_request(backend, student_part, input_tokens, reservation, log, generation_config=GENERATION_CONFIG,
+                 expected_output_tokens=EXPECTED_OUTPUT_TOKENS, stream=None, ledger_key=None):
+    # Sends the shared prefix plus student_part to the backend (with rate limiting and retries) and
+    # settles the budget reservation. Returns (response, usage, cost). On failure the
+    # reservation is released and the exception is re-raised. Answers that are billed but not
+    # used (see Deadlines & Hedged Requests) are added to the ledger_key paper's record.
+    # With a FeedbackStream the response is streamed into it; the caller commits it.
+    estimated_tokens = input_tokens + expected_output_tokens
+
+    def call_api():
+        # --- Wait for a free slot in the rate limits ---
+        # (every retry counts against the quota too)
+        with metrics.timer("rate_limit_wait"):
+            rate_limiter.acquire(estimated_tokens)
+        # --- Call the Google Gemini API ---
+        log("  Sending request to Gemini API...")
+        started = time.perf_counter()
+        try:
+            if stream is None:
+                response = hedger.call(backend.model_name, receive, start_hedge, finish_hedge, log)
+            else:
+                # Not run under the hedger: a duplicate (or an abandoned request) would write to
+                # the same stream. The API's own timeout still applies (see generate()).
+                with hedger.slot():
+                    response = receive()
+                latency_stats.record(backend.model_name, time.perf_counter() - started)
+        except Exception:
+            metrics.record("api_call_failed", time.perf_counter() - started)
+            raise
+        metrics.record("api_call", time.perf_counter() - started, tokens=usage_from_response(response)["total_tokens"])
+        return response
+
+    def receive():
+        if stream is None:
+            return generate(generation_config)
+        stream.start()
+        response = generate(generation_config, stream=True)
+        try:
+            for chunk in response:
+                stream.write(chunk_text(chunk))
+        except BaseException:
+            stream.discard() # Nothing half-written is left behind; a retry starts over
+            raise
+        stream.finish()
+        return response
+
+    def start_hedge():
+        # A duplicate request needs quota and budget right now; returns its reservation
+        if budget_exhausted.is_set():
+            return None
+        hedge_reservation = token_budget.reserve(input_tokens, expected_output_tokens, backend.pricing)
+        if hedge_reservation is None:
+            return None
+        if not rate_limiter.try_acquire(estimated_tokens):
+            token_budget.release(hedge_reservation)
+            return None
+        return hedge_reservation
+
+    def finish_hedge(hedge_reservation, unused_responses):
+        # Answers that weren't used (the one that lost the race, or late answers to a request
+        # abandoned at its deadline) were billed too. hedge_reservation is None if nothing
+        # was hedged; the answers are then charged without one.
+        if hedge_reservation is not None and not unused_responses:
+            token_budget.release(hedge_reservation)
+            return 0.0
+        cost = 0.0
+        for number, unused_response in enumerate(unused_responses):
+            usage = usage_from_response(unused_response)
+            rate_limiter.record_usage(estimated_tokens, usage["total_tokens"])
+            if number == 0 and hedge_reservation is not None:
+                unused_cost = token_budget.settle(hedge_reservation, usage)
+            else:
+                unused_cost = token_budget.charge(usage, backend.pricing)
+            if ledger_key:
+                token_ledger.add(ledger_key, **{f"discarded_{name}": value for name, value in usage.items()},
+                                 discarded_cost_usd=unused_cost)
+            cost += unused_cost
+        return cost
+
+    def generate(generation_config, **options):
+        if hedger.deadline_seconds:
+            options["request_options"] = {"timeout": hedger.deadline_seconds} # Also ends a hung connection
+        return backend.generate(
+            student_part, # The backend adds the shared prefix (or uses its cached copy)
+            # Optional: Add safety settings if needed, balancing safety and utility
+            # safety_settings=[
+            #     {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_LOW_AND_ABOVE"}, # Stricter
+            #     {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_LOW_AND_ABOVE"}, # Stricter
+            #     {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+            #     {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+            # ]
+            generation_config=generation_config, # See the Model Configuration section
+            **options,
+        )
 
-**Student Identifier:** {{student_identifier_placeholder}}
+    try:
+        response = retry_policy.call(call_api, log, on_backoff=lambda delay: metrics.record("retry_backoff", delay))
+    except BaseException:
+        token_budget.release(reservation) # Failed requests aren't billed
+        raise
+    usage = usage_from_response(response)
+    cost = token_budget.settle(reservation, usage)
+    # Correct the token bucket with what the request really cost
+    rate_limiter.record_usage(estimated_tokens, usage["total_tokens"])
+    return response, usage, cost
+
+
+def response_feedback_text(response, log):
+    # The response's text, or "" if it is blocked/empty
+    feedback_text = ""
+    try:
+        # Accessing response text safely - check candidate parts
+        feedback_text = response_text(response)
 
-**Student Paper Text:**
-{{paper_text_placeholder}}
+    except AttributeError:
+         # Handle cases where .text might not exist if response failed early
+         log("  Warning: Could not directly access .text attribute in API response.")
+         feedback_text = "" # Ensure it's empty
+    except Exception as resp_err:
+         log(f"  Warning: Could not extract text from API response parts. Error: {resp_err}")
+         feedback_text = "" # Ensure it's empty
+    return feedback_text
 
-**Generate the feedback letter now, following all instructions carefully:**
-"""
 
-# --- Processing Loop ---
-print(f"\n--- Starting Batch Feedback Generation ---")
+def per_paper_output(student_identifier):
+    # True if the student has more than one paper in this run, so each paper's output files
+    # are named after the paper rather than the student (see results_store.output_name)
+    return len(student_papers.get(student_identifier, ())) > 1
 
-try:
-    # List files, ignore hidden files/folders
-    paper_files = [f for f in os.listdir(papers_folder) if os.path.isfile(os.path.join(papers_folder, f)) and not f.startswith('.')]
-except FileNotFoundError:
-    print(f"Error: Input folder '{papers_folder}' not found.")
-    sys.exit(1)
 
-if not paper_files:
-    print(f"No files found in the '{papers_folder}' folder.")
-    sys.exit(0)
+def feedback_path(job):
+    name = output_name(job["filename"], job["student_identifier"], per_paper_output(job["student_identifier"]))
+    return os.path.join(output_folder, f"{name}_feedback.txt")
 
-total_files = len(paper_files)
-processed_count = 0
-error_count = 0
 
-print(f"Found {total_files} files to process in '{papers_folder}'. Outputting to '{output_folder}'.")
-
-for index, filename in enumerate(paper_files):
-    print("-" * 50) # Separator for clarity
-    print(f"Processing file {index + 1}/{total_files}: {filename}")
+def saved_letter(filename):
+    # The letter saved for a paper (in this or an earlier run), or None
+    if results_store:
+        row = results_store.get(filename)
+        return row["feedback"] if row and row["status"] == "success" else None
+    identifier = identifier_from_filename(filename) or DEFAULT_IDENTIFIER
+    try:
+        with open(feedback_path({"filename": filename, "student_identifier": identifier}), 'r', encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def save_result(job, status, **fields):
+    # Saves one outcome: as a row in the results store, or as its own file in the output folder.
+    # Returns the path of the file written (None with a store).
+    row = {"file": job["filename"], "student_identifier": job["student_identifier"], "status": status, **fields,
+           "output_name": output_name(job["filename"], job["student_identifier"], per_paper_output(job["student_identifier"]))}
+    if results_store:
+        paper = token_ledger.get(job["filename"])
+        timings = {name: paper[name] for name in ("time_to_first_token_s", "generation_s") if name in paper}
+        if "api_started" in job:
+            timings["processing_s"] = round(time.perf_counter() - job["api_started"], 3)
+        results_store.add({**{name: paper.get(name) for name in ("model", "prompt_tokens", "output_tokens",
+                                                                 "cached_tokens", "cost_usd")},
+                           **row, "timings": timings, "prompt_version": current_prompt_version})
+        return None
+    name, contents = output_file(row)
+    path = os.path.join(output_folder, name)
+    write_output(path, contents)
+    return path
+
+
+def generate_and_save(job, log, allow_defer=True):
+    # Sends one prepared prompt to the API and saves the result. Returns "success", "error",
+    # "blocked" (blocked or empty response) or "deferred" (retryable failure parked in
+    # deferred_queue; only when allow_defer is True).
+    filename = job["filename"]
+    student_identifier = job["student_identifier"]
+    student_part = job["student_prompt"]
 
-    full_text = ""
-    student_identifier = "Unknown_Student" # Default identifier
+    try:
+        # --- Reuse a cached response for an identical request ---
+        if response_cache:
+            with metrics.timer("response_cache_lookup"):
+                cached = cached_response(job)
+            if cached:
+                log("  Using cached response (identical request already answered).")
+                token_ledger.record(filename, student_identifier=student_identifier, cached_response=True)
+                return save_feedback(job, cached["feedback_text"], log)
+
+        # --- Measure the prompt and pick the model ---
+        with metrics.timer("token_count") as sample:
+            input_tokens = sample["tokens"] = token_counter.count(student_part)
+        token_ledger.record(filename, student_identifier=student_identifier, estimated_input_tokens=input_tokens)
+        backend = router.first(input_tokens)
+        if backend is not router.primary:
+            log(f"  Long paper (~{input_tokens} tokens): using {backend.model_name}.")
+        if SECTIONS_ABOVE_TOKENS and input_tokens > SECTIONS_ABOVE_TOKENS:
+            # The letter is written from section notes instead of the whole paper
+            student_part = read_in_sections(job, log)
+            if student_part is None:
+                return skip_over_budget(job, input_tokens, log)
+            input_tokens = token_counter.count(student_part)
+
+        feedback_text = ""
+        stream = None
+        while True:
+            # --- Check the request against the run's budget ---
+            reservation = None
+            if not budget_exhausted.is_set():
+                reservation = token_budget.reserve(input_tokens, EXPECTED_OUTPUT_TOKENS, backend.pricing)
+            if reservation is None:
+                if not feedback_text:
+                    return skip_over_budget(job, input_tokens, log)
+                log(f"  Not escalating to {backend.model_name}: it doesn't fit in the run's token/cost budget.")
+                break
+            if stream_responses:
+                # With a results store, the letter is streamed to memory and only the finished one is stored
+                stream = FeedbackStream(None if results_store else feedback_path(job),
+                                        {"{student_identifier}": student_identifier})
+            response, usage, cost = send_request(backend, student_part, input_tokens, reservation, log, stream=stream,
+                                                 ledger_key=filename)
+            token_ledger.add(filename, **usage, cost_usd=cost)
+            token_ledger.record(filename, model=backend.model_name)
+            used_backend = backend
+
+            # --- Extract Feedback ---
+            if stream:
+                # Already written chunk by chunk; move it into place
+                token_ledger.record(filename, **stream.timings)
+                with metrics.timer("save") as sample:
+                    committed = stream.commit()
+                    sample["bytes"] = stream.characters
+                feedback_text = stream.text if committed else ""
+            else:
+                feedback_text = response_feedback_text(response, log)
+            if feedback_text:
+                checked_text = check_letter(job, feedback_text, backend, student_part, log)
+                if checked_text != feedback_text:
+                    feedback_text, stream = checked_text, None # Saved below, over the streamed version
+
+            # --- Escalate to the better model if the letter fails the output checks ---
+            problems = router.check(feedback_text) if feedback_text else []
+            escalation = router.escalation_for(backend) if problems else None
+            if escalation is None:
+                break
+            log(f"  Letter from {backend.model_name} failed the output checks ({'; '.join(problems)}). "
+                f"Escalating to {escalation.model_name}.")
+            token_ledger.record(filename, escalated=True)
+            backend = escalation
+
+        # Check if feedback is empty or blocked
+        if feedback_text:
+            if problems:
+                log(f"  Warning: The letter still fails the output checks ({'; '.join(problems)}). Saved anyway - review it closely.")
+            if response_cache and used_backend.cacheable:
+                response_cache.put(job_cache_key(job, used_backend.model_name), feedback_text, model=used_backend.model_name)
+            if stream:
+                if results_store:
+                    save_result(job, "success", feedback=feedback_text)
+                log(f"  Streamed feedback to {f'{stream.path!r}' if stream.path else 'the results store'} "
+                    f"(first token after {stream.timings['time_to_first_token_s']:.1f}s, done after {stream.timings['generation_s']:.1f}s)")
+                return "success"
+            return save_feedback(job, feedback_text, log)
+        else:
+            # Handle blocked prompts or genuinely empty responses
+            try:
+                # Log safety feedback if available
+                block_reason = response.prompt_feedback.block_reason
+                safety_ratings = response.prompt_feedback.safety_ratings
+            except Exception:
+                block_reason = safety_ratings = None
+            return save_blocked_or_empty(job, block_reason, safety_ratings, log)
+
+    except RetriesExhausted as exhausted:
+        if allow_defer:
+            # Quota or overload that outlasted our backoff - try again at the end of the run.
+            log(f"  Still failing after {exhausted.attempts} attempts ({exhausted.last_error}). Deferring to the end of the run.")
+            deferred_queue.put(job, exhausted.retry_after)
+            return "deferred"
+        return save_api_error(job, exhausted.last_error, log)
+    except Exception as api_error:
+        return save_api_error(job, api_error, log)
+
+
+def check_letter(job, letter, backend, student_part, log):
+    # Checks a letter against the feedback template and has failing sections rewritten.
+    # Returns the letter to keep (the original one if it passes or can't be repaired).
+    if not letter_template or backend.name == "local": # Placeholder letters have no sections
+        return letter
+    problems = letter_template.check(letter)
+    if not problems:
+        return letter
+    log(f"  Letter doesn't follow the template: {describe_problems(problems)}.")
+    names = [name for name, _ in problems if name]
+    if not REPAIR_SECTIONS or not names:
+        return letter
+
+    repair_part = student_part + letter_template.render_repair(letter, names)
+    input_tokens = token_counter.count(repair_part)
+    expected_output_tokens = REPAIR_OUTPUT_TOKENS * len(names)
+    reservation = None
+    if not budget_exhausted.is_set():
+        reservation = token_budget.reserve(input_tokens, expected_output_tokens, backend.pricing)
+    if reservation is None:
+        log("  Not repairing: the request doesn't fit in the run's token/cost budget.")
+        return letter
+    log(f"  Requesting only these sections again: {', '.join(names)}")
+    try:
+        with metrics.timer("section_repair"):
+            response, usage, cost = send_request(backend, repair_part, input_tokens, reservation, log,
+                                                 expected_output_tokens=expected_output_tokens, ledger_key=job["filename"])
+    except Exception as repair_error:
+        log(f"  Section repair failed ({repair_error}); keeping the letter as written.")
+        return letter
+    token_ledger.add(job["filename"], **usage, cost_usd=cost)
+    repaired = letter_template.repair(letter, response_feedback_text(response, log), names)
+    remaining = letter_template.check(repaired)
+    if len(remaining) >= len(problems):
+        log("  The rewritten sections didn't help; keeping the letter as written.")
+        return letter
+    token_ledger.record(job["filename"], repaired_sections=names)
+    if remaining:
+        log(f"  Repaired some sections; still: {describe_problems(remaining)}.")
+    else:
+        log("  Repaired: the letter now follows the template.")
+    return repaired
+
+
+def describe_problems(problems):
+    return "; ".join(f"{name}: {problem}" if name else problem for name, problem in problems)
+
+
+def read_in_sections(job, log):
+    # Map step for a long paper: sends its sections (in parallel, to the primary model) for
+    # reading notes. Returns the student part of the final request, or None if the sections
+    # don't fit in the budget. The budget for all sections, and room for the letter written from
+    # their notes, is reserved before any section is sent, so that a paper isn't left half read
+    # when the budget runs out (the caller records it as over budget). API errors are raised
+    # like those of any other request; sections not sent by then give their reservations back.
+    filename = job["filename"]
+    sections = split_sections(job["paper_text"], SECTION_MAX_TOKENS)
+    backend = router.primary
+    # Room for the final request: roughly the notes plus the letter
+    letter_room = None
+    if not budget_exhausted.is_set():
+        letter_room = token_budget.reserve(len(sections) * SECTION_NOTES_TOKENS, EXPECTED_OUTPUT_TOKENS, backend.pricing)
+    if letter_room is None:
+        return None
+    requests = [] # (section part, input tokens, reservation)
+    for number, section_text in enumerate(sections, start=1):
+        section_part = render_section(job["student_identifier"], number, len(sections), section_text)
+        input_tokens = token_counter.count(section_part)
+        reservation = None
+        if not budget_exhausted.is_set():
+            reservation = token_budget.reserve(input_tokens, SECTION_NOTES_TOKENS, backend.pricing)
+        if reservation is None:
+            for reserved in [letter_room] + [reserved for _, _, reserved in requests]:
+                token_budget.release(reserved)
+            return None
+        requests.append((section_part, input_tokens, reservation))
+    log(f"  Long paper: reading it in {len(sections)} sections before writing the letter.")
+    failed = threading.Event()
+
+    def read_section(section_part, input_tokens, reservation):
+        if failed.is_set():
+            token_budget.release(reservation) # Not sent: another section has failed
+            return None
+        try:
+            response, usage, cost = send_request(backend, section_part, input_tokens, reservation, log,
+                                                 expected_output_tokens=SECTION_NOTES_TOKENS, ledger_key=filename)
+        except Exception:
+            failed.set()
+            raise
+        token_ledger.add(filename, **usage, cost_usd=cost)
+        return response_feedback_text(response, log)
 
+    try:
+        with metrics.timer("sections"), ThreadPoolExecutor(max_workers=min(SECTION_WORKERS, len(sections))) as section_pool:
+            notes = list(section_pool.map(lambda request: read_section(*request), requests))
+    finally:
+        token_budget.release(letter_room) # The letter's request reserves its own budget next
+    token_ledger.record(filename, sections=len(sections))
+    return render_reduce(job["student_identifier"], notes)
+
+
+def skip_over_budget(job, input_tokens, log):
+    if BUDGET_ACTION == "stop" and not budget_exhausted.is_set():
+        budget_exhausted.set()
+        log("!! Token/cost budget reached - no further requests will be sent in this run.")
+    log(f"  Not sent: ~{input_tokens} input tokens would exceed the run's token/cost budget. "
+        "It will be processed on the next run.")
+    token_ledger.record(job["filename"], over_budget=True)
+    return "over_budget"
+
+
+def save_feedback(job, feedback_text, log):
+    # The model occasionally copies the template's "Dear {student_identifier}," verbatim
+    feedback_text = feedback_text.replace("{student_identifier}", job["student_identifier"])
+    with metrics.timer("save", bytes=len(feedback_text.encode('utf-8'))):
+        output_filename = save_result(job, "success", feedback=feedback_text)
+    if output_filename:
+        log(f"  Successfully generated and saved feedback to '{output_filename}'")
+    else:
+        log("  Successfully generated feedback (saved in the results store)")
+    return "success"
+
+
+def save_blocked_or_empty(job, block_reason, safety_ratings, log):
+    # block_reason/safety_ratings are None if the response had no safety feedback at all
+    filename = job["filename"]
+    log(f"  Warning: No feedback content generated for {filename}.")
+    if block_reason is not None:
+        log(f"    Block Reason (if any): {block_reason}")
+        log(f"    Safety Ratings: {safety_ratings}")
+        save_result(job, "blocked", block_reason=str(block_reason), safety_ratings=str(safety_ratings))
+    else:
+        log("    Could not retrieve detailed safety/block feedback from response.")
+        save_result(job, "empty")
+    return "blocked"
+
+
+def save_api_error(job, api_error, log):
+    filename = job["filename"]
+    error_kind = classify_error(api_error)
+    log(f"!! Error during API call or response processing for {filename} ({error_kind}): {api_error}")
+    save_result(job, "api_error", error=str(api_error), error_kind=error_kind)
+    return "error"
+
+
+def extract_student_identifier(filename, log):
     # --- Extract Student Identifier (Handles username_ID_ID_OriginalName.ext) ---
+    identifier = DEFAULT_IDENTIFIER
     try:
-        base_name = os.path.splitext(filename)[0] # Remove extension
-        parts = base_name.split('_', 1) # Split only at the first underscore
-        if parts and parts[0].strip():
-            student_identifier = parts[0].strip()
-        elif base_name.strip(): # Fallback if no underscore
-             student_identifier = base_name.strip()
-        else:
-             print(f"  Warning: Could not extract a valid identifier from filename. Using default.")
-        print(f"  Extracted Identifier: {student_identifier}")
+        identifier = identifier_from_filename(filename)
+        if identifier is None:
+            log(f"  Warning: Could not extract a valid identifier from filename. Using default.")
+            identifier = DEFAULT_IDENTIFIER
+        log(f"  Extracted Identifier: {identifier}")
     except Exception as e:
-        print(f"  Warning: Error extracting identifier from filename '{filename}'. Using default. Error: {e}")
-
-    filepath = os.path.join(papers_folder, filename)
-    file_processed = False # Flag for rate limiting
-
-    # --- Read File Content based on extension ---
+        log(f"  Warning: Error extracting identifier from filename '{filename}'. Using default. Error: {e}")
+    return identifier
+
+
+def prepare_job(filename, extraction, log):
+    # Turns an extraction result into a job for the API stage.
+    # Returns the job dict, or an outcome ("error"/"skipped") if there is nothing to send.
+    log(f"Processing file: {filename}")
+    with metrics.timer("filename_parsing"):
+        student_identifier = extract_student_identifier(filename, log)
+    submission = parse_submission_name(filename)
+    if submission and submission["late"]:
+        log("  Canvas marks this submission as late.")
+    for message in extraction["messages"]:
+        log(message)
+
+    if extraction["status"] == "unsupported":
+        # Not counted as an error, just skipped.
+        return "skipped"
+    if extraction["status"] == "exception":
+        log(f"!! Unexpected error processing file {filename} before API call: {extraction['error']}")
+        if offline_mode == "dry-run":
+            return "error"
+        save_result({"filename": filename, "student_identifier": student_identifier}, "file_error", error=extraction["error"])
+        return "error"
+    if extraction["status"] != "ok":
+        return "error"
+
+    # --- If text was extracted successfully ---
+    full_text = extraction["text"]
+    log(f"  Extracted text length: ~{len(full_text)} characters.")
+    # --- Prepare the per-student part of the prompt (base_prompt is shared by all papers) ---
+    with metrics.timer("prompt_build") as sample:
+        student_part = prompt_template.render_student_part(student_identifier=student_identifier, paper_text=full_text)
+        sample["bytes"] = len(student_part.encode('utf-8'))
+        sample["tokens"] = estimate_tokens(student_part)
+
+    return {"filename": filename, "student_identifier": student_identifier, "student_prompt": student_part,
+            "paper_text": full_text, "prepared_at": time.perf_counter()}
+
+
+# How each outcome is recorded in the manifest
+MANIFEST_OUTCOMES = {"success": "success", "blocked": "blocked", "error": "failed", "skipped": "skipped",
+                     "over_budget": "over_budget"}
+
+
+def record_outcome(filename, outcome):
+    # Called from the main thread and from API workers, so counters and manifest share a lock.
+    if outcome == "deferred":
+        return # Recorded when the deferred queue is drained
+    with results_lock:
+        if outcome == "success":
+            counts["success"] += 1
+            if filename in queued_at:
+                token_ledger.record(filename, time_to_feedback_s=round(time.monotonic() - queued_at[filename], 3))
+        elif outcome in ("error", "blocked"):
+            counts["error"] += 1
+        elif outcome == "over_budget":
+            counts["over_budget"] += 1
+        if offline_mode:
+            return # The next real run still has to process the paper
+        manifest.record(filename, fingerprints[filename], current_prompt_version, MANIFEST_OUTCOMES[outcome])
+        leased_identifier = leased.pop(filename, None)
+    if leased_identifier:
+        leases.release(leased_identifier, filename, outcome=MANIFEST_OUTCOMES[outcome])
+    if similarity_index:
+        release_duplicates(filename, outcome)
+
+
+def index_paper(job, log):
+    # Adds the paper to the similarity index. Returns True if it is not to be sent because it
+    # duplicates another paper (its outcome is recorded now or when that paper finishes).
+    original, similar = similarity_index.add(job["filename"], job["paper_text"])
+    for other, similarity in similar[:3]:
+        log(f"  Note: ~{similarity:.0%} of the text matches {other} (possible duplicate work).")
+    if original is None:
+        return False
+    log(f"  Note: Same text as {original}.")
+    if original in previous_papers:
+        # Only reused for the same student: the earlier letter may have been edited since
+        letter = saved_letter(original) if identifier_from_filename(original) == job["student_identifier"] else None
+        if letter is not None:
+            log(f"  Not sent: {job['student_identifier']}'s letter was written for the same text in an earlier run.")
+            if per_paper_output(job["student_identifier"]):
+                save_feedback(job, letter, log) # Each of the student's papers has its own letter file
+            token_ledger.record(job["filename"], duplicate_of=original)
+            record_outcome(job["filename"], "success")
+            return True
+        return False
+    if not REUSE_DUPLICATE_FEEDBACK:
+        return False
+    with duplicates_lock:
+        group = duplicate_groups.setdefault(original, {"outcome": None, "followers": []})
+        if group["outcome"] is None:
+            log("  Not sent: waiting for its letter instead.")
+            group["followers"].append((job, log))
+            return True
+    return finish_duplicate(job, log, original, group["outcome"]) # If not, it is sent like any other paper
+
+
+def release_duplicates(filename, outcome):
+    # Called once a paper's outcome is known: finishes the exact duplicates waiting for it
+    with duplicates_lock:
+        group = duplicate_groups.setdefault(filename, {"outcome": None, "followers": []})
+        group["outcome"] = outcome
+        followers, group["followers"] = group["followers"], []
+    for job, log in followers:
+        if not finish_duplicate(job, log, filename, outcome):
+            # Sent from here (usually an API worker); not deferred, as the deferred queue
+            # may already have been drained
+            api_stage(job, log, allow_defer=False)
+
+
+def finish_duplicate(job, log, original, outcome):
+    # Gives an exact duplicate the outcome of the paper it duplicates, and a copy of its letter.
+    # Returns False (and records nothing) if that letter can't be read, e.g. it was removed;
+    # the paper then has to be sent on its own.
+    original_identifier = identifier_from_filename(original) or DEFAULT_IDENTIFIER
+    if outcome == "success" and (original_identifier != job["student_identifier"] or per_paper_output(original_identifier)):
+        original_letter = saved_letter(original)
+        if original_letter is None:
+            log(f"  The letter for {original} can't be read; sending this paper on its own.")
+            return False
+        letter = re.sub(rf"\b{re.escape(original_identifier)}\b", job["student_identifier"], original_letter)
+        log(f"  Reusing the letter for {original} (same text).")
+        outcome = save_feedback(job, letter, log)
+    elif outcome == "success":
+        log(f"  Same student and text as {original}: {job['student_identifier']}'s letter covers both.")
+    else:
+        log(f"  Not sent: {original} (same text) ended as '{outcome}'.")
+    token_ledger.record(job["filename"], duplicate_of=original)
+    record_outcome(job["filename"], outcome)
+    return True
+
+
+def worker_filename(path):
+    # Worker mode: files each worker writes on its own (reports, text cache) get its name
+    if not worker_id:
+        return path
+    stem, extension = os.path.splitext(path)
+    return f"{stem}.{worker_id}{extension}"
+
+
+def claim_paper(filename):
+    # Worker mode: leases the paper's student. Returns True if this worker is to process it.
+    identifier = identifier_from_filename(filename) or DEFAULT_IDENTIFIER
+    details = {"file": filename, "sha256": fingerprints[filename]["sha256"], "prompt_version": current_prompt_version}
+    state = leases.claim(identifier, details, finished=FINISHED_OUTCOMES)
+    if state == "claimed":
+        leased[filename] = identifier
+        return True
+    if state == "busy":
+        lease_waiting.append(filename)
+    else:
+        with results_lock:
+            counts["other_workers"] += 1 # Finished by another worker
+    return False
+
+
+def record_queue_wait(job):
+    # Time from the prompt being ready to an API worker picking it up (first attempt only)
+    prepared_at = job.pop("prepared_at", None)
+    if prepared_at is not None:
+        job["api_started"] = time.perf_counter()
+        metrics.record("queue_wait", job["api_started"] - prepared_at)
+
+
+def api_stage(job, log, allow_defer=True):
+    record_queue_wait(job)
     try:
-        if filename.lower().endswith(".docx"):
-            print("  Reading DOCX file...")
-            doc = Document(filepath)
-            paragraphs = [para.text for para in doc.paragraphs if para.text.strip()]
-            full_text = "\n\n".join(paragraphs) # Use double newline for better paragraph separation
-            if not full_text:
-                print(f"  Warning: No text extracted from DOCX file or file is empty.")
-                error_count += 1
-                continue
-
-        elif filename.lower().endswith(".pdf"):
-            print("  Reading PDF file...")
-            text_list = []
-            try:
-                with open(filepath, 'rb') as pdf_file:
-                    reader = PyPDF2.PdfReader(pdf_file)
-                    # Check for encryption
-                    if reader.is_encrypted:
-                        try:
-                            # Try decrypting with empty password (common case)
-                            if reader.decrypt('') == PyPDF2.PasswordType.NOT_DECRYPTED:
-                                print(f"  Warning: Skipping password-protected PDF: {filename}")
-                                error_count += 1
-                                continue # Skip this file
-                        except Exception as decrypt_err:
-                             print(f"  Warning: Skipping encrypted PDF (decryption failed): {filename} - {decrypt_err}")
-                             error_count += 1
-                             continue
-
-                    num_pages = len(reader.pages)
-                    # print(f"  Found {num_pages} page(s). Extracting text...") # Optional verbosity
-                    for page_num in range(num_pages):
-                        try:
-                            page = reader.pages[page_num]
-                            extracted = page.extract_text()
-                            if extracted:
-                                text_list.append(extracted.strip())
-                        except Exception as page_error:
-                             print(f"    Warning: Error extracting text from PDF page {page_num + 1}: {page_error}")
-                full_text = "\n\n".join(text_list).strip() # Join pages with double newline
-                if not full_text:
-                    print(f"  Warning: No text extracted from PDF (check if image-based or complex).")
-                    error_count += 1
+        outcome = generate_and_save(job, log, allow_defer)
+    except Exception as worker_error:
+        # generate_and_save handles its own errors; this is only a safety net.
+        log(f"!! Worker crashed while processing {job['filename']}: {worker_error}")
+        outcome = "error"
+    record_outcome(job["filename"], outcome)
+    return outcome
+
+
+def generate_pack(jobs, log):
+    # Sends several short papers as one request with JSON output (always to the primary model).
+    # Returns {student_identifier: feedback letter} for the papers the response covers cleanly.
+    backend = router.primary
+    identifiers = [job["student_identifier"] for job in jobs]
+    pack_part = render_pack(jobs)
+    input_tokens = token_counter.count(pack_part)
+    expected_output_tokens = EXPECTED_OUTPUT_TOKENS * len(jobs)
+    reservation = None
+    if not budget_exhausted.is_set():
+        reservation = token_budget.reserve(input_tokens, expected_output_tokens, backend.pricing)
+    if reservation is None:
+        log("  The packed request doesn't fit in the remaining budget.")
+        return {}
+
+    response, usage, cost = send_request(backend, pack_part, input_tokens, reservation, log,
+                                         pack_generation_config(GENERATION_CONFIG, identifiers), expected_output_tokens,
+                                         ledger_key=jobs[0]["filename"])
+    # Share the request's usage between its papers, in proportion to their length
+    total_chars = sum(len(job["paper_text"]) for job in jobs) or 1
+    for job in jobs:
+        share = len(job["paper_text"]) / total_chars
+        token_ledger.add(job["filename"], student_identifier=job["student_identifier"], packed_papers=len(jobs),
+                         **{name: round(value * share) for name, value in usage.items()}, cost_usd=cost * share)
+        token_ledger.record(job["filename"], model=backend.model_name)
+
+    letters, missing = split_packed_response(response_feedback_text(response, log), identifiers)
+    if missing:
+        log(f"  No usable letter in the packed response for: {', '.join(missing)}")
+    return letters
+
+
+def pack_stage(pack):
+    # API worker for a pack of (job, log) pairs. Each letter is saved like a single-paper
+    # response; papers without one (or all of them, if the packed request failed), and letters
+    # that fail the output checks when routing is on, are sent again on their own.
+    log = make_logger(f"pack of {len(pack)}")
+    for job, _ in pack:
+        record_queue_wait(job)
+    log(f"Sending {len(pack)} short papers in one request: {', '.join(job['filename'] for job, _ in pack)}")
+    try:
+        letters = generate_pack([job for job, _ in pack], log)
+    except Exception as pack_error:
+        log(f"  Packed request failed ({pack_error}). Sending these papers individually.")
+        letters = {}
+
+    for job, job_log in pack:
+        feedback_text = letters.get(job["student_identifier"])
+        if not feedback_text:
+            job_log("  Not covered by the packed response; sending this paper on its own.")
+            api_stage(job, job_log)
+            continue
+        feedback_text = check_letter(job, feedback_text, router.primary, job["student_prompt"], job_log)
+        problems = router.check(feedback_text)
+        if problems:
+            job_log(f"  Letter in the packed response failed the output checks ({'; '.join(problems)}); "
+                    "sending this paper on its own.")
+            api_stage(job, job_log)
+            continue
+        job_log("  Feedback letter taken from the packed response.")
+        try:
+            if response_cache and router.primary.cacheable:
+                response_cache.put(job_cache_key(job, router.primary.model_name), feedback_text,
+                                   model=router.primary.model_name, packed=True)
+            outcome = save_feedback(job, feedback_text, job_log)
+        except Exception as save_error:
+            job_log(f"!! Could not save the feedback letter for {job['filename']}: {save_error}")
+            outcome = "error"
+        record_outcome(job["filename"], outcome)
+
+
+def retry_deferred(retry_after, job):
+    wait_until(retry_after) # Honour the longest backoff / server-requested delay first
+    log = make_logger(f"retry {job['filename']}")
+    log("Retrying deferred request...")
+    return api_stage(job, log, allow_defer=False)
+
+
+def extraction_profile_path(filename):
+    # Per-paper cProfile dump, merged into one profile at the end of the run
+    return os.path.join(output_folder, f".{filename}.extraction.prof") if profile_extraction == "cprofile" else None
+
+
+def record_extraction(filename, extraction, measurement):
+    # Papers read from an archive have no file to measure
+    metrics.record("extraction", measurement["seconds"], bytes=measurement["bytes"] or fingerprints[filename]["size"])
+    metrics.record("extraction_cpu", measurement["cpu_seconds"])
+    for page in extraction.get("pages", []):
+        metrics.record("pdf_page_failed" if "error" in page else "pdf_page", page["seconds"])
+    if profile_extraction == "tracemalloc":
+        extraction_profiles.append({"file": filename, **measurement})
+
+
+def prepared_jobs(files_to_process):
+    # Stages 1 and 2: yields (job, log) for every paper that is ready for the API.
+    # Papers that end here (unsupported, unreadable) have their outcome recorded directly.
+    # Extraction only runs a little ahead of the consumer, which gives the API stage backpressure.
+    total = len(files_to_process)
+    pending_files = iter(enumerate(files_to_process))
+    extractions = {} # future -> (index, filename)
+
+    if EXTRACTION_WORKERS > 0:
+        extraction_pool = ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS)
+        max_extractions_in_flight = EXTRACTION_WORKERS * 2
+    else:
+        extraction_pool = ThreadPoolExecutor(max_workers=1)
+        max_extractions_in_flight = 1
+
+    def ready(index, filename, extraction):
+        log = make_logger(f"{index + 1}/{total}")
+        job = prepare_job(filename, extraction, log)
+        if isinstance(job, str):
+            record_outcome(filename, job)
+            return None
+        return job, log
+
+    with extraction_pool:
+        while True:
+            # Keep the extraction workers busy, without parsing the whole folder up front
+            while len(extractions) < max_extractions_in_flight:
+                next_file = next(pending_files, None)
+                if next_file is None:
+                    break
+                index, filename = next_file
+                if leases and not claim_paper(filename):
+                    continue
+                cached = None
+                if text_cache and not profile_extraction:
+                    with metrics.timer("text_cache_lookup"):
+                        cached = text_cache.get(fingerprints[filename]["sha256"])
+                if cached:
+                    prepared = ready(index, filename, cached)
+                    if prepared:
+                        yield prepared
                     continue
-            except ImportError as ie:
-                 print(f"  Error: PyPDF2 dependency possibly missing or corrupt: {ie}")
-                 print(f"  Try: pip install --upgrade PyPDF2")
-                 error_count +=1
-                 continue
-            except Exception as pdf_err:
-                print(f"  Error reading PDF file structure {filename}: {pdf_err}")
-                error_count += 1
+                if archive:
+                    extract = functools.partial(extract_member, archive.path, limits=extraction_limits)
+                    source = archive.member_name(filename)
+                else:
+                    extract = functools.partial(extract_text, limits=extraction_limits)
+                    source = os.path.join(papers_folder, filename)
+                future = extraction_pool.submit(measured_call, extract, source, profile_extraction,
+                                                extraction_profile_path(filename))
+                extractions[future] = next_file
+            if not extractions:
+                break
+
+            done, _ = wait(extractions, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, filename = extractions.pop(future)
+                try:
+                    extraction, measurement = future.result()
+                    record_extraction(filename, extraction, measurement)
+                except Exception as pool_error:
+                    # e.g. a worker process died (out of memory on a huge PDF)
+                    extraction = {"status": "exception", "text": "", "messages": [], "warnings": [], "error": str(pool_error)}
+                if text_cache:
+                    text_cache.put(fingerprints[filename]["sha256"], extraction)
+                prepared = ready(index, filename, extraction)
+                if prepared:
+                    yield prepared
+
+
+def run_pipeline(files_to_process, pack=False):
+    # Interactive mode: stage 3 is a pool of API worker threads, fed through a bounded number
+    # of slots (one per worker plus PROMPT_QUEUE_DEPTH waiting prompts).
+    # With pack=True, short papers are grouped and each group takes a single slot.
+    api_slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS + PROMPT_QUEUE_DEPTH)
+    packer = Packer(PACK_MAX_PAPERS, PACK_MAX_INPUT_TOKENS) if pack else None
+    logs = {} # filename -> log, for papers waiting in the packer
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as api_pool:
+        def submit(stage, *stage_args):
+            api_slots.acquire() # Blocks while the API stage is full
+            api_future = api_pool.submit(stage, *stage_args)
+            api_future.add_done_callback(lambda _: api_slots.release())
+
+        def submit_pack(jobs):
+            if len(jobs) == 1: # Nothing to share the prompt with
+                submit(api_stage, jobs[0], logs.pop(jobs[0]["filename"]))
+            elif jobs:
+                submit(pack_stage, [(job, logs.pop(job["filename"])) for job in jobs])
+
+        for job, log in prepared_jobs(files_to_process):
+            if similarity_index and index_paper(job, log):
                 continue
-
+            paper_tokens = estimate_tokens(job["paper_text"])
+            if (packer is None or paper_tokens > PACK_MAX_PAPER_TOKENS
+                    or (response_cache and cached_response(job))):
+                submit(api_stage, job, log)
+                continue
+            logs[job["filename"]] = log
+            for ready_jobs in packer.add(job, paper_tokens):
+                submit_pack(ready_jobs)
+        if packer:
+            submit_pack(packer.flush())
+
+        # --- Drain the deferred retry queue ---
+        # (waits for the API workers first, as anything they defer lands in the queue)
+        api_pool.shutdown(wait=True)
+        deferred = deferred_queue.pop_all()
+        if deferred:
+            print("-" * 50)
+            print(f"Retrying {len(deferred)} deferred request(s) that hit quota/overload errors...")
+            with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as retry_pool:
+                for retry_after, job in deferred:
+                    retry_pool.submit(retry_deferred, retry_after, job)
+
+
+def run_offline(files_to_process):
+    # --extract-only / --dry-run: stages 1 and 2 without the API. --extract-only saves each
+    # paper's text to extracted_text_folder; --dry-run saves nothing and reports the prompts
+    # that would be sent. Returns (papers ready, estimated input tokens, estimated cost).
+    ready = 0
+    total_tokens = 0
+    total_cost = 0.0
+    if offline_mode == "extract-only":
+        os.makedirs(extracted_text_folder, exist_ok=True)
+    for job, log in prepared_jobs(files_to_process):
+        ready += 1
+        record_outcome(job["filename"], "success")
+        if offline_mode == "extract-only":
+            text_path = os.path.join(extracted_text_folder, os.path.splitext(job["filename"])[0] + ".txt")
+            write_output(text_path, job["paper_text"])
+            log(f"  Saved extracted text to '{text_path}'")
+            continue
+        if response_cache and response_cache.get(job_cache_key(job)):
+            log("  Would be answered from the response cache (no request).")
+            continue
+        input_tokens = token_counter.count(job["student_prompt"])
+        cost = token_budget.pricing.cost(input_tokens, EXPECTED_OUTPUT_TOKENS)
+        total_tokens += input_tokens
+        total_cost += cost
+        log(f"  Would send ~{input_tokens} input tokens to {MODEL_NAME} (~${cost:.4f} with ~{EXPECTED_OUTPUT_TOKENS} output tokens).")
+    return ready, total_tokens, total_cost
+
+
+def print_offline_summary(offline_results, total_files, unchanged_count):
+    ready, input_tokens, cost = offline_results
+    print("-" * 50)
+    print(f"\n--- {'Text Extraction' if offline_mode == 'extract-only' else 'Dry Run'} Summary ---")
+    print(f"Total files found in '{papers_source()}': {total_files}")
+    print(f"Unchanged since the last run (not included): {unchanged_count}")
+    print(f"Papers with usable text: {ready}")
+    print(f"Files skipped or with extraction errors: {counts['error']}")
+    if offline_mode == "extract-only":
+        print(f"Extracted text saved in the '{extracted_text_folder}' folder.")
+    else:
+        print(f"Would send ~{input_tokens} input tokens (plus ~{EXPECTED_OUTPUT_TOKENS} output tokens per letter). "
+              f"Estimated cost: ${cost:.4f}")
+    print("Nothing was sent to the API and the manifest is unchanged.")
+
+
+def seed_similarity_index(filenames):
+    # Papers left out of this run (unchanged since an earlier one) are indexed from the text
+    # cache, so new papers are compared with them too
+    if not text_cache:
+        return
+    for filename in filenames:
+        extraction = text_cache.get(fingerprints[filename]["sha256"])
+        if extraction and extraction["status"] == "ok":
+            similarity_index.add(filename, extraction["text"])
+            previous_papers.add(filename)
+
+
+def make_router(backend_name, client, escalation_model_name):
+    # The model backends for interactive runs. client is the genai model from init_model()
+    # (None for the local backend).
+    pricing = Pricing(PRICE_PER_MILLION_INPUT_TOKENS, PRICE_PER_MILLION_OUTPUT_TOKENS, PRICE_PER_MILLION_CACHED_INPUT_TOKENS)
+    if backend_name == "local":
+        print("Using the local backend: feedback letters are placeholders, no API calls are made.")
+        return ModelRouter(LocalBackend(MODEL_NAME, prompt_template, Pricing(0, 0)))
+
+    prefix_cache = NoPrefixCache()
+    if PROMPT_PREFIX_CACHE == "gemini":
+        try:
+            prefix_cache = GeminiPrefixCache(MODEL_NAME, prompt_template, PREFIX_CACHE_TTL_MINUTES, GENERATION_CONFIG)
+            print(f"Cached the shared prompt prefix (~{prompt_template.prefix_tokens} tokens) as Gemini cached content.")
+        except Exception as cache_error:
+            print(f"Warning: Could not set up Gemini context caching ({cache_error}).")
+            print("Sending the full prompt with every request instead.")
+    primary = GeminiBackend(MODEL_NAME, prompt_template, pricing, prefix_cache, client)
+
+    escalation = None
+    if escalation_model_name:
+        escalation_pricing = Pricing(ESCALATION_PRICE_PER_MILLION_INPUT_TOKENS, ESCALATION_PRICE_PER_MILLION_OUTPUT_TOKENS)
+        escalation = GeminiBackend(escalation_model_name, prompt_template, escalation_pricing)
+        print(f"Escalating long papers and letters that fail the output checks to: {escalation_model_name}")
+    return ModelRouter(primary, escalation, ESCALATE_ABOVE_TOKENS, MIN_FEEDBACK_CHARS)
+
+
+def papers_source():
+    return archive.path if archive else papers_folder
+
+
+def list_papers():
+    # The papers in the archive or folder (hidden files left out)
+    if archive:
+        return archive.names()
+    return [f for f in os.listdir(papers_folder) if os.path.isfile(os.path.join(papers_folder, f)) and not f.startswith('.')]
+
+
+def current_papers(paper_files):
+    # The papers to consider among paper_files (the whole folder): each student's latest attempt,
+    # or every file with --all-attempts. Rebuilds student_papers from them, so output names
+    # follow the files the folder holds now.
+    if not all_attempts:
+        paper_files, replaced = latest_attempts(paper_files)
+        superseded.update(replaced)
+    papers = {}
+    for filename in paper_files:
+        superseded.pop(filename, None)
+        papers.setdefault(identifier_from_filename(filename) or DEFAULT_IDENTIFIER, set()).add(filename)
+    student_papers.clear()
+    student_papers.update(papers)
+    return paper_files
+
+
+def paper_length(filename):
+    # The work a paper is, in characters: counted from the text cache when the file was
+    # extracted before, else estimated from its file size and type (see Work Scheduling)
+    extraction = text_cache.get(fingerprints[filename]["sha256"]) if text_cache else None
+    if extraction and extraction["status"] == "ok":
+        return len(extraction["text"])
+    return estimated_chars(filename, fingerprints[filename]["size"])
+
+
+def select_files(paper_files):
+    # Fingerprints the papers and returns those that need processing
+    # (everything, or only new/changed/failed papers with ONLY_PROCESS_CHANGED),
+    # in the order they are to be processed (see Work Scheduling)
+    files_to_process = []
+    for filename in paper_files:
+        if archive:
+            fingerprints[filename] = manifest.archive_fingerprint(filename, archive)
         else:
-            print(f"  Skipping unsupported file type: {filename}")
-            # Not counted as an error, just skipped.
+            fingerprints[filename] = manifest.fingerprint(filename, os.path.join(papers_folder, filename))
+        if ONLY_PROCESS_CHANGED and manifest.is_up_to_date(filename, fingerprints[filename], current_prompt_version):
+            continue
+        files_to_process.append(filename)
+    files_to_process = order_papers(files_to_process, paper_length, schedule, SHORTEST_FIRST)
+    now = time.monotonic()
+    for filename in files_to_process:
+        queued_at[filename] = now
+    return files_to_process
+
+
+def watch_papers(watcher, pack, on_round):
+    # Processes submissions as they land in papers_folder until Ctrl+C.
+    # Returns the files processed; on_round() is called after each round (e.g. to update reports).
+    processed = []
+    print("-" * 50)
+    print(f"Watching '{papers_folder}' for new or changed submissions ({watcher.mode}). Press Ctrl+C to stop.")
+    try:
+        while True:
+            changed = watcher.wait()
+            # Re-uploads replace earlier attempts here too, so the whole folder is looked at again
+            papers = set(current_papers(list_papers()))
+            replaced = [f for f in changed if f in superseded]
+            if replaced:
+                print(f"{time.strftime('%H:%M:%S')} Not processed (replaced by a later attempt): {', '.join(replaced)}")
+            files_to_process = [f for f in select_files([f for f in changed if f in papers])
+                                if os.path.isfile(os.path.join(papers_folder, f))]
+            if not files_to_process:
+                continue
+            print("-" * 50)
+            print(f"{time.strftime('%H:%M:%S')} New or changed: {', '.join(files_to_process)}")
+            run_pipeline(files_to_process, pack=pack)
+            lease_waiting.clear() # Worker mode: whoever holds those papers is on them
+            processed.extend(files_to_process)
+            on_round()
+            print(f"Done ({counts['success']} letters so far). Watching for more submissions...")
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
+    finally:
+        watcher.close()
+    return processed
+
+
+def make_batch_backend(backend_name):
+    if backend_name == "local":
+        return LocalBatchBackend()
+    return GeminiBatchBackend(os.environ["GOOGLE_API_KEY"])
+
+
+def run_batch(files_to_process, backend, poll_seconds):
+    # Batch mode: every prompt goes into one JSONL request file, submitted as a single job.
+    # The job is remembered in the output folder, so if the script is stopped while waiting,
+    # running it again with --batch picks the same job up instead of submitting a new one.
+    # Each request's budget reservation is settled with its result's usage (a resumed job has
+    # none, so its usage is charged as it comes in).
+    state_path = os.path.join(output_folder, BATCH_STATE_FILENAME)
+    state = None
+    reservations = {} # filename -> budget reservation of its request
+    if os.path.exists(state_path):
+        with open(state_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        if state.get("backend") != backend.name or backend.name == "local":
+            state = None # Local jobs don't outlive the process that ran them
+
+    if state:
+        print(f"Resuming unfinished batch job {state['job_name']} ({len(state['jobs'])} requests).")
+        print(f"(Delete '{state_path}' to start a new job instead.)")
+    else:
+        jobs = {}
+        requests = []
+        for job, log in prepared_jobs(files_to_process):
+            key = job_cache_key(job)
+            cached = response_cache.get(key) if response_cache else None
+            if cached:
+                log("  Using cached response (identical request already answered).")
+                record_outcome(job["filename"], save_feedback(job, cached["feedback_text"], log))
+                continue
+            input_tokens = token_counter.count(job["student_prompt"])
+            token_ledger.record(job["filename"], student_identifier=job["student_identifier"], estimated_input_tokens=input_tokens)
+            reservation = None
+            if not budget_exhausted.is_set():
+                reservation = token_budget.reserve(input_tokens, EXPECTED_OUTPUT_TOKENS)
+            if reservation is None:
+                record_outcome(job["filename"], skip_over_budget(job, input_tokens, log))
+                continue
+            reservations[job["filename"]] = reservation
+            log("  Added to batch request file.")
+            jobs[job["filename"]] = {"filename": job["filename"], "student_identifier": job["student_identifier"], "cache_key": key}
+            requests.append((job["filename"], prompt_template.prefix + job["student_prompt"]))
+        if not requests:
+            print("Nothing to submit - no papers need new feedback.")
+            return
+
+        requests_path = os.path.join(output_folder, BATCH_REQUESTS_FILENAME)
+        write_request_file(requests_path, requests, GENERATION_CONFIG)
+        del requests # Prompts can be large; the request file has them now
+        print("-" * 50)
+        print(f"Submitting {len(jobs)} requests as one batch job ({backend.name} backend)...")
+        job_name = backend.submit(requests_path, MODEL_NAME, f"feedback-{time.strftime('%Y%m%d-%H%M%S')}")
+        state = {"backend": backend.name, "job_name": job_name, "jobs": jobs}
+        with open(state_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        print(f"Submitted batch job {job_name}.")
+
+    # --- Wait for the job ---
+    started = time.monotonic()
+    while True:
+        job_state = backend.state(state["job_name"])
+        if job_state in FINISHED_BATCH_STATES:
+            break
+        print(f"  Batch job {job_state} ({(time.monotonic() - started) / 60:.1f} min so far); checking again in {poll_seconds}s...")
+        time.sleep(poll_seconds)
+    print(f"Batch job finished with state: {job_state}")
+    # A resumed job can hold papers that have since been removed (or replaced by a later
+    # attempt); their results are still saved, but they have no fingerprint for the manifest
+    gone = [filename for filename in state["jobs"] if filename not in fingerprints]
+    if gone:
+        print(f"  {len(gone)} paper(s) in this job are no longer in '{papers_source()}' "
+              f"(their results are saved but not recorded as done): {', '.join(gone)}")
+
+    def finish(filename, outcome):
+        if filename in fingerprints:
+            record_outcome(filename, outcome)
+
+    if job_state != BATCH_SUCCEEDED:
+        print("!! The batch job did not succeed. No feedback was written; run again to submit a new job.")
+        os.remove(state_path)
+        for reservation in reservations.values():
+            token_budget.release(reservation)
+        for filename in state["jobs"]:
+            finish(filename, "error")
+        return
+
+    # --- Fan the results back out into the usual files ---
+    seen = set()
+    for key, response, error in backend.results(state["job_name"]):
+        job = state["jobs"].get(key)
+        if job is None:
             continue
+        seen.add(key)
+        log = make_logger(job["filename"])
+        usage = usage_from_response(response or {})
+        reservation = reservations.pop(key, None)
+        cost = token_budget.settle(reservation, usage) if reservation else token_budget.charge(usage)
+        token_ledger.record(key, student_identifier=job["student_identifier"], **usage, cost_usd=cost)
+        if error:
+            outcome = save_api_error(job, BatchRequestError(error), log)
+        else:
+            feedback_text, block_reason, safety_ratings = parse_batch_response(response or {})
+            if feedback_text:
+                if response_cache and backend.name != "local": # Never cache placeholder feedback
+                    response_cache.put(job["cache_key"], feedback_text, model=MODEL_NAME)
+                outcome = save_feedback(job, feedback_text, log)
+            else:
+                outcome = save_blocked_or_empty(job, block_reason, safety_ratings, log)
+        finish(job["filename"], outcome)
+    for filename in set(state["jobs"]) - seen:
+        job = state["jobs"][filename]
+        if filename in reservations:
+            token_budget.release(reservations.pop(filename)) # Nothing came back, so nothing to bill
+        outcome = save_api_error(job, RuntimeError("No result for this paper in the batch output."), make_logger(filename))
+        finish(filename, outcome)
+    os.remove(state_path)
+
+
+def export_store(path):
+    # --export-results: the per-student files from every paper's latest result
+    rows = read_results(path)
+    if not rows:
+        print(f"No results found in '{path}'.")
+        sys.exit(1)
+    written = export_results(rows, output_folder)
+    statuses = {}
+    for row in rows:
+        statuses[row["status"]] = statuses.get(row["status"], 0) + 1
+    print(f"Exported {written} files from '{path}' to the '{output_folder}' folder "
+          f"({', '.join(f'{count} {status}' for status, count in sorted(statuses.items()))}).")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate first-draft feedback letters for student papers with Gemini.")
+    parser.add_argument("--batch", action="store_true",
+                        help="Submit all papers as one offline batch job instead of individual requests.")
+    parser.add_argument("--batch-backend", choices=["gemini", "local"], default=BATCH_BACKEND,
+                        help=f"Backend for --batch (default: {BATCH_BACKEND}). 'local' needs no API key and writes placeholder feedback.")
+    parser.add_argument("--batch-poll-seconds", type=int, default=BATCH_POLL_SECONDS,
+                        help=f"Seconds between batch job status checks (default: {BATCH_POLL_SECONDS}).")
+    parser.add_argument("--backend", choices=["gemini", "local"], default=MODEL_BACKEND,
+                        help=f"Model backend for interactive runs (default: {MODEL_BACKEND}). 'local' needs no API key and writes placeholder feedback.")
+    parser.add_argument("--escalation-model", default=ESCALATION_MODEL_NAME,
+                        help="Higher-quality model for long papers and letters that fail the output checks (default: ESCALATION_MODEL_NAME).")
+    parser.add_argument("--extract-only", action="store_true",
+                        help=f"Only extract the papers' text (saved to '{extracted_text_folder}'); no API key needed.")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Extract and build every prompt, report token counts and estimated cost, but send nothing.")
+    parser.add_argument("--zip", metavar="PATH", default=papers_archive,
+                        help="Read the papers straight out of a Canvas submissions ZIP instead of the papers folder.")
+    parser.add_argument("--all-attempts", action="store_true", default=not LATEST_ATTEMPT_ONLY,
+                        help="Process every file, not only each student's latest Canvas attempt.")
+    parser.add_argument("--schedule", metavar="PATH", default=SCHEDULE_FILE,
+                        help="CSV of students to do first and/or class sections (student,section,priority,due).")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running and process new or changed papers as they arrive (stop with Ctrl+C).")
+    parser.add_argument("--worker", metavar="NAME",
+                        help="Run as one of several workers sharing the papers folder (each with its own name).")
+    parser.add_argument("--results-store", choices=["files", "sqlite", "jsonl"], default=RESULTS_STORE or "files",
+                        help=f"Save outcomes as one file each ('files') or as rows in output_folder/{RESULTS_STORE_FILENAME}.sqlite3/.jsonl "
+                             f"(default: {RESULTS_STORE or 'files'}).")
+    parser.add_argument("--export-results", action="store_true",
+                        help="Write every student's feedback/error file from the results store to the output folder and exit.")
+    parser.add_argument("--pack", action="store_true", default=PACK_PAPERS,
+                        help=f"Send several short papers per request (up to {PACK_MAX_PAPERS}) and split the answers.")
+    parser.add_argument("--stream", action="store_true", default=STREAM_RESPONSES,
+                        help="Stream each letter to its feedback file as it is generated and record time-to-first-token.")
+    parser.add_argument("--hedge", action="store_true", default=HEDGE_REQUESTS,
+                        help="Send a duplicate of requests slower than the model's recent p95 latency; the first answer wins.")
+    parser.add_argument("--profile-extraction", choices=PROFILE_MODES, default=PROFILE_EXTRACTION,
+                        help="Profile the extraction stage with cProfile or tracemalloc (results next to run_metrics.json).")
+    parser.add_argument("--token-budget", type=int, default=RUN_TOKEN_BUDGET,
+                        help="Maximum total tokens for this run (default: RUN_TOKEN_BUDGET).")
+    parser.add_argument("--cost-budget", type=float, default=RUN_COST_BUDGET_USD,
+                        help="Maximum estimated cost in USD for this run (default: RUN_COST_BUDGET_USD).")
+    args = parser.parse_args()
+    if args.watch and args.batch:
+        parser.error("--watch can't be combined with --batch")
+    if args.watch and args.zip:
+        parser.error("--watch watches the papers folder; it can't be combined with --zip")
+    if args.worker and not re.fullmatch(r"[A-Za-z0-9_-]+", args.worker):
+        parser.error("--worker names may only contain letters, digits, '-' and '_'")
+    if args.worker and (args.batch or args.extract_only or args.dry_run):
+        parser.error("--worker can't be combined with --batch, --extract-only or --dry-run")
+    if args.extract_only and args.dry_run:
+        parser.error("--extract-only can't be combined with --dry-run")
+    if (args.extract_only or args.dry_run) and (args.watch or args.batch):
+        parser.error("--extract-only and --dry-run can't be combined with --watch or --batch")
+    if args.export_results and args.results_store == "files":
+        parser.error("--export-results needs a results store (--results-store sqlite or jsonl)")
+    return args
+
+
+def main():
+    global router, response_cache, text_cache, manifest, current_prompt_version
+    global token_counter, token_budget, stream_responses, profile_extraction, offline_mode, extraction_limits
+    global similarity_index, worker_id, leases, results_store, archive, letter_template, hedger, schedule
+    global all_attempts
+
+    args = parse_args()
+    if args.export_results:
+        export_store(store_path(output_folder, RESULTS_STORE_FILENAME, args.results_store))
+        return
+    stream_responses = args.stream
+    worker_id = args.worker
+    profile_extraction = args.profile_extraction
+    offline_mode = "extract-only" if args.extract_only else "dry-run" if args.dry_run else None
+    placeholder_run = (args.batch_backend if args.batch else args.backend) == "local"
+    if args.zip:
+        try:
+            archive = SubmissionArchive(args.zip)
+        except (OSError, zipfile.BadZipFile) as zip_error:
+            print(f"Error: Could not read the submissions archive '{args.zip}': {zip_error}")
+            sys.exit(1)
+    model = None
+    if not placeholder_run and not offline_mode: # The local stand-ins need no API access
+        model = init_model()
+    check_folders()
+    if not args.batch and not offline_mode:
+        router = make_router(args.backend, model, args.escalation_model)
+        hedger = Hedger(latency_stats, REQUEST_TIMEOUT_SECONDS, args.hedge, HEDGE_PERCENTILE,
+                        HEDGE_MIN_DELAY_SECONDS, HEDGE_MAX_FRACTION, MAX_CONCURRENT_REQUESTS)
+        if CHECK_LETTERS:
+            letter_template = LetterTemplate(feedback_template, MIN_FEEDBACK_CHARS, MAX_FEEDBACK_CHARS, MIN_SECTION_CHARS)
+    if args.results_store != "files" and offline_mode != "dry-run":
+        results_path = worker_filename(store_path(output_folder, RESULTS_STORE_FILENAME, args.results_store))
+        results_store = open_results_store(args.results_store, results_path, RESULTS_BATCH_SIZE, RESULTS_FLUSH_SECONDS)
+
+    if USE_RESPONSE_CACHE:
+        response_cache = ResponseCache(RESPONSE_CACHE_FOLDER, RESPONSE_CACHE_MAX_AGE_DAYS, RESPONSE_CACHE_MAX_SIZE_MB)
+        pruned = response_cache.prune()
+        if pruned:
+            print(f"Removed {pruned} expired or excess entries from the response cache.")
+    extraction_limits = ExtractionLimits(MAX_EXTRACTED_CHARS, MAX_PDF_PAGES, PDF_PAGE_WORKERS,
+                                         PDF_PARALLEL_MIN_PAGES, PDF_PAGES_PER_TASK)
+    if USE_TEXT_CACHE:
+        text_cache = TextCache(worker_filename(TEXT_CACHE_PATH), extractor_version(extraction_limits))
+        pruned = text_cache.prune(TEXT_CACHE_MAX_AGE_DAYS)
+        if pruned:
+            print(f"Removed {pruned} stale entries from the extracted text cache.")
+
+    token_counter = TokenCounter(TOKEN_COUNTING if model else "estimate", prompt_template, model, rate_limiter, retry_policy)
+    pricing = Pricing(PRICE_PER_MILLION_INPUT_TOKENS, PRICE_PER_MILLION_OUTPUT_TOKENS,
+                      PRICE_PER_MILLION_CACHED_INPUT_TOKENS, factor=BATCH_PRICE_FACTOR if args.batch else 1.0)
+    token_budget = TokenBudget(pricing, args.token_budget, args.cost_budget)
+    started_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    print(f"\n--- Starting Batch Feedback Generation ---")
 
-        # --- If text was extracted successfully ---
-        if full_text:
-            print(f"  Extracted text length: ~{len(full_text)} characters.")
-            # --- Prepare the final prompt for the API ---
-            try:
-                # Replace ALL placeholders in the base prompt string
-                prompt_for_api = base_prompt.replace("{assignment_context_placeholder}", assignment_description)
-                prompt_for_api = prompt_for_api.replace("{example_feedback_placeholder}", example_feedback_letter)
-                prompt_for_api = prompt_for_api.replace("{student_identifier_placeholder}", student_identifier)
-                prompt_for_api = prompt_for_api.replace("{paper_text_placeholder}", full_text)
-                # Replace placeholder in the template part itself
-                prompt_for_api = prompt_for_api.replace("{student_identifier}", student_identifier)
-
-                # --- Call the Google Gemini API ---
-                print("  Sending request to Gemini API...")
-                response = model.generate_content(
-                    prompt_for_api,
-                    # Optional: Add safety settings if needed, balancing safety and utility
-                    # safety_settings=[
-                    #     {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_LOW_AND_ABOVE"}, # Stricter
-                    #     {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_LOW_AND_ABOVE"}, # Stricter
-                    #     {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                    #     {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                    # ]
-                    # Optional: Control generation parameters
-                    # generation_config=genai.types.GenerationConfig(
-                    #     # candidate_count=1, # Default is 1
-                    #     # stop_sequences=['\n\n\n'], # Example stop sequence
-                    #     # max_output_tokens=2048, # Limit output length
-                    #     temperature=0.7 # 0.0 = deterministic, 1.0 = max creativity
-                    # )
-                )
-
-                # --- Extract and Save Feedback ---
-                feedback_text = ""
-                try:
-                    # Accessing response text safely - check candidate parts
-                    if response.parts:
-                         feedback_text = "".join(part.text for part in response.parts).strip()
-                    else:
-                         # Sometimes .text might work even if .parts is empty, try as fallback
-                         feedback_text = response.text.strip()
-
-                except AttributeError:
-                     # Handle cases where .text might not exist if response failed early
-                     print("  Warning: Could not directly access .text attribute in API response.")
-                     feedback_text = "" # Ensure it's empty
-                except Exception as resp_err:
-                     print(f"  Warning: Could not extract text from API response parts. Error: {resp_err}")
-                     feedback_text = "" # Ensure it's empty
-
-                # Check if feedback is empty or blocked
-                if feedback_text:
-                    output_filename = os.path.join(output_folder, f"{student_identifier}_feedback.txt")
-                    with open(output_filename, 'w', encoding='utf-8') as f:
-                        f.write(feedback_text)
-                    print(f"  Successfully generated and saved feedback to '{output_filename}'")
-                    processed_count += 1
-                    file_processed = True
-                else:
-                    # Handle blocked prompts or genuinely empty responses
-                    print(f"  Warning: No feedback content generated for {filename}.")
-                    try:
-                        # Log safety feedback if available
-                        block_reason = response.prompt_feedback.block_reason
-                        safety_ratings = response.prompt_feedback.safety_ratings
-                        print(f"    Block Reason (if any): {block_reason}")
-                        print(f"    Safety Ratings: {safety_ratings}")
-                        error_filename = os.path.join(output_folder, f"{student_identifier}_ERROR_FeedbackBlockedOrEmpty.txt")
-                        with open(error_filename, 'w', encoding='utf-8') as f:
-                            f.write(f"Feedback generation blocked or empty for {filename} (Identifier: {student_identifier}).\n")
-                            f.write(f"Block Reason: {block_reason}\n")
-                            f.write(f"Safety Ratings: {safety_ratings}\n")
-                    except Exception:
-                         print("    Could not retrieve detailed safety/block feedback from response.")
-                         error_filename = os.path.join(output_folder, f"{student_identifier}_ERROR_EmptyResponse.txt")
-                         with open(error_filename, 'w', encoding='utf-8') as f:
-                            f.write(f"API returned an empty response for {filename} (Identifier: {student_identifier}).\n")
-                    error_count += 1
-                    continue # Skip saving/pausing
-
-            except Exception as api_error:
-                print(f"!! Error during API call or response processing for {filename}: {api_error}")
-                # You might want to log the specific error to a file here too
-                error_filename = os.path.join(output_folder, f"{student_identifier}_ERROR_API_Call_Failed.txt")
-                with open(error_filename, 'w', encoding='utf-8') as f:
-                   f.write(f"API call failed for {filename} (Identifier: {student_identifier}).\n")
-                   f.write(f"Error: {api_error}\n")
-                error_count += 1
-                continue # Skip to next file
-
-            # --- Rate Limiting ---
-            if file_processed: # Only pause if we successfully processed and saved
-                 print("  Pausing briefly to respect API rate limits...")
-                 # Adjust sleep time based on your API tier limits and observation
-                 # Free tiers often have low requests-per-minute limits (e.g., 15-60 RPM)
-                 time.sleep(4) # Pause for 4 seconds (adjust if needed)
-
-    except Exception as file_proc_error:
-        print(f"!! Unexpected error processing file {filename} before API call: {file_proc_error}")
-        error_filename = os.path.join(output_folder, f"{student_identifier}_ERROR_File_Processing.txt")
-        with open(error_filename, 'w', encoding='utf-8') as f:
-            f.write(f"Unexpected error processing file {filename} (Identifier: {student_identifier}) before API call.\n")
-            f.write(f"Error: {file_proc_error}\n")
-        error_count += 1
-        continue # Skip to next file
-
-# --- Final Summary ---
-print("-" * 50)
-print("\n--- Batch Feedback Generation Summary ---")
-print(f"Total files found in '{papers_folder}': {total_files}")
-print(f"Successfully generated feedback for: {processed_count} files")
-print(f"Files skipped or resulting in errors: {error_count}")
-print(f"Feedback files (and any error logs) saved in the '{output_folder}' folder.")
-print("\n--- IMPORTANT REMINDERS ---")
-print("1. REVIEW AND EDIT EACH feedback file carefully before sharing.")
-print("2. Manually replace the '{student_identifier}' (username) in each feedback letter with the student's actual name.")
->>>>>>> e8b3a0fa421187254876ec0270612d1141e3a024
-print("-" * 50)
\ No newline at end of file
+    try:
+        # List files, ignore hidden files/folders
+        paper_files = list_papers()
+    except FileNotFoundError:
+        print(f"Error: Input folder '{papers_folder}' not found.")
+        sys.exit(1)
+
+    if not paper_files and not args.watch:
+        print(f"No files found in '{papers_source()}'.")
+        sys.exit(0)
+
+    total_files = len(paper_files)
+    # Earlier Canvas attempts of students who submitted again are left out (see current_papers)
+    all_attempts = args.all_attempts
+    paper_files = current_papers(paper_files)
+
+    schedule_path = args.schedule
+    if schedule_path:
+        try:
+            schedule = load_schedule(schedule_path)
+        except (OSError, ScheduleError) as schedule_error:
+            print(f"Error: Could not read the schedule file '{schedule_path}': {schedule_error}")
+            sys.exit(1)
+
+    # --- Skip papers that are unchanged since the last run ---
+    manifest = RunManifest(os.path.join(output_folder, MANIFEST_FILENAME), worker_id)
+    current_prompt_version = prompt_version(MODEL_NAME, GENERATION_CONFIG, base_prompt, student_prompt)
+    if router and router.escalation:
+        current_prompt_version = prompt_version(current_prompt_version, router.escalation.model_name,
+                                                ESCALATE_ABOVE_TOKENS, MIN_FEEDBACK_CHARS)
+    if placeholder_run:
+        # Placeholder feedback must not count as done for the next real run
+        current_prompt_version += "-local"
+    # In watch mode, start watching before the first pass so nothing that lands meanwhile is missed
+    watcher = FolderWatcher(papers_folder, WATCH_SETTLE_SECONDS, WATCH_POLL_SECONDS, WATCH_RESCAN_SECONDS) if args.watch else None
+    files_to_process = select_files(paper_files)
+    unchanged_count = len(paper_files) - len(files_to_process)
+    if DETECT_DUPLICATES and not args.batch and not offline_mode:
+        similarity_index = SimilarityIndex(NEAR_DUPLICATE_THRESHOLD)
+        selected = set(files_to_process)
+        seed_similarity_index([f for f in paper_files if f not in selected])
+    if worker_id:
+        leases = LeaseManager(os.path.join(output_folder, LEASE_FOLDER), worker_id, LEASE_TTL_SECONDS)
+        # Each worker shuffles short runs of the scheduled order, so workers rarely reach the same
+        # paper at once but still follow the schedule. Runs never mix urgency tiers: a paper due
+        # tomorrow is not swapped behind one that isn't due at all.
+        shuffler = random.Random(worker_id)
+        run_length = MAX_CONCURRENT_REQUESTS * 2
+        shuffled = []
+        for _, tier in itertools.groupby(files_to_process, key=lambda filename: urgency(schedule, filename)):
+            tier = list(tier)
+            for start in range(0, len(tier), run_length):
+                papers_run = tier[start:start + run_length]
+                shuffler.shuffle(papers_run)
+                shuffled.extend(papers_run)
+        files_to_process = shuffled
+
+    print(f"Found {total_files} files in '{papers_source()}'. Outputting to '{output_folder}'.")
+    if superseded:
+        print(f"Skipping {len(superseded)} earlier attempts of students who submitted again (--all-attempts to include them).")
+    if worker_id:
+        print(f"Running as worker '{worker_id}': papers are shared with any other workers on this folder.")
+    if schedule and schedule.entries:
+        sections = schedule.sections()
+        print(f"Schedule '{schedule_path}': {schedule.urgent_count()} student(s) first"
+              + (f", {len(sections)} sections taking turns." if len(sections) > 1 else "."))
+    if unchanged_count:
+        print(f"Skipping {unchanged_count} files already processed with the current prompt (unchanged since the last run).")
+    if offline_mode == "extract-only":
+        print(f"Extracting the text of {len(files_to_process)} files (no API calls).")
+    elif offline_mode == "dry-run":
+        print(f"Dry run: building the prompts for {len(files_to_process)} files (no API calls).")
+    elif args.batch:
+        print(f"Processing {len(files_to_process)} files as one batch job.")
+    else:
+        print(f"Processing {len(files_to_process)} files with up to {MAX_CONCURRENT_REQUESTS} concurrent requests, "
+              f"limited to {REQUESTS_PER_MINUTE} requests/minute"
+              + (f" and {TOKENS_PER_MINUTE} tokens/minute." if TOKENS_PER_MINUTE else "."))
+        if args.pack:
+            print(f"Packing papers under ~{PACK_MAX_PAPER_TOKENS} tokens, up to {PACK_MAX_PAPERS} per request.")
+        if args.hedge:
+            print(f"Duplicating requests slower than the model's recent p{HEDGE_PERCENTILE} latency "
+                  f"(at most {HEDGE_MAX_FRACTION:.0%} extra requests).")
+    print("-" * 50) # Separator for clarity
+
+    mode = "batch" if args.batch else "watch" if args.watch else "interactive"
+    token_report_path = worker_filename(os.path.join(output_folder, TOKEN_REPORT_FILENAME))
+    metrics_report_path = worker_filename(os.path.join(output_folder, METRICS_REPORT_FILENAME))
+    similarity_report_path = worker_filename(os.path.join(output_folder, SIMILARITY_REPORT_FILENAME))
+    processed_files = list(files_to_process)
+
+    def write_reports():
+        if results_store:
+            results_store.flush()
+        if similarity_index:
+            similarity_index.write_report(similarity_report_path)
+        token_ledger.write_report(token_report_path, model=MODEL_NAME, mode=mode, started_at=started_at,
+                                  token_budget=args.token_budget, cost_budget_usd=args.cost_budget)
+        return metrics.write_report(
+            metrics_report_path, model=MODEL_NAME, mode=mode, started_at=started_at,
+            files_processed=len(processed_files), outcomes=dict(counts), extraction_workers=EXTRACTION_WORKERS,
+            max_concurrent_requests=MAX_CONCURRENT_REQUESTS, extraction_profile=profile_info,
+            latency_by_model=latency_stats.summary(), hedging=hedger.summary() if hedger else None)["stages"]
+
+    profile_info = None
+    try:
+        if offline_mode:
+            offline_results = run_offline(files_to_process)
+        elif args.batch:
+            run_batch(files_to_process, make_batch_backend(args.batch_backend), args.batch_poll_seconds)
+        else:
+            run_pipeline(files_to_process, pack=args.pack)
+            while lease_waiting:
+                # Wait for the other workers to finish (or abandon) the papers they hold
+                waiting = list(dict.fromkeys(lease_waiting))
+                lease_waiting.clear()
+                print("-" * 50)
+                print(f"{len(waiting)} paper(s) are being processed by other workers. Checking again in {LEASE_RECHECK_SECONDS}s...")
+                time.sleep(LEASE_RECHECK_SECONDS)
+                run_pipeline(waiting, pack=args.pack)
+            if watcher:
+                write_reports()
+                processed_files += watch_papers(watcher, args.pack, write_reports)
+    finally:
+        if router:
+            router.close()
+        if leases:
+            leases.close()
+        if results_store:
+            results_store.close() # Writes the last batch
+    if text_cache:
+        text_cache.close()
+    if offline_mode:
+        print_offline_summary(offline_results, total_files, unchanged_count)
+        return
+    manifest.compact()
+    totals = token_ledger.totals()
+
+    # --- Run metrics (and extraction profile) ---
+    if profile_extraction == "cprofile":
+        profile_info = {"mode": "cprofile", "profile": worker_filename(os.path.join(output_folder, "extraction_profile.prof")),
+                        "summary": worker_filename(os.path.join(output_folder, "extraction_profile.txt"))}
+        if not combine_profiles([extraction_profile_path(f) for f in set(processed_files)],
+                                profile_info["profile"], profile_info["summary"]):
+            profile_info = None
+    elif profile_extraction == "tracemalloc":
+        profile_info = {"mode": "tracemalloc", "papers": extraction_profiles}
+    stage_summary = write_reports()
+
+    # --- Final Summary ---
+    print("-" * 50)
+    print("\n--- Batch Feedback Generation Summary ---")
+    print(f"Total files found in '{papers_source()}': {total_files}")
+    if superseded:
+        print(f"Earlier attempts superseded by a later submission (not processed): {len(superseded)}")
+    print(f"Unchanged since the last run (not reprocessed): {unchanged_count}")
+    if args.watch:
+        print(f"Processed while watching: {len(processed_files) - len(files_to_process)} files")
+    print(f"Successfully generated feedback for: {counts['success']} files")
+    print(f"Files skipped or resulting in errors: {counts['error']}")
+    if worker_id:
+        print(f"Already finished by other workers: {counts['other_workers']}")
+    if counts["over_budget"]:
+        print(f"Not sent because of the token/cost budget (will be processed next run): {counts['over_budget']}")
+    print(f"Tokens used: {totals['total_tokens']} ({totals['prompt_tokens']} input, of which {totals['cached_tokens']} cached; "
+          f"{totals['output_tokens']} output). Estimated cost: ${totals['cost_usd']:.4f}")
+    if token_counter.fallbacks:
+        print(f"Prompt sizes estimated offline because count_tokens failed: {token_counter.fallbacks}")
+    first_token_times = token_ledger.values("time_to_first_token_s")
+    if first_token_times:
+        generation_times = token_ledger.values("generation_s")
+        print(f"Streaming latency: first token after {statistics.median(first_token_times):.1f}s median "
+              f"({max(first_token_times):.1f}s slowest), full letter after {statistics.median(generation_times):.1f}s median "
+              f"({max(generation_times):.1f}s slowest)")
+    times_to_feedback = token_ledger.values("time_to_feedback_s")
+    if times_to_feedback:
+        print(f"Time to feedback: {statistics.mean(times_to_feedback):.1f}s mean, {statistics.median(times_to_feedback):.1f}s median, "
+              f"{max(times_to_feedback):.1f}s for the last letter")
+    print(f"Per-paper token report: '{token_report_path}'")
+    hedging = hedger.summary() if hedger else None
+    if hedging and (hedging["hedged"] or hedging["deadline_misses"]):
+        print(f"Slow requests: {hedging['hedged']} duplicated ({hedging['hedge_wins']} answered first by the duplicate, "
+              f"~${hedging['extra_cost_usd']:.4f} extra), {hedging['deadline_misses']} abandoned after {REQUEST_TIMEOUT_SECONDS}s "
+              f"({hedging['late_answers']} answered late, discarded)")
+    if similarity_index:
+        similarity = similarity_index.report()
+        duplicates = sum(len(group) - 1 for group in similarity["exact_duplicates"])
+        print(f"Duplicate submissions: {duplicates} with the same text as another paper, "
+              f"{len(similarity['near_duplicates'])} near-duplicate pair(s). See '{similarity_report_path}'")
+    busiest = sorted(stage_summary.items(), key=lambda item: item[1]["total_s"], reverse=True)[:4]
+    if busiest:
+        print("Most time spent in: " + ", ".join(
+            f"{stage} {summary['total_s']:.1f}s (p95 {summary['p95_s']:.2f}s)" for stage, summary in busiest))
+    print(f"Per-stage metrics: '{metrics_report_path}'")
+    if profile_info and profile_extraction == "cprofile":
+        print(f"Extraction profile: '{profile_info['summary']}'")
+    if results_store:
+        print(f"Feedback and any errors saved in '{results_store.path}'. "
+              "Run with --export-results to write them out as one file per student.")
+    else:
+        print(f"Feedback files (and any error logs) saved in the '{output_folder}' folder.")
+    print("\n--- IMPORTANT REMINDERS ---")
+    print("1. REVIEW AND EDIT EACH feedback file carefully before sharing.")
+    print("2. Manually replace the '{student_identifier}' (username) in each feedback letter with the student's actual name.")
+
+
+# The guard matters: extraction worker processes re-import this file on Windows/macOS.
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# The tests import the script and the package from the repository root, and the simulated
+# Gemini backend from benchmarks/ (as benchmarks/benchmark.py does)
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (REPO_ROOT, os.path.join(REPO_ROOT, "benchmarks")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
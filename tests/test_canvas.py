@@ -0,0 +1,43 @@
+from feedback_assistant.canvas import latest_attempts, parse_submission_name
+
+
+def test_parse_submission_name():
+    submission = parse_submission_name("jdoe_LATE_12345_67890_Essay-1.docx")
+    assert submission["username"] == "jdoe"
+    assert submission["user_id"] == "12345"
+    assert submission["submission_id"] == 67890
+    assert submission["late"]
+    assert submission["original_name"] == "Essay-1.docx"
+    assert submission["upload_counter"] == 1
+    assert submission["base_name"] == "Essay.docx"
+    assert parse_submission_name("essay.docx") is None
+
+
+def test_reuploads_keep_the_highest_counter():
+    files = ["jdoe_1_100_Essay.docx", "jdoe_1_100_Essay-2.docx", "jdoe_1_100_Essay-1.docx"]
+    kept, superseded = latest_attempts(files)
+    assert kept == ["jdoe_1_100_Essay-2.docx"]
+    assert superseded == {"jdoe_1_100_Essay.docx": "jdoe_1_100_Essay-2.docx",
+                          "jdoe_1_100_Essay-1.docx": "jdoe_1_100_Essay-2.docx"}
+
+
+def test_digits_in_a_name_are_not_a_reupload_counter():
+    # Essay-2024 has no Essay to be a re-upload of, so the submission id decides
+    files = ["jdoe_1_200_Essay-2024.docx", "jdoe_1_150_Essay.docx"]
+    kept, superseded = latest_attempts(files)
+    assert kept == ["jdoe_1_200_Essay-2024.docx"]
+    assert superseded == {"jdoe_1_150_Essay.docx": "jdoe_1_200_Essay-2024.docx"}
+    kept, _ = latest_attempts(["jdoe_1_300_Project-1.docx", "jdoe_1_400_Project-9.pdf"])
+    assert kept == ["jdoe_1_400_Project-9.pdf"]
+
+
+def test_files_of_one_attempt_are_all_kept():
+    files = ["jdoe_1_100_Project-1.docx", "jdoe_1_100_Notes.docx"]
+    assert latest_attempts(files) == (files, {})
+
+
+def test_students_are_kept_apart_and_other_names_pass_through():
+    files = ["jdoe_1_100_Essay.docx", "asmith_2_90_Essay.docx", "notes.txt", "jdoe_1_120_Essay.docx"]
+    kept, superseded = latest_attempts(files)
+    assert kept == ["asmith_2_90_Essay.docx", "notes.txt", "jdoe_1_120_Essay.docx"]
+    assert superseded == {"jdoe_1_100_Essay.docx": "jdoe_1_120_Essay.docx"}
@@ -0,0 +1,177 @@
+import itertools
+import threading
+import time
+
+import pytest
+
+import fake_gemini
+from fake_gemini import FakeServer, FakeSettings
+from feedback_assistant.hedging import Hedger, LatencyStats, RequestDeadlineExceeded
+
+MODEL = "gemini-2.0-flash"
+
+
+@pytest.fixture
+def model(monkeypatch):
+    # The simulated Gemini backend of the benchmark harness, answering after 20ms
+    monkeypatch.setattr(fake_gemini, "server", FakeServer(FakeSettings(latency=0.02, latency_jitter=0.0, seed=1)))
+    return fake_gemini.FakeGenerativeModel(MODEL)
+
+
+def request_to(model, slow_calls=(), slow_seconds=0.5):
+    # A request whose calls numbered in slow_calls (0 = the original request) take slow_seconds longer
+    calls = itertools.count()
+
+    def request():
+        if next(calls) in slow_calls:
+            time.sleep(slow_seconds)
+        return model.generate_content("Write feedback.")
+    return request
+
+
+def warmed_up_stats(seconds=0.02, samples=20):
+    stats = LatencyStats(window=50, min_samples=samples)
+    for _ in range(samples):
+        stats.record(MODEL, seconds)
+    return stats
+
+
+class Finished:
+    # finish_hedge(): remembers what it was given and bills each unused answer 0.01
+
+    def __init__(self):
+        self.calls = []
+        self.called = threading.Event()
+
+    def __call__(self, token, responses):
+        self.calls.append((token, list(responses)))
+        self.called.set()
+        return 0.01 * len(responses)
+
+
+def test_plain_request_records_latency(model):
+    stats = LatencyStats(min_samples=1)
+    hedger = Hedger(stats)
+    response = hedger.call(MODEL, request_to(model))
+    assert response.text.startswith("Dear")
+    assert stats.summary()[MODEL]["count"] == 1
+    assert hedger.summary()["requests"] == 1
+
+
+def test_hedge_delay_needs_samples():
+    stats = warmed_up_stats(samples=20)
+    assert Hedger(stats, hedge=False).hedge_delay(MODEL) is None
+    assert Hedger(LatencyStats(min_samples=20), hedge=True).hedge_delay(MODEL) is None
+    assert Hedger(stats, hedge=True, min_hedge_delay=0.05).hedge_delay(MODEL) == 0.05
+    # Not worth it if the deadline comes first
+    assert Hedger(stats, deadline_seconds=0.05, hedge=True, min_hedge_delay=0.05).hedge_delay(MODEL) is None
+
+
+def test_request_that_cannot_be_hedged_runs_in_the_callers_thread(model):
+    threads = []
+
+    def request():
+        threads.append(threading.current_thread())
+        return model.generate_content("Write feedback.")
+
+    hedger = Hedger(LatencyStats(), deadline_seconds=5)
+    hedger.call(MODEL, request, lambda: "reservation", Finished())
+    assert threads == [threading.current_thread()]
+
+
+def test_client_timeout_counts_as_a_deadline_miss():
+    def request():
+        time.sleep(0.06)
+        raise TimeoutError("client timeout")
+
+    hedger = Hedger(LatencyStats(min_samples=1), deadline_seconds=0.05)
+    with pytest.raises(TimeoutError):
+        hedger.call(MODEL, request)
+    assert hedger.summary()["deadline_misses"] == 1
+    assert hedger.in_flight == 0
+
+
+def test_deadline_abandons_the_request_and_bills_its_late_answer(model):
+    # A duplicate could be sent (so the request runs in its own thread), but start_hedge() refuses one
+    hedger = Hedger(warmed_up_stats(), deadline_seconds=0.1, hedge=True, min_hedge_delay=0.05, max_hedge_fraction=1.0)
+    finished = Finished()
+    with pytest.raises(RequestDeadlineExceeded):
+        hedger.call(MODEL, request_to(model, slow_calls={0}), lambda: None, finished, log=lambda message: None)
+    assert isinstance(RequestDeadlineExceeded("x"), TimeoutError) # Retried like any timeout
+    assert finished.called.wait(5)
+    token, responses = finished.calls[0]
+    assert token is None and len(responses) == 1
+    summary = hedger.summary()
+    assert summary["deadline_misses"] == 1 and summary["late_answers"] == 1
+    assert summary["extra_cost_usd"] == 0.01
+
+
+def test_duplicate_answers_first_and_loser_is_billed(model):
+    hedger = Hedger(warmed_up_stats(), deadline_seconds=5, hedge=True, min_hedge_delay=0.05, max_hedge_fraction=1.0)
+    finished = Finished()
+    response = hedger.call(MODEL, request_to(model, slow_calls={0}), lambda: "reservation", finished,
+                           log=lambda message: None)
+    assert response.text.startswith("Dear")
+    assert finished.called.wait(5) # Once the original request has answered too
+    [(token, responses)] = finished.calls
+    assert token == "reservation" and len(responses) == 1
+    summary = hedger.summary()
+    assert summary["hedged"] == 1 and summary["hedge_wins"] == 1 and summary["late_answers"] == 0
+
+
+def test_unused_hedge_reservation_is_returned(model):
+    # The original request answers first; the duplicate's answer is the one not used
+    hedger = Hedger(warmed_up_stats(), deadline_seconds=5, hedge=True, min_hedge_delay=0.05, max_hedge_fraction=1.0)
+    finished = Finished()
+    hedger.call(MODEL, request_to(model, slow_calls={0, 1}, slow_seconds=0.1), lambda: "reservation", finished,
+                log=lambda message: None)
+    assert finished.called.wait(5)
+    assert finished.calls[0][0] == "reservation"
+    assert hedger.summary()["hedged"] == 1
+
+
+def test_hedging_is_capped_and_needs_a_token(model):
+    start_hedge_calls = []
+
+    def no_token():
+        start_hedge_calls.append(1)
+        return None
+
+    capped = Hedger(warmed_up_stats(), hedge=True, min_hedge_delay=0.05, max_hedge_fraction=0.1)
+    capped.call(MODEL, request_to(model, slow_calls={0}, slow_seconds=0.1), no_token, Finished(), log=lambda m: None)
+    assert not start_hedge_calls and capped.summary()["hedged"] == 0
+    refused = Hedger(warmed_up_stats(), hedge=True, min_hedge_delay=0.05, max_hedge_fraction=1.0)
+    refused.call(MODEL, request_to(model, slow_calls={0}, slow_seconds=0.1), no_token, Finished(), log=lambda m: None)
+    assert start_hedge_calls and refused.summary()["hedged"] == 0
+
+
+def test_errors_are_raised(monkeypatch):
+    from google.api_core import exceptions
+
+    monkeypatch.setattr(fake_gemini, "server", FakeServer(FakeSettings(latency=0.01, error_rate=1.0, seed=1)))
+    hedger = Hedger(LatencyStats(), deadline_seconds=5)
+    with pytest.raises(exceptions.ServiceUnavailable):
+        hedger.call(MODEL, request_to(fake_gemini.FakeGenerativeModel(MODEL)))
+    assert hedger.summary()["deadline_misses"] == 0
+
+
+def test_abandoned_request_keeps_its_place_until_it_ends(model):
+    hedger = Hedger(warmed_up_stats(), deadline_seconds=0.1, hedge=True, min_hedge_delay=0.05, max_hedge_fraction=1.0,
+                    max_in_flight=1)
+    with pytest.raises(RequestDeadlineExceeded):
+        hedger.call(MODEL, request_to(model, slow_calls={0}, slow_seconds=0.4), lambda: None, Finished(),
+                    log=lambda message: None)
+    assert hedger.in_flight == 1 # Still running after being abandoned
+    started = time.perf_counter()
+    hedger.call(MODEL, request_to(model)) # Waits for it
+    assert time.perf_counter() - started >= 0.2
+    assert hedger.in_flight == 0
+
+
+def test_duplicate_needs_a_free_place(model):
+    hedger = Hedger(warmed_up_stats(), deadline_seconds=5, hedge=True, min_hedge_delay=0.05, max_hedge_fraction=1.0,
+                    max_in_flight=1)
+    tokens = []
+    hedger.call(MODEL, request_to(model, slow_calls={0}, slow_seconds=0.1), lambda: tokens.append(1) or "token",
+                Finished(), log=lambda message: None)
+    assert not tokens and hedger.summary()["hedged"] == 0
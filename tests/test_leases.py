@@ -0,0 +1,113 @@
+import json
+import os
+import time
+
+import pytest
+
+from feedback_assistant import leases as leases_module
+from feedback_assistant.leases import LEASE_SUFFIX, LeaseManager
+
+FINISHED = ("success",)
+
+
+def paper(filename, sha256="abc", prompt_version="v1"):
+    return {"file": filename, "sha256": sha256, "prompt_version": prompt_version}
+
+
+@pytest.fixture
+def workers(tmp_path):
+    # Two workers sharing one lease folder
+    managers = [LeaseManager(str(tmp_path), "worker-1"), LeaseManager(str(tmp_path), "worker-2")]
+    yield managers
+    for manager in managers:
+        manager.close()
+
+
+def read_lease(tmp_path, key):
+    with open(os.path.join(str(tmp_path), key + LEASE_SUFFIX), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_claim_is_exclusive(workers):
+    first, second = workers
+    assert first.claim("jdoe", paper("a.docx"), FINISHED) == "claimed"
+    assert second.claim("jdoe", paper("a.docx"), FINISHED) == "busy"
+
+
+def test_lease_held_by_this_worker_is_not_busy(workers):
+    first, second = workers
+    assert first.claim("jdoe", paper("a.docx"), FINISHED) == "claimed"
+    assert first.claim("jdoe", paper("b.docx"), FINISHED) == "claimed"
+    assert second.claim("jdoe", paper("b.docx"), FINISHED) == "busy"
+
+
+def test_finished_work_is_recorded_per_file(tmp_path, workers):
+    first, second = workers
+    first.claim("jdoe", paper("a.docx"), FINISHED)
+    first.claim("jdoe", paper("b.docx"), FINISHED)
+    first.release("jdoe", "a.docx", outcome="success")
+    # Still held for b.docx
+    assert second.claim("jdoe", paper("b.docx"), FINISHED) == "busy"
+    first.release("jdoe", "b.docx", outcome="success")
+    record = read_lease(tmp_path, "jdoe")
+    assert record["done"] and "token" not in record
+    assert set(record["finished"]) == {"a.docx", "b.docx"}
+    assert second.claim("jdoe", paper("a.docx"), FINISHED) == "done"
+    assert second.claim("jdoe", paper("b.docx"), FINISHED) == "done"
+
+
+def test_changed_work_is_claimed_again_and_history_kept(tmp_path, workers):
+    first, second = workers
+    first.claim("jdoe", paper("a.docx"), FINISHED)
+    first.claim("jdoe", paper("b.docx"), FINISHED)
+    first.release("jdoe", "a.docx", outcome="success")
+    first.release("jdoe", "b.docx", outcome="success")
+    assert second.claim("jdoe", paper("a.docx", sha256="changed"), FINISHED) == "claimed"
+    second.release("jdoe", "a.docx", outcome="success")
+    finished = read_lease(tmp_path, "jdoe")["finished"]
+    assert finished["a.docx"]["sha256"] == "changed"
+    assert finished["b.docx"]["sha256"] == "abc"
+
+
+def test_failed_work_is_not_done(workers):
+    first, second = workers
+    first.claim("jdoe", paper("a.docx"), FINISHED)
+    first.release("jdoe", "a.docx", outcome="error")
+    assert second.claim("jdoe", paper("a.docx"), FINISHED) == "claimed"
+
+
+def test_expired_lease_is_taken_over(tmp_path, workers):
+    first, second = workers
+    first.claim("jdoe", paper("a.docx"), FINISHED)
+    stale = time.time() - second.ttl_seconds - 60
+    os.utime(os.path.join(str(tmp_path), "jdoe" + LEASE_SUFFIX), (stale, stale))
+    assert second.claim("jdoe", paper("a.docx"), FINISHED) == "claimed"
+    assert read_lease(tmp_path, "jdoe")["worker"] == "worker-2"
+    # The crashed worker's late release doesn't overwrite the new lease
+    first.release("jdoe", "a.docx", outcome="success")
+    assert read_lease(tmp_path, "jdoe")["worker"] == "worker-2"
+
+
+def test_close_removes_unfinished_leases(tmp_path):
+    manager = LeaseManager(str(tmp_path), "worker-1")
+    manager.claim("jdoe", paper("a.docx"), FINISHED)
+    manager.close()
+    assert not os.path.exists(os.path.join(str(tmp_path), "jdoe" + LEASE_SUFFIX))
+
+
+def test_lease_that_cannot_be_renewed_is_given_up(tmp_path, monkeypatch, capsys):
+    def utime(path, *args, **kwargs):
+        raise PermissionError("read-only file system")
+
+    monkeypatch.setattr(leases_module.os, "utime", utime)
+    manager = LeaseManager(str(tmp_path), "worker-1", ttl_seconds=0.2)
+    try:
+        manager.claim("jdoe", paper("a.docx"), FINISHED)
+        deadline = time.monotonic() + 5
+        while "jdoe" in manager.held and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert "jdoe" not in manager.held
+        assert manager.heartbeat.is_alive()
+    finally:
+        manager.close()
+    assert "Could not renew the lease 'jdoe'" in capsys.readouterr().out
@@ -0,0 +1,115 @@
+import os
+import sqlite3
+
+import pytest
+
+from feedback_assistant.results_store import (export_results, open_results_store, output_file, read_results,
+                                              store_path)
+
+
+def success(filename, identifier, feedback, recorded_at=None):
+    return {"file": filename, "student_identifier": identifier, "status": "success", "feedback": feedback,
+            "timings": {"processing_s": 1.5}, "recorded_at": recorded_at}
+
+
+@pytest.fixture(params=["sqlite", "jsonl"])
+def store(request, tmp_path):
+    store = open_results_store(request.param, store_path(str(tmp_path), "results", request.param),
+                               batch_size=2, flush_seconds=3600)
+    yield store
+    store.close()
+
+
+def test_rows_are_buffered_and_readable(store):
+    store.add(success("a.docx", "amy", "Dear amy"))
+    assert store.get("a.docx")["feedback"] == "Dear amy" # Not written yet
+    store.add(success("b.docx", "bob", "Dear bob")) # Fills the batch
+    assert not store.pending
+    assert store.get("b.docx")["timings"] == {"processing_s": 1.5}
+    assert store.get("c.docx") is None
+
+
+def test_latest_row_per_file_wins(store):
+    store.add(success("a.docx", "amy", "first", recorded_at=1.0))
+    store.flush()
+    store.add({"file": "a.docx", "student_identifier": "amy", "status": "api_error", "error": "503",
+               "recorded_at": 2.0})
+    rows = store.rows()
+    assert [(row["file"], row["status"]) for row in rows] == [("a.docx", "api_error")]
+    store.flush()
+    assert [row["status"] for row in read_results(store.path)] == ["api_error"]
+
+
+def test_read_results_merges_worker_stores(tmp_path):
+    main = open_results_store("jsonl", store_path(str(tmp_path), "results", "jsonl"))
+    worker = open_results_store("jsonl", store_path(str(tmp_path), "results.w2", "jsonl"))
+    main.add(success("a.docx", "amy", "old", recorded_at=1.0))
+    worker.add(success("a.docx", "amy", "new", recorded_at=2.0))
+    worker.add(success("b.docx", "bob", "Dear bob", recorded_at=1.0))
+    main.close()
+    worker.close()
+    rows = read_results(main.path)
+    assert [(row["file"], row["feedback"]) for row in rows] == [("a.docx", "new"), ("b.docx", "Dear bob")]
+
+
+def test_output_file_names():
+    row = success("jdoe_1_100_Essay.docx", "jdoe", "Dear jdoe")
+    assert output_file(row) == ("jdoe_feedback.txt", "Dear jdoe")
+    assert output_file(row, per_paper=True)[0] == "jdoe_1_100_Essay_docx_feedback.txt"
+    error = {"file": "essay.pdf", "student_identifier": "jdoe", "status": "file_error", "error": "bad PDF"}
+    name, contents = output_file(error, per_paper=True)
+    assert name == "jdoe_essay_pdf_ERROR_File_Processing.txt"
+    assert "essay.pdf" in contents and "bad PDF" in contents
+
+
+def test_export_names_files_per_paper_for_students_with_several(tmp_path):
+    rows = [success("jdoe_1_100_Essay.docx", "jdoe", "essay letter", recorded_at=1.0),
+            success("jdoe_1_100_Appendix.docx", "jdoe", "appendix letter", recorded_at=2.0),
+            success("asmith_2_90_Essay.docx", "asmith", "Dear asmith", recorded_at=3.0),
+            {"file": "bob.docx", "student_identifier": "bob", "status": "api_error", "error": "503",
+             "error_kind": "transient", "recorded_at": 4.0}]
+    folder = os.path.join(str(tmp_path), "feedback")
+    assert export_results(rows, folder) == 4
+    assert sorted(os.listdir(folder)) == ["asmith_feedback.txt", "bob_ERROR_API_Call_Failed.txt",
+                                          "jdoe_1_100_Appendix_docx_feedback.txt",
+                                          "jdoe_1_100_Essay_docx_feedback.txt"]
+    with open(os.path.join(folder, "jdoe_1_100_Essay_docx_feedback.txt"), "r", encoding="utf-8") as f:
+        assert f.read() == "essay letter"
+    assert export_results(rows, os.path.join(str(tmp_path), "successes"), statuses={"success"}) == 3
+
+
+def test_export_uses_the_output_name_the_run_chose(tmp_path):
+    rows = [dict(success("jdoe_1_100_Essay.docx", "jdoe", "essay letter", recorded_at=1.0),
+                 output_name="jdoe_1_100_Essay_docx"),
+            dict(success("jdoe_1_100_Appendix.docx", "jdoe", "appendix letter", recorded_at=2.0),
+                 output_name="jdoe_1_100_Appendix_docx")]
+    folder = str(tmp_path)
+    export_results(rows[:1], folder)
+    assert os.listdir(folder) == ["jdoe_1_100_Essay_docx_feedback.txt"]
+
+
+def test_export_ignores_replaced_attempts_when_naming(tmp_path):
+    # Rows without an output name: the earlier attempt doesn't make jdoe a student with two papers
+    rows = [success("jdoe_1_100_Essay.docx", "jdoe", "first draft", recorded_at=1.0),
+            success("jdoe_1_100_Essay-1.docx", "jdoe", "second draft", recorded_at=2.0)]
+    folder = str(tmp_path)
+    export_results(rows, folder)
+    assert os.listdir(folder) == ["jdoe_feedback.txt"]
+    with open(os.path.join(folder, "jdoe_feedback.txt"), "r", encoding="utf-8") as f:
+        assert f.read() == "second draft"
+
+
+def test_sqlite_store_from_before_output_names_is_upgraded(tmp_path):
+    path = store_path(str(tmp_path), "results", "sqlite")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE results (file TEXT PRIMARY KEY, student_identifier TEXT NOT NULL, "
+                       "status TEXT NOT NULL, feedback TEXT, block_reason TEXT, safety_ratings TEXT, error TEXT, "
+                       "error_kind TEXT, model TEXT, prompt_tokens INTEGER, output_tokens INTEGER, "
+                       "cached_tokens INTEGER, cost_usd REAL, timings TEXT, prompt_version TEXT, "
+                       "recorded_at REAL NOT NULL)")
+    connection.commit()
+    connection.close()
+    store = open_results_store("sqlite", path, batch_size=1)
+    store.add(dict(success("a.docx", "amy", "Dear amy"), output_name="amy"))
+    assert store.get("a.docx")["output_name"] == "amy"
+    store.close()
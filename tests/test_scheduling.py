@@ -0,0 +1,81 @@
+import datetime
+
+import pytest
+
+from feedback_assistant.scheduling import Schedule, ScheduleError, estimated_chars, load_schedule, order_papers, urgency
+
+
+def write(tmp_path, text):
+    path = tmp_path / "schedule.csv"
+    path.write_text(text, encoding="utf-8")
+    return str(path)
+
+
+def test_shortest_first_without_a_schedule():
+    sizes = {"big_1_1_a.docx": 900, "small_2_2_b.docx": 100, "mid_3_3_c.docx": 500}
+    assert order_papers(list(sizes), sizes.get) == ["small_2_2_b.docx", "mid_3_3_c.docx", "big_1_1_a.docx"]
+    assert order_papers(list(sizes), sizes.get, shortest_first=False) == list(sizes)
+
+
+def test_load_schedule(tmp_path):
+    path = write(tmp_path, "# Finals week\nstudent,section,priority,due\n"
+                           "JDoe,HIST-101-02,,2026-10-18 09:00\nasmith,,2,\nbob,HIST-101-01,,\n")
+    schedule = load_schedule(path)
+    jdoe = schedule.lookup("jdoe_12345_67890_Essay.docx")
+    assert jdoe["due"] == datetime.datetime(2026, 10, 18, 9, 0).timestamp()
+    assert jdoe["section"] == "HIST-101-02" and jdoe["priority"] is None
+    assert schedule.lookup("asmith_2_3_x.docx")["priority"] == 2
+    assert schedule.lookup("nobody_1_1_x.docx") == {}
+    assert schedule.sections() == ["HIST-101-01", "HIST-101-02"]
+    assert schedule.urgent_count() == 2 # A section alone doesn't make bob urgent
+
+
+def test_plain_list_of_students(tmp_path):
+    schedule = load_schedule(write(tmp_path, "jdoe\nessay_by_hand.pdf\n"))
+    assert schedule.lookup("jdoe_1_2_x.docx")["priority"] == 0
+    assert schedule.lookup("essay_by_hand.pdf")["priority"] == 0
+    assert load_schedule(write(tmp_path, "")).entries == {}
+
+
+def test_bad_rows_are_reported(tmp_path):
+    with pytest.raises(ScheduleError, match="Line 3"):
+        load_schedule(write(tmp_path, "student,due\njdoe,2026-10-18\nasmith,next week\n"))
+    with pytest.raises(ScheduleError, match="teacher"):
+        load_schedule(write(tmp_path, "student,teacher\njdoe,smith\n"))
+
+
+def test_urgent_papers_come_first():
+    sizes = {"a_1_1_x.docx": 100, "due_late_2_2_x.docx": 900, "due_soon_3_3_x.docx": 800, "prio_4_4_x.docx": 700}
+    schedule = Schedule({"due": {"section": "", "priority": None, "due": 200.0},
+                         "prio": {"section": "", "priority": 1, "due": None},
+                         "due_soon_3_3_x.docx": {"section": "", "priority": None, "due": 100.0}})
+    # Earliest due date first, then priorities, then everyone else (shortest first)
+    assert order_papers(list(sizes), sizes.get, schedule) == [
+        "due_soon_3_3_x.docx", "due_late_2_2_x.docx", "prio_4_4_x.docx", "a_1_1_x.docx"]
+
+
+def test_sections_share_the_work_fairly():
+    # Section A has many small papers, section B one large one: B is not left until the end
+    sizes = {f"a{number}_1_1_x.docx": 100 for number in range(6)}
+    sizes["b0_2_2_x.docx"] = 300
+    schedule = Schedule({**{f"a{number}": {"section": "A", "priority": None, "due": None} for number in range(6)},
+                         "b0": {"section": "B", "priority": None, "due": None}})
+    ordered = order_papers(list(sizes), sizes.get, schedule)
+    assert ordered.index("b0_2_2_x.docx") == 1
+    assert ordered[0] == "a0_1_1_x.docx"
+
+
+def test_file_size_is_corrected_for_the_file_type():
+    # A two-page .docx is a larger file than a ten-page .pdf, but the shorter paper
+    sizes = {"short_1_1_x.docx": 38_000, "long_2_2_x.pdf": 25_000}
+    length = lambda filename: estimated_chars(filename, sizes[filename])
+    assert order_papers(list(sizes), length) == ["short_1_1_x.docx", "long_2_2_x.pdf"]
+    assert estimated_chars("tiny_3_3_x.docx", 20_000) == 0
+
+
+def test_urgency_tiers():
+    schedule = Schedule({"jdoe": {"section": "A", "priority": 1, "due": None},
+                         "bob": {"section": "B", "priority": None, "due": None}})
+    assert urgency(schedule, "jdoe_1_1_x.docx") < urgency(schedule, "bob_2_2_x.docx")
+    # A section alone is no more urgent than no schedule at all
+    assert urgency(schedule, "bob_2_2_x.docx") == urgency(None, "bob_2_2_x.docx") == urgency(Schedule(), "x.pdf")
@@ -0,0 +1,37 @@
+import types
+
+from google.api_core import exceptions
+
+from feedback_assistant.rate_limiter import RateLimiter, estimate_tokens
+from feedback_assistant.retry import RetryPolicy
+from feedback_assistant.tokens import TokenCounter
+
+TEMPLATE = types.SimpleNamespace(prefix="You are a writing tutor. " * 4)
+
+
+class CountingModel:
+    # count_tokens() answers 429 for the first `failures` calls
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.calls = 0
+
+    def count_tokens(self, text):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise exceptions.ResourceExhausted("Quota exceeded (simulated).")
+        return types.SimpleNamespace(total_tokens=len(text.split()))
+
+
+def test_api_count_is_retried():
+    model = CountingModel(failures=1)
+    counter = TokenCounter("api", TEMPLATE, model, RateLimiter(6000), RetryPolicy(3, 0.01, 0.02))
+    assert counter.count("three word paper") == counter.prefix_tokens + 3
+    assert counter.fallbacks == 0 and model.calls == 3
+
+
+def test_failing_api_count_falls_back_to_the_estimate(capsys):
+    counter = TokenCounter("api", TEMPLATE, CountingModel(failures=100), None, RetryPolicy(2, 0.01, 0.02))
+    assert counter.count("a paper") == estimate_tokens(TEMPLATE.prefix) + estimate_tokens("a paper")
+    assert counter.fallbacks == 2
+    assert capsys.readouterr().out.count("count_tokens failed") == 1